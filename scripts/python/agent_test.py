@@ -0,0 +1,262 @@
+#!/usr/bin/python2
+
+import unittest
+import socket
+import time
+
+from pss.agent import Agent, AgentPool, ResponseParser
+
+response = "HTTP/1.1 200 OK\nContent-Length: 4\n\ninky"
+
+
+# fake gateway end of a socket pair
+class TestAgent(unittest.TestCase):
+
+
+	def setUp(self):
+		(self.client, self.server) = socket.socketpair()
+		self.agent = Agent("127.0.0.1", 8500, self.client.fileno())
+
+
+	# requests must not be delayed by anything but the gateway
+	def test_get(self):
+		self.server.sendall(response)
+		t = time.time()
+		body = self.agent.get("/bzz-raw:/")
+		self.assertEqual(body, "inky")
+		self.assertTrue(time.time() - t < 0.5)
+		self.assertEqual(self.server.recv(1024)[:16], "GET /bzz-raw:/ H")
+
+
+	# non-blocking request completes via callback when socket is processed
+	def test_get_async(self):
+		results = []
+		resp = self.agent.get_async("/bzz-raw:/", "", results.append)
+		self.assertFalse(resp.done)
+		self.assertEqual(self.agent.poll(0), 0)
+
+		self.server.sendall(response)
+		self.assertEqual(self.agent.poll(1.0), 1)
+		self.assertEqual(len(results), 1)
+		self.assertEqual(results[0].result(), "inky")
+		self.assertEqual(self.agent.pending_count(), 0)
+
+
+	# all requests are written before the first response is read
+	def test_get_many(self):
+		self.server.sendall(response + "HTTP/1.1 404 Not Found\nContent-Length: 0\n\n" + response)
+		resps = self.agent.get_many(["/a", "/b", "/c"])
+		self.assertEqual(self.server.recv(1024).count("GET /"), 3)
+		self.assertEqual(resps[0].result(), "inky")
+		self.assertNotEqual(resps[1].err, None)
+		self.assertEqual(resps[2].result(), "inky")
+
+
+	# pending responses fail when gateway disconnects
+	def test_eof(self):
+		resp = self.agent.get_async("/bzz-raw:/")
+		self.server.close()
+		self.agent.poll(1.0)
+		self.assertTrue(resp.done)
+		with self.assertRaises(IOError):
+			resp.result()
+
+
+	# body larger than a single socket read
+	def test_get_large(self):
+		data = "x" * 300000
+		self.agent.get_async("/bzz-raw:/")
+		resp = self.agent.get_async("/bzz-raw:/")
+		self.server.sendall(response + "HTTP/1.1 200 OK\r\nContent-Length: " + str(len(data)) + "\r\n\r\n")
+		crsr = 0
+		while crsr < len(data):
+			crsr += self.server.send(data[crsr:crsr+65536])
+			self.agent.poll(0.1)
+		self.assertEqual(self.agent.wait(resp), data)
+
+
+	def tearDown(self):
+		self.client.close()
+		self.server.close()
+
+
+
+class TestAgentPool(unittest.TestCase):
+
+
+	def setUp(self):
+		self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.listener.bind(("127.0.0.1", 0))
+		self.listener.listen(8)
+		self.pool = AgentPool("127.0.0.1", self.listener.getsockname()[1], 2)
+		self.pool.connect()
+		self.conns = [self.listener.accept()[0] for i in range(2)]
+
+
+	# concurrent requests are spread over connections
+	def test_parallel(self):
+		resps = [self.pool.get_async("/bzz-raw:/") for i in range(2)]
+		for c in self.conns:
+			self.assertEqual(c.recv(1024)[:3], "GET")
+			c.sendall(response)
+		for r in resps:
+			self.assertEqual(self.pool.wait(r), "inky")
+		self.assertEqual(len(self.pool.idle), 2)
+
+
+	# connection closed by gateway while idle is replaced on checkout
+	def test_reconnect(self):
+		fds = self.pool.fds()
+		for c in self.conns:
+			c.close()
+		time.sleep(0.1)
+		agent = self.pool.checkout()
+		self.assertTrue(agent.is_alive())
+		self.assertTrue(agent.fileno() in fds)
+		c = self.listener.accept()[0]
+		self.pool.checkin(agent)
+		c.close()
+
+
+	# timeout only takes down the connection of the response waited for
+	def test_wait_timeout(self):
+		resps = [self.pool.get_async("/bzz-raw:/") for i in range(2)]
+		self.assertNotEqual(resps[0].agent, resps[1].agent)
+		with self.assertRaises(IOError):
+			self.pool.wait(resps[0], 0.1)
+		self.assertFalse(resps[0].agent.up)
+		self.assertTrue(resps[1].agent.up)
+		self.assertFalse(resps[1].done)
+
+
+	# posts are not replayed when the gateway drops the connection, gets are retried once
+	def test_retry(self):
+		calls = []
+		def drop(agent, *args):
+			calls.append(args)
+			agent.up = False
+			raise IOError("swarm closed connection")
+		self.assertRaises(IOError, self.pool._call, drop, False, "/bzz-raw:/", "data")
+		self.assertEqual(len(calls), 1)
+		self.assertRaises(IOError, self.pool._call, drop, True, "/bzz-raw:/")
+		self.assertEqual(len(calls), 3)
+
+		# requests that timed out are not retried
+		def stall(agent, *args):
+			calls.append(args)
+			agent._expire()
+			raise IOError("HTTP response from swarm timed out")
+		self.assertRaises(IOError, self.pool._call, stall, True, "/bzz-raw:/")
+		self.assertEqual(len(calls), 4)
+
+
+	# connections opened on demand are announced
+	def test_onconnect(self):
+		fds = []
+		pool = AgentPool("127.0.0.1", self.listener.getsockname()[1], 2, None, fds.append)
+		agents = [pool.checkout(), pool.checkout()]
+		self.conns += [self.listener.accept()[0] for i in range(2)]
+		self.assertEqual(fds, pool.fds())
+		self.assertEqual(len(fds), 2)
+		pool.close()
+
+
+	# response arriving after timeout is not taken as response to the next request
+	def test_late_response(self):
+		agent = self.pool.checkout()
+		resp = agent.get_async("/bzz-raw:/aa/")
+		with self.assertRaises(IOError):
+			agent.wait(resp, 0.1)
+		self.assertFalse(agent.up)
+		for c in self.conns:
+			c.sendall("HTTP/1.1 200 OK\nContent-Length: 8\n\nchunk-aa")
+
+		resp = agent.get_async("/bzz-raw:/bb/")
+		c = self.listener.accept()[0]
+		self.conns.append(c)
+		self.assertEqual(c.recv(1024)[:16], "GET /bzz-raw:/bb")
+		c.sendall("HTTP/1.1 200 OK\nContent-Length: 8\n\nchunk-bb")
+		self.assertEqual(agent.wait(resp), "chunk-bb")
+
+
+	def tearDown(self):
+		self.pool.close()
+		for c in self.conns:
+			c.close()
+		self.listener.close()
+
+
+
+class TestResponseParser(unittest.TestCase):
+
+
+	def setUp(self):
+		self.parser = ResponseParser()
+
+
+	# data arriving one byte at a time
+	def test_content_length_partial(self):
+		s = "HTTP/1.1 200 OK\r\nContent-Length: 6\r\nX-Foo: bar\r\n\r\n{}\n\n{}"
+		for c in s[:-1]:
+			self.parser.feed(c)
+			self.assertEqual(self.parser.next(), None)
+		self.parser.feed(s[-1])
+		(status, headers, body) = self.parser.next()
+		self.assertEqual(status, 200)
+		self.assertEqual(headers["x-foo"], "bar")
+		self.assertEqual(body, "{}\n\n{}")
+		self.assertEqual(self.parser.buffered(), 0)
+
+
+	def test_chunked(self):
+		self.parser.feed("HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n4\r\ninky\r\n5;ext=1\r\npinky\r\n0\r\n")
+		self.assertEqual(self.parser.next(), None)
+		self.parser.feed("\r\n")
+		(status, _, body) = self.parser.next()
+		self.assertEqual(body, "inkypinky")
+
+
+	# responses split at any offset, including between carriage return and newline
+	def test_chunked_split(self):
+		s = "HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n5\r\nhello\r\n0\r\n\r\n" + response
+		for i in range(len(s)):
+			parser = ResponseParser()
+			parser.feed(s[:i])
+			bodies = []
+			r = parser.next()
+			if r != None:
+				bodies.append(r[2])
+			parser.feed(s[i:])
+			while True:
+				r = parser.next()
+				if r == None:
+					break
+				bodies.append(r[2])
+			self.assertEqual(bodies, ["hello", "inky"])
+
+
+	# leftover bytes are kept for the next response
+	def test_pipelined(self):
+		self.parser.feed(response + response + "HTTP/1.1 404 Not Found\nContent-Length: 0\n\nHTTP/1.1")
+		self.assertEqual(self.parser.next()[2], "inky")
+		self.assertEqual(self.parser.next()[2], "inky")
+		self.assertEqual(self.parser.next()[0], 404)
+		self.assertEqual(self.parser.next(), None)
+		self.assertEqual(self.parser.buffered(), 8)
+
+
+	def test_until_close(self):
+		self.parser.feed("HTTP/1.1 200 OK\n\nblinky")
+		self.assertEqual(self.parser.next(), None)
+		self.parser.eof()
+		self.assertEqual(self.parser.next()[2], "blinky")
+
+
+	def test_invalid(self):
+		self.parser.feed("SPAM\n\n")
+		with self.assertRaises(IOError):
+			self.parser.next()
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,467 @@
+#!/usr/bin/python2
+
+import unittest
+import time
+import json
+import struct
+import urlparse
+
+from pss.agent import AgentResponse, AgentHTTPError
+from pss.user import Account
+from pss.message import Message
+from pss.schedule import Scheduler
+from pss.bzz import Bzz, ChunkCache, Feed, FeedState, FeedCollection, zerohsh, epoch_next, epoch_base, parse_update, FEED_HIGHEST_LEVEL
+
+
+# stands in for the gateway, counting requests
+class FakeAgent:
+
+	def __init__(self):
+		self.chunks = {}
+		self.heads = {}
+		self.requests = 0
+		self.queue = []
+		self.maxqueue = 0
+
+
+	def send(self, path, data, querystring=""):
+		hsh = "{:064x}".format(len(self.chunks) + 1)
+		self.chunks[hsh] = data
+		return hsh
+
+
+	def get(self, path, querystring=""):
+		self.requests += 1
+		try:
+			if path == "/bzz-feed:/":
+				q = urlparse.parse_qs(querystring)
+				return self.heads[q["user"][0][2:]]
+			return self.chunks[path.split("/")[2]]
+		except KeyError as e:
+			raise IOError("404 not found")
+
+
+	# responses are held back until poll
+	def get_async(self, path, querystring="", callback=None):
+		self.queue.append((path, querystring, callback))
+		self.maxqueue = max(self.maxqueue, len(self.queue))
+
+
+	def poll(self, timeout=0):
+		queue = self.queue
+		self.queue = []
+		for (path, querystring, callback) in queue:
+			r = AgentResponse(callback)
+			try:
+				r.resolve(200, self.get(path, querystring))
+			except IOError as e:
+				r.fail(e)
+		return len(queue)
+
+
+	def get_many(self, paths):
+		resps = []
+		for p in paths:
+			r = AgentResponse()
+			try:
+				r.resolve(200, self.get(p))
+			except IOError as e:
+				r.fail(e)
+			resps.append(r)
+		return resps
+
+
+
+class TestChunkCache(unittest.TestCase):
+
+
+	def setUp(self):
+		self.agent = FakeAgent()
+		self.bzz = Bzz(self.agent, ChunkCache(10))
+
+
+	def test_lru(self):
+		cache = self.bzz.cache
+		cache.put("a", "inky")
+		cache.put("b", "pinky")
+		self.assertEqual(cache.get("a"), "inky")
+		cache.put("c", "sue")
+		self.assertEqual(cache.get("b"), None)
+		self.assertEqual(cache.get("a"), "inky")
+		cache.put("d", "clydeclydeclyde")
+		self.assertEqual(cache.get("d"), None)
+		self.assertEqual(cache.stats(), {"hits": 2, "misses": 2, "evictions": 1, "chunks": 2, "size": 7})
+
+
+	# repeated gets of same hash only hit the network once
+	def test_get(self):
+		self.agent.chunks["ff"] = "blinky"
+		self.assertEqual(self.bzz.get("ff"), "blinky")
+		self.assertEqual(self.bzz.get("ff"), "blinky")
+		self.assertEqual(self.agent.requests, 1)
+
+		hsh = self.bzz.add("inky")
+		self.assertEqual(self.bzz.get(hsh), "inky")
+		self.assertEqual(self.agent.requests, 1)
+
+		self.assertEqual(self.bzz.get_many(["ff", "ee", hsh]), ["blinky", None, "inky"])
+		self.assertEqual(self.agent.requests, 2)
+
+
+	# concurrent requests for the same chunk share one request
+	def test_single_flight(self):
+		self.bzz.cache = ChunkCache(0)
+		hsh = self.bzz.add("clyde")
+		results = []
+		def done(data, err):
+			results.append(data)
+		self.bzz.get_async(hsh, done)
+		self.bzz.get_async(hsh, done)
+		self.assertEqual(len(self.agent.queue), 1)
+		self.assertEqual(self.bzz.get(hsh), "clyde")
+		self.assertEqual(results, ["clyde", "clyde"])
+		self.assertEqual(self.agent.requests, 1)
+		self.assertEqual(self.bzz.inflight, {})
+
+
+	def test_inflight_expire(self):
+		self.bzz.cache = ChunkCache(0)
+		hsh = self.bzz.add("clyde")
+		results = []
+		def done(data, err):
+			results.append((data, err))
+		self.bzz.timeout = 0
+		self.bzz.get_async(hsh, done)
+		self.bzz.expire()
+		self.assertEqual(results[0][0], None)
+		self.assertTrue(isinstance(results[0][1], IOError))
+		self.assertEqual(self.bzz.inflight, {})
+
+		# late response for the expired request is dropped, and a new request is issued
+		self.bzz.timeout = 30
+		self.bzz.get_async(hsh, done)
+		self.assertEqual(len(self.agent.queue), 2)
+		self.bzz.poll()
+		self.assertEqual(results[1:], [("clyde", None)])
+		self.assertEqual(self.bzz.inflight, {})
+
+
+	def test_wait_timeout(self):
+		self.bzz.cache = ChunkCache(0)
+		self.agent.poll = lambda timeout=0: 0
+		hsh = self.bzz.add("clyde")
+		def done(data, err):
+			pass
+		self.bzz.get_async(hsh, done)
+		path = "/bzz-raw:/" + hsh + "/"
+		self.assertRaises(IOError, self.bzz._wait, path, "", 0.01)
+		self.assertEqual(self.bzz.inflight[path + "?"][0], [done])
+		self.bzz.abandon(done)
+		self.assertEqual(self.bzz.inflight, {})
+
+
+
+class TestFeedCollection(unittest.TestCase):
+
+
+	def setUp(self):
+		self.agent = FakeAgent()
+		self.bzz = Bzz(self.agent)
+		self.coll = FeedCollection("test")
+		self.timebytes = struct.pack(">I", 1000)
+
+
+	# add a feed with a linked list of updates, starting at lasthsh
+	def add_feed(self, name, n, lasthsh=zerohsh):
+		acc = Account()
+		acc.set_address(chr(len(self.coll.feeds)) * 20)
+		for i in range(n):
+			lasthsh = self.bzz.add(lasthsh + self.timebytes + chr(i) + name + str(i)).decode("hex")
+		self.agent.heads[acc.get_address().encode("hex")] = lasthsh
+		self.coll.add(name, Feed(self.bzz, acc, name))
+		return acc.get_address()
+
+
+	# only updates rejected by the node are posted again with the epoch from the node
+	def test_update_retry(self):
+		acc = Account()
+		acc.set_key("\x01" * 32)
+		feed = Feed(self.bzz, acc, "foo")
+		feed.lastupdate = 1000
+		feed.lastepoch = 25
+		posts = []
+		def send(path, data, querystring=""):
+			posts.append(querystring)
+			if len(posts) == 1:
+				raise errors.pop(0)
+			return "ok"
+		self.agent.send = send
+		self.agent.get = lambda path, querystring="": json.dumps({"epoch": {"time": 2000, "level": 3}})
+
+		errors = [AgentHTTPError(400, "bad epoch")]
+		self.assertEqual(feed.update("data"), "ok")
+		self.assertEqual((len(posts), feed.lastepoch), (2, 3))
+
+		posts = []
+		feed.lastupdate = 1000
+		errors = [IOError("HTTP response from swarm timed out")]
+		self.assertRaises(IOError, feed.update, "data")
+		self.assertEqual(len(posts), 1)
+
+
+	# feeds are walked in parallel, at most concurrency at a time
+	def test_gethead(self):
+		self.bzz.cache = ChunkCache(0)
+		addrs = [self.add_feed(n, 3) for n in ["foo", "bar", "baz"]]
+		(ridx, fails) = self.coll.gethead(self.bzz, True, 2)
+		self.assertEqual(len(fails), 0)
+		self.assertEqual(self.agent.maxqueue, 2)
+		msgs = self.coll.retrievals[ridx]
+		self.assertEqual(len(msgs), 3)
+		self.assertEqual(msgs[addrs[1]][self.timebytes + "\x02"].content, "bar2")
+
+		# nothing new on next retrieval
+		(ridx, _) = self.coll.gethead(self.bzz)
+		self.assertEqual(self.coll.retrievals[ridx], {})
+
+
+	# retrieval limited by number of requests continues on next call, newest updates first
+	def test_budget(self):
+		self.add_feed("foo", 5)
+		(ridx, _) = self.coll.gethead(self.bzz, hops=4)
+		self.assertEqual([m.content for m in self.coll.get(ridx)], ["foo3", "foo4"])
+		self.assertEqual(self.coll.pending(), 1)
+		(ridx, _) = self.coll.gethead(self.bzz, hops=4)
+		self.assertEqual([m.content for m in self.coll.get(ridx)], ["foo0", "foo1", "foo2"])
+		self.assertEqual(self.coll.pending(), 0)
+		self.assertEqual(self.coll.feeds["foo"].curhsh, "")
+
+
+	# only feeds due in schedule are polled
+	def test_schedule(self):
+		self.coll.schedule = Scheduler()
+		self.add_feed("foo", 1)
+		self.coll.gethead(self.bzz)
+		requests = self.agent.requests
+		self.coll.gethead(self.bzz)
+		self.assertEqual(self.agent.requests, requests)
+		self.coll.schedule.force()
+		self.coll.gethead(self.bzz)
+		self.assertEqual(self.agent.requests, requests + 1)
+
+
+	# announced update is retrieved without feed lookup
+	def test_hint(self):
+		self.coll.schedule = Scheduler()
+		addr = self.add_feed("foo", 1)
+		self.coll.gethead(self.bzz)
+		self.coll.get()
+		headhsh = self.agent.heads[addr.encode("hex")]
+		hsh = self.bzz.add(headhsh + self.timebytes + "\x01foo1").decode("hex")
+		self.coll.hint("foo", hsh)
+		(ridx, _) = self.coll.gethead(self.bzz)
+		self.assertEqual([m.content for m in self.coll.get(ridx)], ["foo1"])
+		self.assertEqual(self.coll.feeds["foo"].lasthsh, hsh)
+
+
+	def test_gap(self):
+		bogushsh = "\x01" * 32
+		addr = self.add_feed("foo", 2, bogushsh)
+		headhsh = self.agent.heads[addr.encode("hex")]
+		(ridx, fails) = self.coll.gethead(self.bzz)
+		self.assertEqual(self.coll.feeds["foo"].orphans[headhsh], bogushsh)
+		self.assertEqual(len(self.coll.retrievals[ridx][addr]), 2)
+
+
+	# updates written with skip list headers can be read, skipped and paged
+	def test_skiplist(self):
+		acc = Account()
+		acc.set_key("\x01" * 32)
+		sender = FeedCollection("sender", Feed(self.bzz, acc, "foo"), True)
+		hshs = [zerohsh]
+		for i in range(1, 21):
+			hshs.append(sender.write("msg" + str(i)).decode("hex"))
+
+		(prevhsh, _, height, skips, content) = parse_update(self.bzz.get(hshs[20].encode("hex")))
+		self.assertEqual((prevhsh, height, content), (hshs[19], 20, "msg20"))
+		self.assertEqual(skips, [hshs[18], hshs[16]])
+
+		reader = Account()
+		reader.set_address(acc.get_address())
+		self.agent.heads[acc.get_address().encode("hex")] = hshs[20]
+		self.coll.backlog = 5
+		self.coll.add("foo", Feed(self.bzz, reader, "foo"))
+		(ridx, _) = self.coll.gethead(self.bzz)
+		msgs = self.coll.get(ridx)
+		self.assertEqual([m.content for m in msgs], ["msg" + str(i) for i in range(16, 21)])
+		self.assertEqual(self.coll.feeds["foo"].gaps, {hshs[15]: (15, zerohsh)})
+
+		requests = self.agent.requests
+		self.bzz.cache = ChunkCache(0)
+		self.assertEqual(self.coll.seek(self.bzz, hshs[20], 3), hshs[3])
+		self.assertTrue(self.agent.requests - requests < 8)
+
+		self.coll.get(self.coll.page(self.bzz, "foo", 15, 10))
+		self.assertEqual(self.coll.feeds["foo"].gaps, {hshs[5]: (5, zerohsh)})
+		msgs = self.coll.get(self.coll.page(self.bzz, "foo", 5, 10))
+		self.assertEqual(len(msgs), 5)
+		self.assertEqual(self.coll.feeds["foo"].gaps, {})
+
+
+	# update indices stay unique when serials of a second are used up
+	def test_serial(self):
+		state = FeedState(None)
+		state.lasttime = 0x7fffffff
+		serials = set()
+		for i in range(300):
+			state.next()
+			serials.add(state.serial())
+		self.assertEqual(len(serials), 300)
+		self.assertEqual(state.lasttime, 0x7fffffff + 2)
+
+
+	# all buffered retrievals are merged in order of time, sequence and address
+	def test_get(self):
+		msgs = {}
+		for (tim, seq, name) in [(2, 0, "a"), (1, 1, "b"), (256, 0, "c"), (1, 0, "d")]:
+			acc = Account()
+			acc.set_address(name * 20)
+			serial = struct.pack("<I", tim) + chr(seq)
+			msgs[name] = {acc.get_address(): {serial: Message(serial, acc, name)}}
+		self.coll._buffer(msgs["a"])
+		self.coll._buffer(msgs["b"])
+		ridx = self.coll._buffer(msgs["c"])
+		self.coll._buffer(msgs["d"])
+		self.assertEqual([m.content for m in self.coll.get(ridx)], ["c"])
+		self.assertEqual([m.content for m in self.coll.get()], ["d", "b", "a"])
+		self.assertEqual(self.coll.retrievals, [])
+
+		# oldest messages are dropped when buffer is full
+		self.coll.buffersize = 2
+		self.coll._buffer(msgs["a"])
+		self.coll._buffer(msgs["b"])
+		self.coll._buffer(msgs["c"])
+		self.assertEqual(self.coll.overflow(), 1)
+		self.assertEqual(self.coll.overflow(), 0)
+		self.assertEqual([m.content for m in self.coll.get()], ["b", "c"])
+
+
+	# updates lost to a failed retrieval are retried and delivered
+	def test_repair(self):
+		self.bzz.cache = ChunkCache(0)
+		addr = self.add_feed("foo", 4)
+		brokenhsh = "{:064x}".format(len(self.agent.chunks) - 1)
+		chunk = self.agent.chunks.pop(brokenhsh)
+		(ridx, _) = self.coll.gethead(self.bzz)
+		self.assertEqual([m.content for m in self.coll.get(ridx)], ["foo3"])
+		feedstate = self.coll.feeds["foo"]
+		self.assertEqual(feedstate.orphans.values(), [brokenhsh.decode("hex")])
+
+		# not due yet
+		self.assertEqual(self.coll.repair(self.bzz)[1:], (0, 1))
+
+		# failed retry is delayed further
+		feedstate.repairs[brokenhsh.decode("hex")] = (brokenhsh.decode("hex"), zerohsh, 0, 0)
+		self.assertEqual(self.coll.repair(self.bzz)[1:], (0, 1))
+		self.assertEqual(feedstate.repairs[brokenhsh.decode("hex")][2], 1)
+
+		self.agent.chunks[brokenhsh] = chunk
+		feedstate.repairs[brokenhsh.decode("hex")] = (brokenhsh.decode("hex"), zerohsh, 1, 0)
+		(ridx, recovered, pending) = self.coll.repair(self.bzz)
+		self.assertEqual((recovered, pending), (1, 0))
+		self.assertEqual([m.content for m in self.coll.get(ridx)], ["foo0", "foo1", "foo2"])
+		self.assertEqual(feedstate.orphans, {})
+
+
+	# a stalled gateway holds up repair no longer than the budget
+	def test_repair_budget(self):
+		self.bzz.cache = ChunkCache(0)
+		addr = self.add_feed("foo", 4)
+		brokenhsh = "{:064x}".format(len(self.agent.chunks) - 1)
+		feedstate = self.coll.feeds["foo"]
+		feedstate.repairs[brokenhsh.decode("hex")] = (brokenhsh.decode("hex"), zerohsh, 0, 0)
+
+		poll = self.agent.poll
+		self.agent.poll = lambda timeout=0: time.sleep(timeout) or 0
+		t = time.time()
+		self.assertEqual(self.coll.repair(self.bzz, 0, 0.1)[1:], (0, 1))
+		self.assertTrue(time.time() - t < 0.5)
+		self.assertEqual(feedstate.repairs[brokenhsh.decode("hex")][2], 0)
+
+		self.agent.poll = poll
+		(ridx, recovered, pending) = self.coll.repair(self.bzz, 0, 0.1)
+		self.assertEqual((recovered, pending), (1, 0))
+		self.assertEqual([m.content for m in self.coll.get(ridx)], ["foo0", "foo1", "foo2"])
+
+
+	# request of walk that times out is given up on the agent
+	def test_gethead_timeout(self):
+		self.bzz.cache = ChunkCache(0)
+		self.add_feed("foo", 1)
+		expired = []
+		class Response:
+			def expire(self):
+				expired.append(self)
+		self.agent.get_async = lambda path, querystring="", callback=None: Response()
+		self.agent.poll = lambda timeout=0: time.sleep(timeout) or 0
+		(_, fails) = self.coll.gethead(self.bzz, False, timeout=0.01)
+		self.assertEqual(len(fails), 1)
+		self.assertEqual(len(expired), 1)
+		self.assertEqual(self.bzz.inflight, {})
+
+
+	# a restored collection resumes where the saved one left off
+	def test_checkpoint(self):
+		addr = self.add_feed("foo", 3)
+		self.coll.gethead(self.bzz)
+		checkpoint = json.loads(json.dumps(self.coll.get_checkpoint()))
+
+		headhsh = self.agent.heads[addr.encode("hex")]
+		self.agent.heads[addr.encode("hex")] = self.bzz.add(headhsh + self.timebytes + "\x03foo3").decode("hex")
+		acc = Account()
+		acc.set_address(addr)
+		coll = FeedCollection("test")
+		coll.add("foo", Feed(self.bzz, acc, "foo"))
+		coll.set_checkpoint(checkpoint)
+		self.assertEqual(coll.feeds["foo"].lasthsh, headhsh)
+		msgs = coll.get(coll.gethead(self.bzz)[0])
+		self.assertEqual([m.content for m in msgs], ["foo3"])
+
+		self.assertRaises(ValueError, coll.set_checkpoint, {"feeds": {"foo": {}}})
+
+
+	def test_fail(self):
+		self.add_feed("foo", 1)
+		self.agent.heads = {}
+		(_, fails) = self.coll.gethead(self.bzz)
+		self.assertEqual(len(fails), 1)
+		self.assertFalse(self.coll.feeds["foo"].active)
+
+
+
+# compare with epochs the swarm node assigns to successive updates
+class TestEpoch(unittest.TestCase):
+
+
+	def test_first(self):
+		self.assertEqual(epoch_next(0, FEED_HIGHEST_LEVEL, 1000), (1000, FEED_HIGHEST_LEVEL))
+
+
+	# frequent updates descend one level at a time
+	def test_descend(self):
+		(tim, level) = (1000, FEED_HIGHEST_LEVEL)
+		for i in range(1, 5):
+			(tim, level) = epoch_next(tim, level, 1000 + i)
+			self.assertEqual(level, FEED_HIGHEST_LEVEL - i)
+
+
+	def test_level(self):
+		self.assertEqual(epoch_base(1001, 10), 0)
+		self.assertEqual(epoch_next(1001, 10, 1030), (1030, 10))
+		self.assertEqual(epoch_next(5, 1, 5), (5, 0))
+		self.assertEqual(epoch_next(1000, 3, 1000 + (1 << 27)), (1000 + (1 << 27), FEED_HIGHEST_LEVEL))
+
+
+
+if __name__ == "__main__":
+	unittest.main()
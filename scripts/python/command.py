@@ -9,6 +9,7 @@ cmd_list = [
 	"msg",
 	"join",
 	"invite",
+	"refresh",
 	"key",
 	"pubkey",
 	"address",
@@ -48,6 +49,9 @@ def chk_join(pssName, command, params):
 def chk_invite(pssName, command, params):
 	pass
 
+def chk_refresh(pssName, command, params):
+	pass
+
 def chk_key(pssName, command, params):
 	pass
 
@@ -0,0 +1,86 @@
+#!/usr/bin/python2
+
+# measures throughput of the json-rpc stream framer pss.Stream
+#
+# the framer is not on the pss receive path of the client, which takes whole messages from websocket frames, so this does not measure message intake
+#
+# usage: content_bench.py [recorded stream file] [chunk size]
+#
+# without a file, a stream of pss receive notifications with random payloads is generated
+
+import sys
+import os
+import time
+import json
+
+from pss.content import Stream, rpc_call
+
+# total bytes of generated stream
+BENCH_SIZE = 16 * 1024 * 1024
+
+# bytes passed to the framer per call
+BENCH_CHUNK_SIZE = 4096
+
+BENCH_ROUNDS = 3
+
+
+def generate(size):
+	stanzas = []
+	total = 0
+	i = 0
+	while total < size:
+		msg = os.urandom(64 + (i % 16) * 128)
+		stanza = json.dumps({
+			"jsonrpc": "2.0",
+			"method": "pss_subscription",
+			"params": {
+				"subscription": "0x" + "ab" * 16,
+				"result": {
+					"Msg": "0x" + msg.encode("hex"),
+					"Key": "0x04" + os.urandom(64).encode("hex"),
+					"Asymmetric": True,
+				},
+			},
+		})
+		stanzas.append(stanza)
+		# interleave replies to our own requests
+		stanzas.append(rpc_call(i, "sendAsym", ["0x04", "0xdeadbee2", "{\"}"]))
+		total += len(stanza) + len(stanzas[-1])
+		i += 1
+	return "".join(stanzas), len(stanzas)
+
+
+def main():
+	chunksize = BENCH_CHUNK_SIZE
+	if len(sys.argv) > 2:
+		chunksize = int(sys.argv[2])
+
+	if len(sys.argv) > 1:
+		f = open(sys.argv[1], "rb")
+		data = f.read()
+		f.close()
+		expect = None
+	else:
+		(data, expect) = generate(BENCH_SIZE)
+
+	chunks = [data[i:i+chunksize] for i in range(0, len(data), chunksize)]
+
+	best = None
+	for _ in range(BENCH_ROUNDS):
+		stream = Stream()
+		count = 0
+		start = time.time()
+		for c in chunks:
+			count += len(stream.process(c)['results'])
+		elapsed = time.time() - start
+		if expect != None and count != expect:
+			raise RuntimeError("framed " + str(count) + " objects, expected " + str(expect))
+		if best == None or elapsed < best:
+			best = elapsed
+
+	mb = len(data) / (1024.0 * 1024.0)
+	print("%.1f MB in %d byte chunks, %d objects: %.1f MB/s" % (mb, chunksize, count, mb / best))
+
+
+if __name__ == "__main__":
+	main()
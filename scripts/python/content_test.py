@@ -0,0 +1,49 @@
+#!/usr/bin/python2
+
+import unittest
+import json
+
+from pss.content import Stream
+
+
+class TestStream(unittest.TestCase):
+
+
+	def setUp(self):
+		self.stream = Stream()
+
+
+	def test_split(self):
+		objs = ['{"id":1,"result":{"a":[1,2]}}', '{"id":2,"result":"0xabcd"}']
+		data = "\n".join(objs)
+		results = []
+		for i in range(0, len(data), 3):
+			r = self.stream.process(data[i:i+3])
+			results += r['results']
+		self.assertEqual(results, objs)
+		self.assertFalse(r['processing'])
+
+
+	# braces and escaped quotes inside strings are not counted
+	def test_strings(self):
+		objs = [json.dumps({"msg": "}{\\\"{", "key": "\"}"}), '{"a":"\\\\"}']
+		data = "".join(objs)
+		for n in range(1, len(data)):
+			stream = Stream()
+			r = stream.process(data[:n])
+			results = r['results'] + stream.process(data[n:])['results']
+			self.assertEqual(results, objs)
+		self.assertEqual([json.loads(o) for o in results], [json.loads(o) for o in objs])
+
+
+	# state is not shared between instances
+	def test_instances(self):
+		self.assertTrue(self.stream.process('{"a":')['processing'])
+		other = Stream()
+		self.assertEqual(other.process('{"b":1}')['results'], ['{"b":1}'])
+		self.assertEqual(self.stream.process('2}')['results'], ['{"a":2}'])
+
+
+
+if __name__ == "__main__":
+	unittest.main()
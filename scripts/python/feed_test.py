@@ -6,11 +6,10 @@ import socket
 import sys
 import random
 import struct
-import json
 
-from pss.bzz import feedRootTopic, FeedCollection, zerohsh, new_topic_mask
-from pss.room import Participant
-from pss.tools import clean_pubkey, now_int
+from pss.bzz import feedRootTopic, FeedCollection, zerohsh, new_topic_mask, parse_update
+from pss.room import Participant, ParticipantList
+from pss.tools import now_int
 
 privkey = "2ea3f401733d3ecc1e18b305245adc98f3ffc4c6e46bf42f37001fb18b5a70ac"
 pubkey = "04b72985aa2104e41c1a2d40340c2b71a8d641bb6ac0f9fd7dc2dbbd48c0eaf172baa41456d252532db97704ea4949e1f42f66fd57de00f8f1f4514a2889f42df6"
@@ -298,14 +297,13 @@ class TestFeedRebuild(unittest.TestCase):
 		# retrieve the pubkey from the saved room format	
 		# and create account with retrieved public key
 		# \todo more intuitive feed injection on load
-		unserializedroom = json.loads(serializedroom)
+		unserializedroom = ParticipantList.parse(serializedroom)
 		acc = pss.Account()
-		cleanpub = clean_pubkey(unserializedroom['pubkey'])
-		acc.set_public_key(cleanpub.decode("hex"))
+		acc.set_public_key(unserializedroom.owner)
 		return
 
 		# create feed with account from newly (re)created account
-		recreatedownerfeed = pss.Feed(self.bzz, acc, unserializedroom['name'])
+		recreatedownerfeed = pss.Feed(self.bzz, acc, unserializedroom.name)
 
 		# instantiate room with feed recreated from saved state
 		rr = pss.Room(self.bzz, recreatedownerfeed)
@@ -381,20 +379,19 @@ class TestFeedRebuild(unittest.TestCase):
 
 		hsh = r.send(msg)
 
-		body = self.bzz.get(hsh)
-		self.assertEqual(body[37:69], r.hsh_room)
+		(_, _, _, _, body) = parse_update(self.bzz.get(hsh))
+		self.assertEqual(body[:32], r.hsh_room)
 	
-		roomparticipants = json.loads(self.bzz.get(r.hsh_room.encode("hex")))
-		crsr = 69
-		participantcount = len(roomparticipants['participants'])
-		datathreshold = 69 + (participantcount*3)
+		roomparticipants = r.get_state(r.hsh_room)
+		crsr = 32
+		participantcount = len(roomparticipants)
+		datathreshold = 32 + (participantcount*3)
 		for i in range(participantcount):
 			lenbytes = body[crsr:crsr+3]
 			offset = struct.unpack("<I", lenbytes + "\x00")[0]
 			self.assertEqual(offset, i*len(msg))
 			self.assertEqual(body[datathreshold+offset:datathreshold+offset+len(msg)], msg)
-			body = self.bzz.get(hsh)
-			ciphermsg = r.extract_message(body[37:], r.participants[nicks[i]])
+			ciphermsg = r.extract_message(body, r.participants[nicks[i]])
 			self.assertEqual(ciphermsg, msg)
 			crsr += 3
 
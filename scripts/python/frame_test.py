@@ -0,0 +1,88 @@
+#!/usr/bin/python2
+
+import unittest
+import socket
+import struct
+
+from pss.frame import FrameReader, FRAME_OP_TEXT, FRAME_OP_CONTINUATION, FRAME_OP_PING, FRAME_OP_CLOSE
+
+
+# create websocket frame
+def frame(payload, opcode=FRAME_OP_TEXT, fin=True, mask=None):
+	data = chr((0x80 if fin else 0) | opcode)
+	maskbit = 0x80 if mask != None else 0
+	if len(payload) < 126:
+		data += chr(maskbit | len(payload))
+	elif len(payload) < 0x10000:
+		data += chr(maskbit | 126) + struct.pack(">H", len(payload))
+	else:
+		data += chr(maskbit | 127) + struct.pack(">Q", len(payload))
+	if mask != None:
+		data += mask
+		payload = "".join([chr(ord(payload[i]) ^ ord(mask[i % 4])) for i in range(len(payload))])
+	return data + payload
+
+
+
+class TestFrameReader(unittest.TestCase):
+
+
+	def setUp(self):
+		self.reader = FrameReader(None, 16)
+
+
+	# frames split at any point are returned when complete
+	def test_feed(self):
+		data = frame('{"foo":"}{"}') + frame("x" * 300) + frame("bar", mask="\x01\x02\x03\x04")
+		msgs = []
+		for i in range(0, len(data), 7):
+			msgs += self.reader.feed(data[i:i+7])
+		self.assertEqual(msgs, ['{"foo":"}{"}', "x" * 300, "bar"])
+		self.assertEqual(self.reader.buffered(), 0)
+
+
+	def test_fragments(self):
+		data = frame("in", fin=False) + frame("", FRAME_OP_PING) + frame("ky", FRAME_OP_CONTINUATION)
+		self.assertEqual(self.reader.feed(data), ["inky"])
+		self.assertEqual(self.reader.control, [(FRAME_OP_PING, "")])
+		self.assertRaises(IOError, self.reader.feed, frame("ky", FRAME_OP_CONTINUATION))
+
+
+	def test_too_large(self):
+		self.reader.maxsize = 64
+		self.assertRaises(IOError, self.reader.feed, frame("x" * 100))
+
+
+	# all data available on socket is drained in one call
+	def test_read(self):
+		(a, b) = socket.socketpair()
+		self.reader.sock = b
+		payloads = [str(i) * (i * 1000) for i in range(1, 10)]
+		a.sendall("".join([frame(p) for p in payloads]))
+		self.assertEqual(self.reader.read(), payloads)
+		self.assertEqual(self.reader.read(), [])
+		a.sendall(frame("", FRAME_OP_CLOSE))
+		a.close()
+		self.reader.read()
+		self.assertTrue(self.reader.closed)
+		b.close()
+
+
+	# maximum size limits a single frame, not a burst of small frames
+	def test_read_burst(self):
+		(a, b) = socket.socketpair()
+		self.reader.sock = b
+		self.reader.maxsize = 64
+		payloads = [str(i) * 30 for i in range(10)]
+		a.sendall("".join([frame(p) for p in payloads]))
+		self.assertEqual(self.reader.read(), payloads)
+		self.assertTrue(len(self.reader.buf) <= 64)
+		a.sendall(frame("x" * 100))
+		self.assertRaises(IOError, self.reader.read)
+		a.close()
+		b.close()
+
+
+
+if __name__ == "__main__":
+	unittest.main()
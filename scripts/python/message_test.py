@@ -0,0 +1,23 @@
+#!/usr/bin/python2
+
+import unittest
+
+from pss.message import new_room_notice, parse_room_notice, is_room_notice
+
+
+class TestRoomNotice(unittest.TestCase):
+
+
+	def test_notice(self):
+		hsh = "\x2a" * 32
+		notice = new_room_notice("fooroom", hsh)
+		self.assertTrue(is_room_notice(notice))
+		self.assertFalse(is_room_notice("fooroom"))
+		self.assertEqual(parse_room_notice(notice), ("fooroom", hsh))
+		self.assertRaises(ValueError, parse_room_notice, notice[:-1])
+		self.assertRaises(ValueError, new_room_notice, "", hsh)
+
+
+
+if __name__ == "__main__":
+	unittest.main()
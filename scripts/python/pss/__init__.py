@@ -1,11 +1,14 @@
 from pss import Pss
 from user import PssContact, Account, publickey_to_address
 from content import Stream, rpc_parse
+from frame import FrameReader
 from tools import *
 from error import *
 from message import *
-from bzz import Feed, Bzz, new_topic_mask, zerohsh, chattopic, roomtopic
+from bzz import Feed, Bzz, ChunkCache, parse_update, new_topic_mask, zerohsh, chattopic, roomtopic
 from agent import *
 from room import Room
+from store import ChunkStore
+from schedule import Scheduler
 from cache import Cache
 
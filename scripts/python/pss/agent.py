@@ -2,6 +2,7 @@ import urllib2
 import copy
 import re
 import os
+import errno
 import select
 import sys
 import socket
@@ -9,10 +10,284 @@ import time
 
 REQUEST_TIMEOUT = 30.0
 
-regexStatusLine = re.compile("^HTTP/1.1 (\d{3}) (.+)\n", re.M)
+# default number of connections per gateway in AgentPool
+AGENT_POOL_SIZE = 4
+
+# maximum bytes to read from socket per read call
+AGENT_READ_SIZE = 65536
+
+# parser states
+PARSE_HEAD = 0
+PARSE_BODY = 1
+PARSE_CHUNK_SIZE = 2
+PARSE_CHUNK = 3
+PARSE_TRAILER = 4
+PARSE_UNTIL_CLOSE = 5
+
+regexStatusLine = re.compile("^HTTP/1\.[01] (\d{3}) ?([^\r\n]*)")
+
+
+
+## Exception for requests answered by the gateway with an error status
+class AgentHTTPError(IOError):
+
+	## \param status HTTP status code, numerical
+	# \param reason Error string
+	def __init__(self, status, reason):
+		super(AgentHTTPError, self).__init__(reason)
+		self.status = status
+
+
+
+## \brief Incremental HTTP/1.1 response parser
+#
+# Data is added with feed() as it arrives from the socket, in pieces of any size. Complete responses are taken out with next(), in the order they were received.
+#
+# The body length is determined by Content-Length or chunked Transfer-Encoding. If neither is present, the body lasts until the connection is closed, which must be signalled with eof().
+#
+# Bytes beyond a complete response are kept in the buffer for the next response. The body is copied out of the buffer only once when the response is complete.
+class ResponseParser:
+
+	def __init__(self):
+		self.buf = bytearray()
+		self.crsr = 0
+		self.closed = False
+		self._reset()
+
+
+	def _reset(self):
+		self.state = PARSE_HEAD
+		self.status = 0
+		self.reason = ""
+		self.headers = {}
+		self.remaining = 0
+		self.chunks = []
+
+
+	## Add received data
+	#
+	# \param data Bytes read from socket
+	def feed(self, data):
+		# drop consumed data when it makes up most of the buffer
+		if self.crsr > 0 and self.crsr >= len(self.buf) / 2:
+			del self.buf[:self.crsr]
+			self.crsr = 0
+		self.buf.extend(data)
+
+
+	## Signal that the connection has been closed by the peer
+	def eof(self):
+		self.closed = True
+
+
+	## Number of received bytes not yet consumed
+	def buffered(self):
+		return len(self.buf) - self.crsr
+
+
+	# find the end of the line starting at cursor
+	# returns tuple of line content without line ending and offset after line ending, or None if incomplete
+	def _line(self):
+		nl = self.buf.find("\n", self.crsr)
+		if nl == -1:
+			return None
+		end = nl
+		if end > self.crsr and self.buf[end-1] == 0x0d:
+			end -= 1
+		return (str(self.buf[self.crsr:end]), nl + 1)
+
+
+	def _parse_head(self):
+		# headers are small, so we wait for all of them before parsing
+		crsr = self.buf.find("\n\n", self.crsr)
+		crlf = self.buf.find("\n\r\n", self.crsr)
+		if crlf != -1 and (crsr == -1 or crlf < crsr):
+			end = crlf + 3
+		elif crsr != -1:
+			end = crsr + 2
+		else:
+			return False
+
+		lines = str(self.buf[self.crsr:end]).splitlines()
+		self.crsr = end
+
+		m = regexStatusLine.match(lines[0])
+		if m == None:
+			raise IOError("invalid HTTP status line: " + repr(lines[0][:64]))
+		self.status = int(m.group(1))
+		self.reason = m.group(2)
+
+		for l in lines[1:]:
+			if l == "":
+				continue
+			try:
+				(k, v) = l.split(":", 1)
+			except ValueError:
+				raise IOError("invalid HTTP header: " + repr(l[:64]))
+			self.headers[k.strip().lower()] = v.strip()
+
+		if (self.status >= 100 and self.status < 200) or self.status == 204 or self.status == 304:
+			self.state = PARSE_BODY
+			self.remaining = 0
+		elif "chunked" in self.headers.get("transfer-encoding", "").lower():
+			self.state = PARSE_CHUNK_SIZE
+		elif "content-length" in self.headers:
+			try:
+				self.remaining = int(self.headers["content-length"])
+			except ValueError:
+				raise IOError("invalid HTTP content length: " + repr(self.headers["content-length"]))
+			self.state = PARSE_BODY
+		else:
+			self.state = PARSE_UNTIL_CLOSE
+		return True
+
+
+	# returns True if a complete chunked body is parsed
+	def _parse_chunked(self):
+		while True:
+			if self.state == PARSE_CHUNK_SIZE:
+				l = self._line()
+				if l == None:
+					return False
+				try:
+					self.remaining = int(l[0].split(";", 1)[0].strip(), 16)
+				except ValueError:
+					raise IOError("invalid HTTP chunk size: " + repr(l[0][:64]))
+				self.crsr = l[1]
+				if self.remaining == 0:
+					self.state = PARSE_TRAILER
+				else:
+					self.state = PARSE_CHUNK
+
+			elif self.state == PARSE_CHUNK:
+				# chunk data is followed by a line ending, which must be complete before the chunk is consumed
+				end = self.crsr + self.remaining
+				if len(self.buf) <= end:
+					return False
+				nl = self.buf.find("\n", end)
+				if nl == -1:
+					return False
+				if nl - end > 1 or (nl > end and self.buf[end] != 0x0d):
+					raise IOError("invalid HTTP chunk end: " + repr(str(self.buf[end:nl+1])[:64]))
+				self.chunks.append(str(self.buf[self.crsr:end]))
+				self.crsr = nl + 1
+				self.state = PARSE_CHUNK_SIZE
+
+			elif self.state == PARSE_TRAILER:
+				l = self._line()
+				if l == None:
+					return False
+				self.crsr = l[1]
+				if l[0] == "":
+					return True
+
+
+	## Get next complete response
+	#
+	# \return Tuple; status code (numerical), headers (dict with lowercase keys), body. None if no complete response is available
+	# \exception IOError on malformed response
+	def next(self):
+		if self.state == PARSE_HEAD:
+			if not self._parse_head():
+				return None
+
+		body = None
+		if self.state == PARSE_BODY:
+			if self.buffered() < self.remaining:
+				return None
+			body = str(self.buf[self.crsr:self.crsr+self.remaining])
+			self.crsr += self.remaining
+
+		elif self.state == PARSE_UNTIL_CLOSE:
+			if not self.closed:
+				return None
+			body = str(self.buf[self.crsr:])
+			self.crsr = len(self.buf)
+
+		else:
+			if not self._parse_chunked():
+				return None
+			body = "".join(self.chunks)
+
+		r = (self.status, self.headers, body)
+		self._reset()
+		return r
+
+
+
+## \brief Handle for the response of a request issued through Agent
+#
+# Responses are resolved in the order the requests were written to the socket.
+#
+# If a callback is given, it is called with the response object as only argument when the response is complete
+class AgentResponse:
+
+	## \param callback Function to call on completion, or None
+	def __init__(self, callback=None):
+		self.callback = callback
+		# Agent the request was written to
+		self.agent = None
+		self.status = 0
+		self.body = None
+		self.err = None
+		self.done = False
+
+
+	## Complete the response with data
+	#
+	# \param status HTTP status code, numerical
+	# \param body Response body
+	def resolve(self, status, body):
+		self.status = status
+		self.body = body
+		self._complete()
+
+
+	## Complete the response with an error
+	#
+	# \param e Exception object describing the error
+	def fail(self, e):
+		self.err = e
+		self._complete()
+
+
+	def _complete(self):
+		self.done = True
+		if self.callback != None:
+			self.callback(self)
+
+
+	## Give up waiting for the response
+	#
+	# The connection the request was written to is marked down and its pending responses fail, including this one, as a late response would otherwise be taken for the response to the next request on it.
+	def expire(self):
+		if self.done:
+			return
+		if self.agent != None:
+			self.agent._expire()
+		if not self.done:
+			self.fail(IOError("HTTP response from swarm timed out"))
+
+
+	## Get response body
+	#
+	# \return Response body
+	# \exception RuntimeError if response is not yet complete
+	# \exception Exception the error the request failed with, if any
+	def result(self):
+		if not self.done:
+			raise RuntimeError("response pending")
+		if self.err != None:
+			raise self.err
+		return self.body
+
 
 
 ## \brief Agent handles HTTP requests and responses for swarm
+#
+# The socket is used in non-blocking mode. Requests can either be made blocking with get() and send(), or non-blocking with get_async() and send_async().
+#
+# For non-blocking requests the caller is responsible for calling process() when the socket is readable, for example from a weechat.hook_fd callback. Without an event loop poll() can be used instead.
 class Agent:
 
 	## Connects to swarm and sets up base request headers
@@ -26,11 +301,19 @@ class Agent:
 			self._sock = socket.create_connection((host,port))
 			sock = self._sock.fileno()
 		s = socket.fromfd(sock, socket.AF_INET, socket.SOCK_STREAM)
-		s.setblocking(1)
+		s.setblocking(0)
 		self.sock = sock	
 		self.host = host
 		self.port = str(port)
-		self.up = False
+		self.up = True
+		self.closed = False
+
+		# set if connection was taken down because a response timed out
+		self.timedout = False
+
+		# responses still to be read, in order of request
+		self.pending = []
+		self.parser = ResponseParser()
 
 		self.debugfile = open("debugsock.log", "a", 0500)
 
@@ -48,69 +331,202 @@ class Agent:
 		return req
 
 
-	# \todo add retries on select
-	def _write(self, requeststring):
+	## File descriptor of the underlying socket
+	#
+	# Makes the agent usable directly with select.select
+	#
+	# \return file descriptor, numerical
+	def fileno(self):
+		return self.sock
+
+
+	## Number of requests awaiting response
+	def pending_count(self):
+		return len(self.pending)
+
+
+	## Check if connection is still usable
+	#
+	# An idle keep-alive connection that is readable has either been closed by the gateway, or has sent data nobody asked for. Both cases render the connection unusable.
+	#
+	# \return True if connection is up
+	def is_alive(self):
+		if not self.up:
+			return False
+		if len(self.pending) > 0:
+			return True
+		try:
+			(r, _, _) = select.select([self.sock], [], [], 0)
+		except select.error as e:
+			return False
+		if len(r) > 0:
+			self.process()
+			if self.parser.buffered() > 0:
+				self.up = False
+		return self.up
+
+
+	## Open a new connection to the gateway
+	#
+	# The new connection reuses the file descriptor number of the old one, so hooks registered on fileno() remain valid.
+	#
+	# Pending requests on the old connection fail.
+	def reconnect(self):
+		self._fail_pending(IOError("agent reconnecting"))
+		s = socket.create_connection((self.host, self.port))
+		os.dup2(s.fileno(), self.sock)
+		s.close()
+		s = socket.fromfd(self.sock, socket.AF_INET, socket.SOCK_STREAM)
+		s.setblocking(0)
+		self.parser = ResponseParser()
+		self.up = True
+		self.timedout = False
+
+
+	# write request and register the pending response
+	# a connection that is down is reconnected first, as it may still deliver responses to earlier requests
+	def _write(self, requeststring, callback=None):
+		if self.closed:
+			raise IOError("agent closed")
+		if not self.up:
+			try:
+				self.reconnect()
+			except socket.error as e:
+				raise IOError("gateway reconnect failed: " + repr(e))
 		self.debugfile.write("[" + str(id(self)) + "] request: " + repr(requeststring) + "\n")
 		self.debugfile.flush()
-		select.select([], [self.sock], [], REQUEST_TIMEOUT)
+		resp = AgentResponse(callback)
+		resp.agent = self
+		self.pending.append(resp)
+		crsr = 0
 		towrite = len(requeststring)
-		while towrite > 0:
-			written = os.write(self.sock, requeststring)
-			towrite -= written
-		# \todo sleep interrupts on select fail signals, need better mechanism for waits (while waiting for external process for handling the io)
-		for i in range(100):
-			time.sleep(1)
+		while crsr < towrite:
 			try:
-				select.select([self.sock], [], [], REQUEST_TIMEOUT)
-				#sys.stderr.write("success\n")
-				break
+				select.select([], [self.sock], [], REQUEST_TIMEOUT)
+				crsr += os.write(self.sock, requeststring[crsr:])
+			except (OSError, select.error) as e:
+				if e[0] in [errno.EAGAIN, errno.EINTR]:
+					continue
+				self.pending.remove(resp)
+				self.up = False
+				raise IOError("HTTP write to swarm failed: " + repr(e))
+		return resp
+
+
+	## Read and dispatch available responses
+	#
+	# Should be called whenever the socket is readable. Does not block.
+	#
+	# \return Number of responses completed
+	def process(self):
+		while True:
+			try:
+				r = os.read(self.sock, AGENT_READ_SIZE)
 			except OSError as e:
-				#sys.stderr.write("oserror: " + repr(e) + "\n")
-				if e[0] != 11:
+				if e[0] == errno.EINTR:
+					continue
+				elif e[0] == errno.EAGAIN:
 					break
-			except Exception as e:
-				#sys.stderr.write("othererror: " + repr(e) + "\n")
-				if e[0] != 4:
-					break
-		r = os.read(self.sock, 4104)
-		self.debugfile.write("[" + str(id(self)) + "] response: " + repr(r) + "\n")
-		m = regexStatusLine.match(r)
-		if m.group(1) != "200":
-			print r
-			raise Exception("HTTP send to swarm failed: " + str(m.group(0)))
-
-		body = ""
+				self._fail_pending(IOError("HTTP read from swarm failed: " + repr(e)))
+				return 0
+
+			if r == "":
+				self.parser.eof()
+				break
+
+			self.debugfile.write("[" + str(id(self)) + "] response: " + repr(r) + "\n")
+			self.parser.feed(r)
+			if len(r) < AGENT_READ_SIZE:
+				break
+
+		n = 0
+		while len(self.pending) > 0:
+			try:
+				r = self.parser.next()
+			except IOError as e:
+				# stream is out of sync, so no later response can be trusted either
+				self._fail_pending(e)
+				break
+			if r == None:
+				break
+			(status, _, body) = r
+			if status >= 100 and status < 200:
+				continue
+			resp = self.pending.pop(0)
+			if status != 200:
+				resp.fail(AgentHTTPError(status, "HTTP send to swarm failed: " + str(status) + " " + repr(body[:128])))
+			else:
+				resp.resolve(status, body)
+			n += 1
+
+		if self.parser.closed:
+			self.up = False
+			self._fail_pending(IOError("swarm closed connection"))
+
+		return n
+
+
+	def _fail_pending(self, e):
+		pending = self.pending
+		self.pending = []
+		for resp in pending:
+			resp.fail(e)
+
+
+	# fail pending requests that timed out
+	# a late response would be taken as the response to the next request, so the connection is marked down and must be reconnected before reuse
+	def _expire(self):
+		self.up = False
+		self.timedout = True
+		self.parser = ResponseParser()
+		self._fail_pending(IOError("HTTP response from swarm timed out"))
+
+
+	## Wait for socket activity and process responses
+	#
+	# Use in place of an event loop
+	#
+	# \param timeout Seconds to wait for data, 0 returns immediately
+	# \return Number of responses completed
+	def poll(self, timeout=0):
 		try:
-			(_, body) = r.split("\x0a\x0a")
-		except:
-			(_, body)  = r.split("\x0d\x0a\x0d\x0a")
-		return body
+			(r, _, _) = select.select([self.sock], [], [], timeout)
+		except select.error as e:
+			if e[0] == errno.EINTR:
+				return 0
+			raise
+		if len(r) == 0:
+			return 0
+		return self.process()
 
 
-	## performs a HTTP GET to swarm
+	## Block until response is complete
 	#
-	# \param path the path to GET
-	# \param querystring query string to add
-	# \return response body
-	def get(self, path, querystring=""):
+	# \param resp AgentResponse to wait for
+	# \param timeout Maximum seconds to wait between socket reads
+	# \return Response body
+	# \exception IOError on timeout
+	def wait(self, resp, timeout=REQUEST_TIMEOUT):
+		deadline = time.time() + timeout
+		while not resp.done:
+			if self.poll(max(deadline - time.time(), 0)) > 0:
+				deadline = time.time() + timeout
+			elif time.time() >= deadline:
+				self._expire()
+		return resp.result()
+
+
+	def _get_request(self, path, querystring):
 		req = self.new_request()
 		requeststring = path
 		if querystring != "":
 			requeststring += "?" + querystring
 		requeststring = req.get_method() + " " + requeststring
 		requeststring += " HTTP/1.1\nHost: " + req.get_host() + "\n\n"
-		return self._write(requeststring)
-
+		return requeststring
 
-	## performs a HTTP POST to Swarm
-	#
-	# \param path the path to POST
-	# \param data data payload
-	# \param querystring query string to add
-	# \return response body
-	# \todo check if we use querystring here
-	def send(self, path, data, querystring=""):
 
+	def _send_request(self, path, data, querystring):
 		req = self.new_request()
 		req.add_header("Content-length", str(len(data)))
 		req.add_data(data)
@@ -124,10 +540,314 @@ class Agent:
 		for (k, v) in req.header_items():
 			requeststring += k + ": " + v + "\n"
 		requeststring += "\n" + req.get_data()
-		return self._write(requeststring)
+		return requeststring
+
+
+	## performs a HTTP GET to swarm
+	#
+	# \param path the path to GET
+	# \param querystring query string to add
+	# \return response body
+	def get(self, path, querystring=""):
+		return self.wait(self.get_async(path, querystring))
+
+
+	## performs a non-blocking HTTP GET to swarm
+	#
+	# \param path the path to GET
+	# \param querystring query string to add
+	# \param callback Function to call with AgentResponse on completion
+	# \return AgentResponse
+	def get_async(self, path, querystring="", callback=None):
+		return self._write(self._get_request(path, querystring), callback)
+
+
+	## performs pipelined HTTP GETs to swarm
+	#
+	# All requests are written to the connection before any response is read. Responses are matched to requests by order.
+	#
+	# \param paths List of paths to GET
+	# \param timeout Maximum seconds to wait between socket reads
+	# \return List of completed AgentResponse objects, in the same order as paths
+	def get_many(self, paths, timeout=REQUEST_TIMEOUT):
+		resps = []
+		for p in paths:
+			resps.append(self.get_async(p))
+		for r in resps:
+			try:
+				self.wait(r, timeout)
+			except Exception as e:
+				pass
+		return resps
+
+
+	## performs a HTTP POST to Swarm
+	#
+	# \param path the path to POST
+	# \param data data payload
+	# \param querystring query string to add
+	# \return response body
+	# \todo check if we use querystring here
+	def send(self, path, data, querystring=""):
+		return self.wait(self.send_async(path, data, querystring))
+
+
+	## performs a non-blocking HTTP POST to Swarm
+	#
+	# \param path the path to POST
+	# \param data data payload
+	# \param querystring query string to add
+	# \param callback Function to call with AgentResponse on completion
+	# \return AgentResponse
+	def send_async(self, path, data, querystring="", callback=None):
+		return self._write(self._send_request(path, data, querystring), callback)
 
 
 	## close the TCP socket connection to Swarm
-	def close():
-		self._sock.close()
+	def close(self):
+		self.up = False
+		self.closed = True
+		self._fail_pending(IOError("agent closed"))
+		try:
+			self._sock.close()
+		except AttributeError:
+			os.close(self.sock)
 		self.debugfile.close()	
+
+
+
+## \brief Pool of persistent keep-alive connections to a single swarm gateway
+#
+# AgentPool provides the same request interface as Agent, and can be used in its place by Bzz. Each request checks out a connection from the pool and checks it back in when the response is complete, so non-blocking requests run in parallel on separate connections.
+#
+# Idle connections are health checked on checkout, and reconnected if the gateway has closed them. When all connections are busy, requests are pipelined on the least busy one.
+#
+# For non-blocking requests, process() must be called when any of the file descriptors returned by fds() is readable. Connections opened after setup are announced through the onconnect callback, so their file descriptors can be watched too.
+class AgentPool:
+
+	## \param host swarm host
+	# \param port swarm port
+	# \param size Maximum number of connections
+	# \param agent Agent object with already established connection to add to the pool
+	# \param onconnect Function to call with file descriptor of each new connection opened by the pool
+	def __init__(self, host="127.0.0.1", port=8500, size=AGENT_POOL_SIZE, agent=None, onconnect=None):
+		self.host = host
+		self.port = str(port)
+		self.size = size
+		self.agents = []
+		self.idle = []
+		self.onconnect = onconnect
+		if agent != None:
+			self.agents.append(agent)
+			self.idle.append(agent)
+
+
+	## Key identifying the gateway of the pool
+	#
+	# \return host:port string
+	def get_key(self):
+		return self.host + ":" + self.port
+
+
+	## Open all connections in the pool
+	#
+	# Connections are otherwise opened on demand. Opening them up front makes the set of file descriptors known in advance
+	def connect(self):
+		while len(self.agents) < self.size:
+			self.idle.append(self._open())
+
+
+	# open new connection and add it to the pool
+	def _open(self):
+		agent = Agent(self.host, self.port)
+		self.agents.append(agent)
+		if self.onconnect != None:
+			self.onconnect(agent.fileno())
+		return agent
+
+
+	## File descriptors of all connections in the pool
+	#
+	# \return List of file descriptors, numerical
+	def fds(self):
+		return [a.fileno() for a in self.agents]
+
+
+	## Take a connection out of the pool
+	#
+	# \return Agent object
+	def checkout(self):
+		while len(self.idle) > 0:
+			agent = self.idle.pop()
+			if agent.pending_count() > 0:
+				continue
+			if not agent.is_alive():
+				try:
+					agent.reconnect()
+				except socket.error as e:
+					sys.stderr.write("gateway reconnect fail: " + repr(e) + "\n")
+					continue
+			return agent
+
+		if len(self.agents) < self.size:
+			try:
+				return self._open()
+			except socket.error as e:
+				sys.stderr.write("gateway connect fail: " + repr(e) + "\n")
+				if len(self.agents) == 0:
+					raise IOError("gateway connect failed: " + repr(e))
+
+		agent = min(self.agents, key=lambda a: a.pending_count())
+		if not agent.up:
+			agent.reconnect()
+		return agent
+
+
+	## Return a connection to the pool
+	#
+	# \param agent Agent object previously returned from checkout()
+	def checkin(self, agent):
+		if agent.pending_count() == 0 and not agent in self.idle:
+			self.idle.append(agent)
+
+
+	# run blocking request
+	# if retry is set and the gateway dropped the connection, the request is retried once on a fresh connection
+	# requests that timed out are not retried, as the gateway may still be working on them
+	def _call(self, fn, retry, *args):
+		agent = self.checkout()
+		try:
+			try:
+				return fn(agent, *args)
+			except IOError as e:
+				if agent.up or agent.timedout or not retry:
+					raise
+			agent.reconnect()
+			return fn(agent, *args)
+		finally:
+			self.checkin(agent)
+
+
+	# run non-blocking request, checking in connection on completion
+	def _call_async(self, fn, callback, *args):
+		agent = self.checkout()
+		def done(resp):
+			self.checkin(agent)
+			if callback != None:
+				callback(resp)
+		try:
+			return fn(agent, *(args + (done,)))
+		except IOError as e:
+			agent.up = False
+			raise
+
+
+	## performs a HTTP GET to swarm
+	#
+	# \see Agent.get
+	def get(self, path, querystring=""):
+		return self._call(Agent.get, True, path, querystring)
+
+
+	## performs a non-blocking HTTP GET to swarm
+	#
+	# \see Agent.get_async
+	def get_async(self, path, querystring="", callback=None):
+		return self._call_async(Agent.get_async, callback, path, querystring)
+
+
+	## performs pipelined HTTP GETs to swarm on a single connection
+	#
+	# If the connection is dropped by the gateway, the requests that did not complete are retried once on a fresh connection. Requests are not retried after a timeout
+	#
+	# \see Agent.get_many
+	def get_many(self, paths, timeout=REQUEST_TIMEOUT):
+		agent = self.checkout()
+		try:
+			resps = agent.get_many(paths, timeout)
+			if agent.up or agent.timedout:
+				return resps
+			agent.reconnect()
+			retry = []
+			for i in range(len(resps)):
+				if resps[i].err != None:
+					retry.append(i)
+			retryresps = agent.get_many([paths[i] for i in retry], timeout)
+			for i in range(len(retry)):
+				resps[retry[i]] = retryresps[i]
+			return resps
+		finally:
+			self.checkin(agent)
+
+
+	## performs a HTTP POST to swarm
+	#
+	# The request is not retried if the connection fails, as the gateway may already have accepted it
+	#
+	# \see Agent.send
+	def send(self, path, data, querystring=""):
+		return self._call(Agent.send, False, path, data, querystring)
+
+
+	## performs a non-blocking HTTP POST to swarm
+	#
+	# \see Agent.send_async
+	def send_async(self, path, data, querystring="", callback=None):
+		return self._call_async(Agent.send_async, callback, path, data, querystring)
+
+
+	## Read and dispatch available responses
+	#
+	# \param fd If set, only process the connection with this file descriptor
+	# \return Number of responses completed
+	def process(self, fd=None):
+		n = 0
+		for agent in self.agents:
+			if fd == None or agent.fileno() == fd:
+				n += agent.process()
+		return n
+
+
+	## Number of requests awaiting response
+	def pending_count(self):
+		return sum([a.pending_count() for a in self.agents])
+
+
+	## Wait for socket activity on any connection and process responses
+	#
+	# \see Agent.poll
+	def poll(self, timeout=0):
+		busy = [a for a in self.agents if a.pending_count() > 0]
+		if len(busy) == 0:
+			return 0
+		try:
+			(r, _, _) = select.select(busy, [], [], timeout)
+		except select.error as e:
+			if e[0] == errno.EINTR:
+				return 0
+			raise
+		n = 0
+		for agent in r:
+			n += agent.process()
+		return n
+
+
+	## Block until response is complete
+	#
+	# \see Agent.wait
+	def wait(self, resp, timeout=REQUEST_TIMEOUT):
+		deadline = time.time() + timeout
+		while not resp.done:
+			if self.poll(max(deadline - time.time(), 0)) > 0:
+				deadline = time.time() + timeout
+			elif time.time() >= deadline:
+				resp.expire()
+		return resp.result()
+
+
+	## Close all connections
+	def close(self):
+		for agent in self.agents:
+			agent.close()
+		self.agents = []
+		self.idle = []
@@ -2,12 +2,16 @@ import struct
 import json
 import sys
 import copy
+import collections
+import heapq
+import time
 
 from Crypto.Hash import keccak
 from urllib import urlencode
 
 from tools import now_int
 from message import Message
+from agent import REQUEST_TIMEOUT, AgentHTTPError
 
 
 # this is not used for swarm feeds for the time being
@@ -20,9 +24,52 @@ zerohsh = ""
 for i in range(32):
 	zerohsh += "\x00"
 
-# the last topic byte is used as bitflag to allow to determine context from the topic
-chattopic = new_topic_mask(zerohsh, "", "\x01")
-roomtopic = new_topic_mask(zerohsh, "", "\x02")
+# default maximum bytes held by in-memory chunk cache
+BZZ_CACHE_SIZE = 8 * 1024 * 1024
+
+# highest epoch level of swarm feeds lookup algorithm
+FEED_HIGHEST_LEVEL = 25
+
+# default maximum number of feeds retrieved in parallel by FeedCollection.gethead
+FEED_CONCURRENCY = 8
+
+# default seconds a single request of a feed retrieval in FeedCollection.gethead may take
+FEED_TIMEOUT = 30.0
+
+# default maximum number of requests issued by one FeedCollection.gethead call, 0 for no limit
+FEED_HOPS = 0
+
+# default maximum seconds one FeedCollection.gethead call may take, 0 for no limit
+FEED_BUDGET = 0
+
+# bit in update serial sequence byte marking an update header extension
+FEED_SERIAL_EXTENDED = 0x80
+
+# version of skip list update header extension
+FEED_SKIPLIST_VERSION = 1
+
+# maximum number of skip pointers in an update
+FEED_SKIPLIST_LEVELS = 16
+
+# write skip list header extension by default
+# off, as clients without extension support show the extension bytes as part of the message
+FEED_SKIPLIST = False
+
+# default maximum number of updates per feed retrieved by FeedCollection.gethead when catching up, 0 for no limit
+# updates beyond the limit are only retrieved if the caller pages them in with FeedCollection.page
+FEED_BACKLOG = 0
+
+# seconds to wait before first retry of a broken feed link, doubled on every failed retry
+FEED_REPAIR_DELAY = 10.0
+
+# number of retries of a broken feed link before giving up
+FEED_REPAIR_RETRIES = 8
+
+# default maximum number of requests issued by one FeedCollection.repair call, 0 for no limit
+FEED_REPAIR_HOPS = 16
+
+# default maximum number of messages held in FeedCollection retrieval buffer
+FEED_BUFFER_SIZE = 4096
 
 ## Exception to specify error in swarm content retrieval
 class BzzRetrieveError(Exception):
@@ -36,14 +83,96 @@ class BzzRetrieveError(Exception):
 	pass
 
 
+## \brief In-memory cache of swarm chunks
+#
+# Swarm content is immutable by hash, so cached data never needs to be invalidated. The least recently used chunks are evicted when the total size of cached data exceeds the capacity.
+class ChunkCache:
+
+	## \param capacity Maximum bytes of chunk data to hold
+	def __init__(self, capacity=BZZ_CACHE_SIZE):
+		self.capacity = capacity
+		self.size = 0
+		self.chunks = collections.OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+
+	## Get cached chunk
+	#
+	# \param hsh Swarm hash, hex format
+	# \return Chunk data, or None if not cached
+	def get(self, hsh):
+		data = self.chunks.pop(hsh, None)
+		if data == None:
+			self.misses += 1
+			return None
+		self.chunks[hsh] = data
+		self.hits += 1
+		return data
+
+
+	## Add chunk to cache
+	#
+	# Chunks larger than the capacity are not cached
+	#
+	# \param hsh Swarm hash, hex format
+	# \param data Chunk data
+	def put(self, hsh, data):
+		if len(data) > self.capacity:
+			return
+		old = self.chunks.pop(hsh, None)
+		if old != None:
+			self.size -= len(old)
+		self.chunks[hsh] = data
+		self.size += len(data)
+		while self.size > self.capacity:
+			(_, evicted) = self.chunks.popitem(False)
+			self.size -= len(evicted)
+			self.evictions += 1
+
+
+	## Cache counters
+	#
+	# \return dict with hits, misses, evictions, number of chunks and bytes held
+	def stats(self):
+		return {
+			"hits": self.hits,
+			"misses": self.misses,
+			"evictions": self.evictions,
+			"chunks": len(self.chunks),
+			"size": self.size,
+		}
+
+
+
 ## \brief Swarm context for HTTP
 #
 # Bzz is a convenience wrapper for making swarm store and retrieve calls over http
+#
+# Retrieved and stored chunks are kept in a ChunkCache, and repeated retrievals of the same hash are served from it
+#
+# If a ChunkStore is given, it is consulted after the cache and before the network, and all retrieved and stored chunks are written to it
+#
+# Concurrent non-blocking requests for the same chunk or feed head share one request to the gateway, and all callers get its result
 class Bzz():
 
 
-	def __init__(self, httpagent):
+	## \param httpagent Agent or AgentPool object to make requests with
+	# \param cache ChunkCache object. If None a new cache with default capacity is created
+	# \param store ChunkStore object for persistent storage of chunks, optional
+	def __init__(self, httpagent, cache=None, store=None):
 		self.agent = httpagent
+		if cache == None:
+			cache = ChunkCache()
+		self.cache = cache
+		self.store = store
+
+		# requests in progress, path and query => list of callbacks waiting for result, deadline, and response handle from agent
+		self.inflight = {}
+
+		# seconds a request in progress may take before it is failed
+		self.timeout = REQUEST_TIMEOUT
 
 
 	## Create new raw data chunk
@@ -51,7 +180,29 @@ class Bzz():
 	# \param data binary data to post
 	# \return Swarm chunk hash, binary format
 	def add(self, data):
-		return self.agent.send("/bzz-raw:/", data)
+		hsh = self.agent.send("/bzz-raw:/", data)
+		self._keep(hsh, data)
+		return hsh
+
+
+	# put retrieved or stored chunk in cache and store
+	def _keep(self, hsh, data):
+		self.cache.put(hsh, data)
+		if self.store != None:
+			try:
+				self.store.put(hsh, data)
+			except Exception as e:
+				sys.stderr.write("chunk store fail: " + repr(e) + "\n")
+
+
+	# get chunk from cache or store
+	def _lookup(self, hsh):
+		data = self.cache.get(hsh)
+		if data == None and self.store != None:
+			data = self.store.get(hsh)
+			if data != None:
+				self.cache.put(hsh, data)
+		return data
 
 
 	## Retrieve raw data chunk
@@ -59,7 +210,186 @@ class Bzz():
 	# \param hsh Swarm hash to retrieve, binary format
 	# \return Raw response data
 	def get(self, hsh):
-		return self.agent.get("/bzz-raw:/" + hsh + "/")
+		data = self._lookup(hsh)
+		if data != None:
+			return data
+
+		# use result of non-blocking request if one is in progress
+		path = "/bzz-raw:/" + hsh + "/"
+		if self._inflight(path, ""):
+			return self._wait(path)
+
+		data = self.agent.get(path)
+		if data != "":
+			self._keep(hsh, data)
+		return data
+
+
+	## Retrieve raw data chunk without blocking
+	#
+	# If the chunk is cached, the callback is called before returning
+	#
+	# \param hsh Swarm hash to retrieve, hex format
+	# \param callback Function to call on completion with data and error; data is None on error
+	def get_async(self, hsh, callback):
+		data = self._lookup(hsh)
+		if data != None:
+			callback(data, None)
+			return
+
+		path = "/bzz-raw:/" + hsh + "/"
+		entry = self._join(path, "", callback)
+		if entry == None:
+			return
+
+		def done(resp):
+			if resp.err != None:
+				self._resolve(path, "", None, resp.err, entry)
+				return
+			if resp.body != "":
+				self._keep(hsh, resp.body)
+			self._resolve(path, "", resp.body, None, entry)
+
+		try:
+			entry[2] = self.agent.get_async(path, "", done)
+		except IOError as e:
+			self._resolve(path, "", None, e, entry)
+
+
+	# check if request for path and query is in progress
+	def _inflight(self, path, querystring):
+		self.expire()
+		return path + "?" + querystring in self.inflight
+
+
+	# add callback to request in progress for path and query, or register new request if there is none
+	# a request in progress past its deadline is failed first
+	# returns entry of new request, which the caller must issue, or None if request is already in progress
+	def _join(self, path, querystring, callback):
+		k = path + "?" + querystring
+		entry = self.inflight.get(k)
+		if entry != None and entry[1] <= time.time():
+			self._fail(k, entry, IOError("request timed out"))
+			entry = None
+		if entry != None:
+			entry[0].append(callback)
+			return None
+		entry = [[callback], time.time() + self.timeout, None]
+		self.inflight[k] = entry
+		return entry
+
+
+	# complete request in progress, passing result to all callbacks
+	# does nothing if the request has already been failed
+	def _resolve(self, path, querystring, data, err, entry):
+		k = path + "?" + querystring
+		if self.inflight.get(k) is entry:
+			del self.inflight[k]
+		callbacks = entry[0]
+		entry[0] = []
+		for callback in callbacks:
+			callback(data, err)
+
+
+	# give up request in progress, failing all callbacks
+	# the request is expired on the agent too, so the connection is not left waiting for a response that may never come
+	def _fail(self, k, entry, err):
+		if self.inflight.get(k) is entry:
+			del self.inflight[k]
+		callbacks = entry[0]
+		entry[0] = []
+		if entry[2] != None:
+			entry[2].expire()
+		for callback in callbacks:
+			callback(None, err)
+
+
+	## Fail requests in progress that have passed their deadline
+	#
+	# \param now Time to check against, current time if None
+	def expire(self, now=None):
+		if now == None:
+			now = time.time()
+		for (k, entry) in self.inflight.items():
+			if entry[1] <= now:
+				self._fail(k, entry, IOError("request timed out"))
+
+
+	## Stop waiting for requests in progress
+	#
+	# The callback is removed from all requests in progress. Requests left with no callbacks are given up.
+	#
+	# \param callback Callback passed with request
+	def abandon(self, callback):
+		for (k, entry) in self.inflight.items():
+			if callback in entry[0]:
+				entry[0].remove(callback)
+				if len(entry[0]) == 0:
+					self._fail(k, entry, IOError("request abandoned"))
+
+
+	# block until request in progress completes
+	def _wait(self, path, querystring="", timeout=REQUEST_TIMEOUT):
+		result = []
+		def done(data, err):
+			result.append((data, err))
+		if self._join(path, querystring, done) != None:
+			del self.inflight[path + "?" + querystring]
+			raise IOError("no request in progress")
+
+		deadline = time.time() + timeout
+		while len(result) == 0:
+			if time.time() > deadline:
+				self.abandon(done)
+				raise IOError("request timed out")
+			self.poll(min(deadline - time.time(), 1.0))
+
+		(data, err) = result[0]
+		if err != None:
+			raise err
+		return data
+
+
+	## Wait for and process responses to non-blocking requests
+	#
+	# Requests in progress that have passed their deadline are failed
+	#
+	# \param timeout Seconds to wait for data
+	# \return Number of responses completed
+	def poll(self, timeout=0):
+		n = self.agent.poll(timeout)
+		self.expire()
+		return n
+
+
+	## Retrieve several raw data chunks
+	#
+	# The requests for chunks not in cache are pipelined on a single connection
+	#
+	# \param hshs List of swarm hashes to retrieve, hex format
+	# \return List of raw response data in same order as hshs. Failed retrievals are None
+	def get_many(self, hshs):
+		bodies = []
+		missing = []
+		for hsh in hshs:
+			data = self._lookup(hsh)
+			if data == None:
+				missing.append(len(bodies))
+			bodies.append(data)
+
+		if len(missing) == 0:
+			return bodies
+
+		resps = self.agent.get_many(["/bzz-raw:/" + hshs[i] + "/" for i in missing])
+		for i in range(len(missing)):
+			r = resps[i]
+			if r.err != None:
+				sys.stderr.write("retrieve fail: " + repr(r.err) + "\n")
+				continue
+			bodies[missing[i]] = r.body
+			if r.body != "":
+				self._keep(hshs[missing[i]], r.body)
+		return bodies
 
 
 	## \brief close connection
@@ -84,17 +414,17 @@ class Feed():
 
 	## \param bzz Swarm transport object
 	# \param account Account object containing key to use for Feed (must have private key for write access)
-	# \param name Human name of feed, XORed with high-order bits of base topic to create feed topic, up to 31 bytes
+	# \param name Human name of feed, XORed with high-order bits of base topic to create feed topic, up to 32 bytes
 	def __init__(self, bzz, account, name):
 		self.tim = 0
-		self.lastepoch = 25
+		self.lastepoch = FEED_HIGHEST_LEVEL
 		self.lastupdate = 0
 		self.topic = ""
 
 		self.account = account
 		self.bzz = bzz
-		if len(name) > 31 or len(name) == 0:
-			raise ValueError("invalid name length 0 < n <= 31")
+		if len(name) > 32 or len(name) == 0:
+			raise ValueError("invalid name length 0 < n <= 32")
 
 		self.topic = new_topic_mask(feedRootTopic, name, "")
 
@@ -104,7 +434,7 @@ class Feed():
 	# retrieve epoch and time next update belongs to from swarm node
 	#
 	# \return Tuple; (time, level), numerical
-	# \todo client side should calculate this after initial state gotten from feed
+	# \see epoch_next
 	def info(self):
 		q = {
 			'user': '0x' + self.account.address.encode("hex"),
@@ -125,11 +455,29 @@ class Feed():
 
 	## Add new update to feed
 	#
+	# The epoch of the first update is retrieved from the swarm node. The epochs of subsequent updates are calculated locally from the previous one. If an update with a calculated epoch is rejected by the node, it is retried once with the epoch retrieved from the node.
+	#
+	# Other failures, such as timeouts and dropped connections, are not retried, as the node may have accepted the update.
+	#
 	# \param data raw byte data to post as update
 	# \return (unsure)
+	# \exception IOError if the update fails
 	# \todo find out what this returns
 	def update(self, data):
+		if self.lastupdate == 0:
+			(tim, epoch) = self.info()
+			return self._post(data, tim, epoch)
+
+		(tim, epoch) = epoch_next(self.lastupdate, self.lastepoch, now_int())
+		try:
+			return self._post(data, tim, epoch)
+		except AgentHTTPError as e:
+			sys.stderr.write("feed update with calculated epoch " + str(tim) + "/" + str(epoch) + " failed, resyncing: " + repr(e) + "\n")
 		(tim, epoch) = self.info()
+		return self._post(data, tim, epoch)
+
+
+	def _post(self, data, tim, epoch):
 		d = compile_digest(self.topic, self.account.address, data, int(tim), int(epoch))
 		s = sign_digest(self.account.privatekey, d)
 		q = {
@@ -143,8 +491,8 @@ class Feed():
 		sendpath = "/bzz-feed:/"
 		r = self.bzz.agent.send(sendpath, data, querystring)
 	
-		self.lastupdate = tim
-		self.epoch = epoch
+		self.lastupdate = int(tim)
+		self.lastepoch = int(epoch)
 
 		return r
 
@@ -153,13 +501,35 @@ class Feed():
 	#
 	# \return Update content, binary format
 	def head(self):
+		q = self._head_query()
+		if self.bzz._inflight("/bzz-feed:/", q):
+			return self.bzz._wait("/bzz-feed:/", q)
+		return self.bzz.agent.get("/bzz-feed:/", q)
+
+
+	## Get latest feed update without blocking
+	#
+	# \param callback Function to call on completion with update content and error; content is None on error
+	def head_async(self, callback):
+		q = self._head_query()
+		entry = self.bzz._join("/bzz-feed:/", q, callback)
+		if entry == None:
+			return
+
+		def done(resp):
+			self.bzz._resolve("/bzz-feed:/", q, resp.body, resp.err, entry)
+		try:
+			entry[2] = self.bzz.agent.get_async("/bzz-feed:/", q, done)
+		except IOError as e:
+			self.bzz._resolve("/bzz-feed:/", q, None, e, entry)
+
+
+	def _head_query(self):
 		q = {
 			'user': '0x' + self.account.address.encode("hex"),
 			'topic': '0x' + self.topic.encode("hex"),
 		}
-		querystring = urlencode(q)
-		sendpath = "/bzz-feed:/"
-		return self.bzz.agent.get(sendpath, querystring)
+		return urlencode(q)
 		
 
 
@@ -176,30 +546,160 @@ class FeedState:
 	def __init__(self, feed):
 		self.obj = feed
 		self.headhsh = ""
+		self.curhsh = ""
 		self.lasthsh = zerohsh
 		self.lasttime = 0
 		self.lastseq = 0
 		self.orphans = {}
 		self.active = True
 
+		# retries of orphans, orphan hash => tuple of hash to retrieve next, last retrieved hash, attempts and time of next attempt
+		self.repairs = {}
+
+		# skip list state of sender; height of last update and hash of last update at height divisible by 2^k
+		self.height = 0
+		self.skips = {}
+
+		# skip list state of reader; height of head being retrieved and of last retrieved head
+		# ranges skipped when catching up are kept in gaps, topmost hash => tuple of height and last retrieved hash
+		self.headheight = 0
+		self.lastheight = 0
+		self.gaps = {}
+
+
+	## \brief Get retrieval and write position for persistence
+	#
+	# Does not include position of a retrieval in progress, which will be redone on restore
+	#
+	# \return dict of json serializable values
+	def get_checkpoint(self):
+		return {
+			"lasthsh": self.lasthsh.encode("hex"),
+			"lastheight": self.lastheight,
+			"lasttime": self.lasttime,
+			"lastseq": self.lastseq,
+			"height": self.height,
+			"skips": dict([(str(k), v.encode("hex")) for (k, v) in self.skips.iteritems()]),
+			"orphans": dict([(k.encode("hex"), v.encode("hex")) for (k, v) in self.orphans.iteritems()]),
+			"repairs": dict([(k.encode("hex"), [v[0].encode("hex"), v[1].encode("hex"), v[2], v[3]]) for (k, v) in self.repairs.iteritems()]),
+			"gaps": dict([(k.encode("hex"), [v[0], v[1].encode("hex")]) for (k, v) in self.gaps.iteritems()]),
+		}
+
+
+	## \brief Restore retrieval and write position
+	#
+	# \param checkpoint dict as returned by get_checkpoint
+	# \exception ValueError if checkpoint is invalid
+	def set_checkpoint(self, checkpoint):
+		try:
+			self.lasthsh = checkpoint["lasthsh"].decode("hex")
+			self.lastheight = int(checkpoint.get("lastheight", 0))
+			self.lasttime = int(checkpoint.get("lasttime", 0))
+			self.lastseq = int(checkpoint.get("lastseq", 0))
+			self.height = int(checkpoint.get("height", 0))
+			self.skips = dict([(int(k), v.decode("hex")) for (k, v) in checkpoint.get("skips", {}).iteritems()])
+			self.orphans = dict([(k.decode("hex"), v.decode("hex")) for (k, v) in checkpoint.get("orphans", {}).iteritems()])
+			self.repairs = dict([(k.decode("hex"), (v[0].decode("hex"), v[1].decode("hex"), int(v[2]), float(v[3]))) for (k, v) in checkpoint.get("repairs", {}).iteritems()])
+			self.gaps = dict([(k.decode("hex"), (int(v[0]), v[1].decode("hex"))) for (k, v) in checkpoint.get("gaps", {}).iteritems()])
+		except (KeyError, TypeError, AttributeError) as e:
+			raise ValueError("invalid feed checkpoint: " + repr(e))
+		self.headhsh = ""
+		self.curhsh = ""
+
 
 	## \brief Get next update index
 	#
 	# Sets the last update timestamp to current time. If same timestamp as last update, serial is incremented.
+	#
+	# The top bit of the serial marks header extensions, leaving 128 serials per second. When they are used up, or the clock has gone backwards, the timestamp is moved one second past the last update instead, so that no two updates share an index.
 	def next(self):
 		tim = now_int()
-		seq = 0
-		if tim == self.lasttime:
-			self.lastseq = (state.lastseq + 1) & 0xff
-		else:
+		if tim > self.lasttime:
 			self.lasttime = tim
 			self.lastseq = 0
+		elif self.lastseq < FEED_SERIAL_EXTENDED - 1:
+			self.lastseq += 1
+		else:
+			self.lasttime += 1
+			self.lastseq = 0
 
 	## \brief Serialize update index
 	#
+	# \param extended If True, mark that the update has a header extension
 	# \return 5 bytes; 4 byte little-endian timestamp, 1 byte serial
-	def serial(self):
-		return struct.pack("<I", self.lasttime) + struct.pack("B", self.lastseq)
+	def serial(self, extended=False):
+		seq = self.lastseq
+		if extended:
+			seq |= FEED_SERIAL_EXTENDED
+		return struct.pack("<I", self.lasttime) + struct.pack("B", seq)
+
+
+	## \brief Serialize skip list header extension for next update
+	#
+	# \return Header extension bytes
+	# \see parse_update
+	def extension(self):
+		height = self.height + 1
+		levels = skip_levels(height)
+		fields = struct.pack(">I", height) + chr(levels)
+		for k in range(1, levels+1):
+			fields += self.skips.get(k, zerohsh)
+		return chr(FEED_SKIPLIST_VERSION) + struct.pack(">H", len(fields)) + fields
+
+
+	## \brief Record update written with skip list header extension
+	#
+	# \param hsh Swarm hash of update, binary format
+	def link(self, hsh):
+		self.height += 1
+		for k in range(1, skip_levels(self.height)+1):
+			self.skips[k] = hsh
+
+
+
+## \brief Retrieval of new updates of a single feed
+#
+# Used by FeedCollection.gethead to follow the linked list of one feed with non-blocking requests. Responses are only recorded by the callbacks; the collection processes them when stepping the walk, so that chunks served from cache don't cause recursion.
+#
+# The position of the walk is kept in the FeedState object. A walk may span several gethead calls; messages retrieved so far are handed over at the end of each call.
+class FeedWalk:
+
+	def __init__(self, feedstate, timeout):
+		self.state = feedstate
+		self.msgs = {}
+		self.timeout = timeout
+		self.deadline = time.time() + timeout
+		self.count = 0
+		self.result = None
+		self.waiting = False
+		self.done = False
+
+
+	# callback for non-blocking requests
+	# ignores responses arriving after walk is abandoned
+	def receive(self, data, err):
+		if self.done:
+			return
+		self.result = (data, err)
+		self.waiting = False
+
+
+	# give up request in progress
+	# if no one else waits for it, the request is expired on the agent, so its connection returns to the pool
+	def expire(self, bzz, err):
+		bzz.abandon(self.receive)
+		self.receive(None, err)
+
+
+
+# state of one repair of a broken link in progress in FeedCollection.repair
+class RepairWalk(FeedWalk):
+
+	def __init__(self, feedstate, orphanhsh, timeout):
+		FeedWalk.__init__(self, feedstate, timeout)
+		self.orphanhsh = orphanhsh
+		(self.hsh, self.lasthsh, self.attempts, self.nexttime) = feedstate.repairs[orphanhsh]
+		self.failed = False
 
 
 
@@ -215,6 +715,20 @@ class FeedState:
 # [32 - 36]: serial number; 4 byte timestamp (seconds) + 1 byte sequence number (in increments for updates within same timestamps)
 # [37 - n ]: content; arbitrary bytes
 #
+# If the high bit of the sequence number is set, a header extension precedes the content:
+#
+# [37     ]: extension version
+# [38 - 39]: extension length l, big-endian
+# [40 - 40+l]: extension data
+#
+# Extension version 1 adds skip list pointers, which allow finding an update at any position in the list with a logarithmic number of retrievals:
+#
+# [40 - 43]: height of update in list, starting at 1, big-endian
+# [44     ]: number of pointers k
+# [45 - 45+(k*32)]: hashes of updates 2, 4, ... 2^k positions back
+#
+# An update has pointers for each power of two its height is divisible by (up to a maximum), so on average one pointer per update.
+#
 # The state of sender and reader feeds is the last swarm hash seen. It is stored for every retrieval or send. 
 #
 # Upon retrieval all new updates will be retrieved until the last seen hash is encountered, and the state is reset to the hash of the newest update.
@@ -223,10 +737,22 @@ class FeedCollection:
 
 
 	## \param name Name of collection later if senderfeed is passed, writing to this collection is enabled
-	def __init__(self, name, senderfeed=None):
+	# \param skiplist If True, updates are written with skip list header extension
+	# \param backlog Maximum number of updates per feed to retrieve when catching up, 0 for no limit. Older updates can be retrieved with page()
+	# \param buffersize Maximum number of messages to keep in retrieval buffer. When exceeded, the oldest messages are dropped
+	# \param schedule Scheduler object deciding which feeds are polled by gethead. If None, all feeds are polled every time
+	def __init__(self, name, senderfeed=None, skiplist=FEED_SKIPLIST, backlog=FEED_BACKLOG, buffersize=FEED_BUFFER_SIZE, schedule=None):
 		self.name = name
+		self.schedule = schedule
 		self.feeds = {}
 		self.retrievals = []
+		self.buffersize = buffersize
+		self.buffered = 0
+		self.dropped = 0
+		self.skiplist = skiplist
+		self.backlog = backlog
+		self.walks = []
+		self.senderfeed = None
 		if senderfeed != None:
 			self.senderfeed = FeedState(senderfeed)
 
@@ -241,6 +767,36 @@ class FeedCollection:
 
 
 
+	## \brief Get positions of all feeds for persistence
+	#
+	# \return dict of json serializable values
+	# \see FeedState.get_checkpoint
+	def get_checkpoint(self):
+		checkpoint = {
+			"feeds": {},
+		}
+		if self.senderfeed != None:
+			checkpoint["sender"] = self.senderfeed.get_checkpoint()
+		for (name, feedstate) in self.feeds.iteritems():
+			checkpoint["feeds"][name] = feedstate.get_checkpoint()
+		return checkpoint
+
+
+	## \brief Restore positions of feeds
+	#
+	# Feeds in the checkpoint that are not in the collection are ignored
+	#
+	# \param checkpoint dict as returned by get_checkpoint
+	# \exception ValueError if checkpoint is invalid
+	def set_checkpoint(self, checkpoint):
+		if self.senderfeed != None and "sender" in checkpoint:
+			self.senderfeed.set_checkpoint(checkpoint["sender"])
+		for (name, feedcheckpoint) in checkpoint.get("feeds", {}).iteritems():
+			if name in self.feeds:
+				self.feeds[name].set_checkpoint(feedcheckpoint)
+
+
+
 	## \brief Post update to room
 	#
 	# Makes a single update with the passed data
@@ -261,7 +817,11 @@ class FeedCollection:
 				
 		lasthsh = senderstate.lasthsh
 		senderstate.next()
-		headhsh = senderstate.obj.bzz.add(lasthsh + senderstate.serial() + data)	
+		if self.skiplist:
+			headhsh = senderstate.obj.bzz.add(lasthsh + senderstate.serial(True) + senderstate.extension() + data)
+			senderstate.link(headhsh.decode("hex"))
+		else:
+			headhsh = senderstate.obj.bzz.add(lasthsh + senderstate.serial() + data)	
 		senderstate.lasthsh = headhsh.decode("hex")
 	
 		return headhsh
@@ -297,129 +857,518 @@ class FeedCollection:
 	# 
 	# \param name Internal key of feed
 	def remove(self, name):
-		del self.feeds[name]
+		feedstate = self.feeds.pop(name)
+		if self.schedule != None:
+			self.schedule.remove(feedstate)
+		for w in self.walks:
+			if w.state == feedstate:
+				w.done = True
+		self.walks = [w for w in self.walks if not w.done]
 
 
 
-	## \brief Drain latest update buffer
+	## \brief Announce new update of feed
 	#
-	# Gets all updates retrieved by last syncings
+	# The next gethead call retrieves the feed from the given hash, without looking up the feed head. If a retrieval of the feed is in progress, the feed is only marked to be polled again.
 	#
-	# The array of messages is an aggregate of all reader feeds, sorted by time of update 
+	# \param name Internal key of feed
+	# \param hsh Swarm hash of the update, binary format
+	# \exception KeyError if feed doesn't exist
+	def hint(self, name, hsh):
+		feedstate = self.feeds[name]
+		if self.schedule != None:
+			self.schedule.force(feedstate)
+		if feedstate.headhsh == "" and feedstate.curhsh == "":
+			feedstate.headhsh = hsh
+			feedstate.curhsh = hsh
+
+
+
+	## \brief Number of feeds with retrieval in progress
+	#
+	# \return Number of feeds that the next gethead call will continue retrieving
+	def pending(self):
+		return len(self.walks)
+
+
+
+	## \brief Drain update buffer
+	#
+	# Gets all updates retrieved by syncings since last drain
+	#
+	# The array of messages is an aggregate of all reader feeds, sorted by time of update, sequence number and sender address
 	#
 	# Removes the updates from the buffer
 	#
-	# \param idx Array index to start retrieval from
+	# \param idx Index of single retrieval to get, as returned by gethead. If -1, all retrievals are returned
 	# \return Array of message objects
 	# \see FeedCollection.gethead
-	# \todo evaulate if idx is useful
+	# \see FeedCollection.overflow
 	def get(self, idx=-1):
 
-		msgs = {}
-		msgssorted = []
-
+		# merge all retrievals to one stream per feed, so updates retrieved more than once are only returned once
+		# hash map eth address => hash map serial to Message
+		feedmsgs = {}
 		if idx == -1:
-			if len(self.retrievals) == 0:
-				return []
-			idx = len(self.retrievals)-1	
-	
-		feedmsgs = self.retrievals.pop(idx)
+			retrievals = self.retrievals
+			self.retrievals = []
+		else:
+			retrievals = [self.retrievals[idx]]
+			self.retrievals[idx] = {}
+		for r in retrievals:
+			for (k, msgs) in r.iteritems():
+				feedmsgs.setdefault(k, {}).update(msgs)
+
+		# removed retrievals are left empty until the last, so indices stay valid
+		while len(self.retrievals) > 0 and len(self.retrievals[-1]) == 0:
+			self.retrievals.pop()
+
+		streams = []
+		for msgs in feedmsgs.values():
+			self.buffered -= len(msgs)
+			streams.append([(m.sort_key(), m) for m in sorted(msgs.values(), key=Message.sort_key)])
+		if len(self.retrievals) == 0:
+			self.buffered = 0
+
+		return [m for (_, m) in heapq.merge(*streams)]
+
+
 
-		# \todo refactor to use keys function in sorted
-		for k in feedmsgs.keys():
-			for s, m in feedmsgs[k].iteritems():
-				msgs[str(s) + k] = m
+	## \brief Number of messages dropped because buffer was full
+	#
+	# Resets the count
+	#
+	# \return Number of messages dropped since last call
+	def overflow(self):
+		dropped = self.dropped
+		self.dropped = 0
+		return dropped
+
+
+
+	# add a retrieval to the buffer, dropping the oldest messages if it's full
+	# returns index of retrieval
+	def _buffer(self, feedmsgs):
+		count = 0
+		for msgs in feedmsgs.values():
+			count += len(msgs)
+
+		for i in range(len(self.retrievals)):
+			if self.buffered + count <= self.buffersize:
+				break
+			for msgs in self.retrievals[i].values():
+				self.buffered -= len(msgs)
+				self.dropped += len(msgs)
+			self.retrievals[i] = {}
+
+		# if retrieval alone doesn't fit, keep the newest part of it
+		if count > self.buffersize:
+			keys = []
+			for (k, msgs) in feedmsgs.iteritems():
+				for (serial, m) in msgs.iteritems():
+					keys.append((m.sort_key(), k, serial))
+			keys.sort()
+			for (_, k, serial) in keys[:count-self.buffersize]:
+				del feedmsgs[k][serial]
+			self.dropped += count - self.buffersize
+			count = self.buffersize
+
+		self.buffered += count
+		self.retrievals.append(feedmsgs)
+		return len(self.retrievals)-1
+
+
+
+	## \brief Find update at given height in a feed
+	#
+	# Follows skip list pointers from the given update, using a logarithmic number of retrievals
+	#
+	# \param bzz Swarm connection object
+	# \param hsh Swarm hash of update to start from, binary format
+	# \param height Height of update to find
+	# \return Swarm hash of update, binary format
+	# \exception ValueError if height is above start or updates don't have skip list headers
+	def seek(self, bzz, hsh, height):
+		while True:
+			(prevhsh, _, h, skips, _) = parse_update(bzz.get(hsh.encode("hex")))
+			if h == height:
+				return hsh
+			elif h == 0:
+				raise ValueError("update " + hsh.encode("hex") + " has no height")
+			elif h < height:
+				raise ValueError("height " + str(height) + " is above start " + str(h))
+
+			hsh = prevhsh
+			for k in range(len(skips), 0, -1):
+				if h - (1 << k) >= height:
+					hsh = skips[k-1]
+					break
+
+
+
+	## \brief Retrieve older updates of a feed to buffer
+	#
+	# Retrieves updates left out when catching up with a feed, or any other range of earlier updates
+	#
+	# \param bzz Swarm connection object
+	# \param name Internal key of feed
+	# \param height Height of newest update to retrieve
+	# \param count Maximum number of updates to retrieve
+	# \return Index of retrieval in buffer
+	# \see FeedCollection.get
+	def page(self, bzz, name, height, count):
+		feedstate = self.feeds[name]
+		hsh = self.seek(bzz, feedstate.lasthsh, height)
+		gap = feedstate.gaps.pop(hsh, None)
+		msgs = {}
+		while count > 0 and hsh != zerohsh:
+			if gap != None and hsh == gap[1]:
+				gap = None
+				break
+			(prevhsh, serial, h, _, content) = parse_update(bzz.get(hsh.encode("hex")))
+			msgs[serial] = Message(serial, feedstate.obj.account, content)
+			hsh = prevhsh
+			height = h - 1
+			count -= 1
 
-		for m in sorted(msgs):
-			msgssorted.append(msgs[m])
+		# keep what is left of a skipped range
+		if gap != None and hsh != zerohsh and hsh != gap[1]:
+			feedstate.gaps[hsh] = (height, gap[1])
 
-		return msgssorted
+		return self._buffer({feedstate.obj.account.get_address(): msgs})
 
 
 
 	## \brief Retrieve latest updates to buffer
 	#
 	# Syncs all reader feeds with the latest updates and stored them in a buffer
+	#
+	# If the collection has a schedule, only the feeds that are due are polled, and the schedule is updated with whether they had new updates
+	#
+	# The feeds are retrieved in parallel using non-blocking requests, with at most concurrency feeds in progress at a time. A feed where a single request is not answered within timeout seconds is abandoned as if the retrieval failed.
+	#
+	# The work done by one call can be limited by number of requests and by time, so a long backlog doesn't block the caller. Retrievals left unfinished are continued by the next call, and the messages retrieved so far are buffered right away. As the feeds are followed from the head, the newest messages are buffered first.
 	# 
 	# The messages can be retrieved with get()
 	#
 	# \param bzz Swarm connection object
 	# \param deactivateonfail Deactivates a feed if updates can't be retrieved for it
+	# \param concurrency Maximum number of feeds to retrieve in parallel
+	# \param timeout Seconds a single request may take
+	# \param hops Maximum number of requests to issue, 0 for no limit
+	# \param budget Maximum seconds to spend, 0 for no limit
 	# \return Tuple; number of feeds have new messages, and an array of accounts for feeds that we w not retrievable
 	# \see FeedCollection.get
-	# \todo make sure this completes or fully abandons retrieves before returning
-	def gethead(self, bzz, deactivateonfail=True):
+	# \see FeedCollection.pending
+	def gethead(self, bzz, deactivateonfail=True, concurrency=FEED_CONCURRENCY, timeout=FEED_TIMEOUT, hops=FEED_HOPS, budget=FEED_BUDGET):
 
 		# hash map eth address => hash map serial to Message 
 		feedmsgs = {}
 		fails = []
 
-		for feedname in self.feeds.keys(): # feedstate in self.feeds.values():
-	
-			feedstate = self.feeds[feedname]
-			if not feedstate.active:
+		# feeds with retrievals left from last call are continued, not restarted
+		walking = [w.state for w in self.walks]
+		queue = collections.deque()
+		now = time.time()
+		for feedstate in self.feeds.values():
+			if not feedstate.active or feedstate in walking:
 				continue
-
-			# headhsh will be empty string 
-			# between completed retrieves
-			# we then need to get the new head hash
-			# the feed is currently pointing to
-			if feedstate.headhsh == "":
+			if self.schedule != None and not self.schedule.due(feedstate, now):
+				continue
+			queue.append(feedstate)
+
+		stoptime = time.time() + budget
+		issued = 0
+		exhausted = False
+		while len(queue) > 0 or len(self.walks) > 0:
+			while len(self.walks) < concurrency and len(queue) > 0:
+				self.walks.append(FeedWalk(queue.popleft(), timeout))
+
+			# step all walks that have a response, until all are waiting for the network or budget is spent
+			stepped = True
+			while stepped and not exhausted:
+				stepped = False
+				for w in self.walks:
+					if not w.waiting and not w.done:
+						stepped = True
+						if self._step(bzz, w, deactivateonfail, fails):
+							issued += 1
+							exhausted = hops > 0 and issued >= hops
+							if exhausted:
+								break
+
+			# abandon walks that take too long
+			now = time.time()
+			for w in self.walks:
+				if not w.done and w.waiting and w.deadline <= now:
+					sys.stderr.write("retrieve timeout on feed " + w.state.obj.account.get_address().encode("hex") + "\n")
+					w.expire(bzz, IOError("feed retrieve timed out"))
+					self._step(bzz, w, deactivateonfail, fails)
+
+			for w in self.walks:
+				if len(w.msgs) > 0:
+					feedmsgs.setdefault(w.state.obj.account.get_address(), {}).update(w.msgs)
+					w.count += len(w.msgs)
+					w.msgs = {}
+				if w.done and self.schedule != None:
+					self.schedule.polled(w.state, w.count > 0)
+			self.walks = [w for w in self.walks if not w.done]
+
+			if budget > 0 and now >= stoptime:
+				exhausted = True
+			if exhausted:
+				break
+
+			if len(self.walks) > 0:
+				deadline = min([w.deadline for w in self.walks])
+				if budget > 0:
+					deadline = min(deadline, stoptime)
+				bzz.poll(max(min(deadline - time.time(), 1.0), 0))
+
+		return (self._buffer(feedmsgs), fails)
+
+
+	## \brief Retry retrieval of updates lost to broken links
+	#
+	# When a link in a feed can't be retrieved, the updates from there to the last retrieved update are missing. These are retried with increasing delay, until they are retrieved or the retries are used up.
+	#
+	# All due repairs are followed in parallel using non-blocking requests. Like gethead, the work done by one call can be limited by number of requests and by time; a repair not finished continues from where it stopped on the next call.
+	#
+	# Recovered messages are stored in the buffer, and can be retrieved with get()
+	#
+	# \param bzz Swarm connection object
+	# \param hops Maximum number of requests to issue, 0 for no limit
+	# \param budget Maximum seconds to spend, 0 for no limit
+	# \param timeout Seconds a single request may take before the attempt counts as failed
+	# \return Tuple; index of retrieval in buffer, number of orphans recovered, number of orphans still pending retry
+	# \see FeedCollection.get
+	def repair(self, bzz, hops=FEED_REPAIR_HOPS, budget=FEED_BUDGET, timeout=FEED_TIMEOUT):
+		feedmsgs = {}
+		recovered = 0
+		pending = 0
+		now = time.time()
+
+		walks = []
+		for feedstate in self.feeds.values():
+			for orphanhsh in feedstate.repairs.keys():
+				if feedstate.repairs[orphanhsh][3] > now:
+					pending += 1
+				else:
+					walks.append(RepairWalk(feedstate, orphanhsh, timeout))
+
+		stoptime = now + budget
+		issued = 0
+		while True:
+			for w in walks:
+				limit = -1
+				if hops > 0:
+					limit = hops - issued
+				issued += self._step_repair(bzz, w, limit)
+
+			now = time.time()
+			waiting = [w for w in walks if w.waiting]
+			if len(waiting) == 0 or (budget > 0 and now >= stoptime):
+				break
+
+			# requests not answered in time count as failed attempts
+			for w in waiting:
+				if w.deadline <= now:
+					w.expire(bzz, IOError("repair retrieve timed out"))
+
+			deadline = min([w.deadline for w in waiting])
+			if budget > 0:
+				deadline = min(deadline, stoptime)
+			bzz.poll(max(min(deadline - time.time(), 1.0), 0))
+
+		for w in walks:
+			# responses arriving after this are ignored, but still end up in the chunk cache for the next call
+			w.done = True
+			feedstate = w.state
+			if len(w.msgs) > 0:
+				feedmsgs.setdefault(feedstate.obj.account.get_address(), {}).update(w.msgs)
+
+			if not w.failed and (w.hsh == w.lasthsh or w.hsh == zerohsh):
+				del feedstate.repairs[w.orphanhsh]
+				for (k, v) in feedstate.orphans.items():
+					if v == w.orphanhsh:
+						del feedstate.orphans[k]
+				recovered += 1
+			elif w.failed and w.attempts >= FEED_REPAIR_RETRIES:
+				sys.stderr.write("giving up repair of orphan " + w.orphanhsh.encode("hex") + "\n")
+				del feedstate.repairs[w.orphanhsh]
+			elif w.failed:
+				attempts = w.attempts + 1
+				feedstate.repairs[w.orphanhsh] = (w.hsh, w.lasthsh, attempts, now + (FEED_REPAIR_DELAY * (1 << attempts)))
+				pending += 1
+			else:
+				feedstate.repairs[w.orphanhsh] = (w.hsh, w.lasthsh, w.attempts, w.nexttime)
+				pending += 1
+
+		return (self._buffer(feedmsgs), recovered, pending)
+
+
+
+	# advance a repair by processing responses, issuing at most limit requests, or any number if limit is negative
+	# a cached chunk is delivered before the request returns, so the repair is followed until it waits for the network
+	# returns number of requests issued
+	def _step_repair(self, bzz, walk, limit):
+		issued = 0
+		while not walk.done and not walk.waiting:
+			if walk.result != None:
+				(data, err) = walk.result
+				walk.result = None
 				try:
-					feedstate.headhsh = feedstate.obj.head()
-				except:
+					if err != None:
+						raise err
+					if data == None or data == "":
+						raise IOError("empty response")
+					(prevhsh, serial, _, _, content) = parse_update(data)
+				except (IOError, ValueError) as e:
+					sys.stderr.write("repair fail on hash " + walk.hsh.encode("hex") + ": " + repr(e) + "\n")
+					walk.failed = True
+					walk.done = True
+					break
+				walk.msgs[serial] = Message(serial, walk.state.obj.account, content)
+				walk.hsh = prevhsh
+
+			if walk.hsh == walk.lasthsh or walk.hsh == zerohsh:
+				walk.done = True
+			elif issued == limit:
+				break
+			else:
+				walk.waiting = True
+				walk.deadline = time.time() + walk.timeout
+				issued += 1
+				bzz.get_async(walk.hsh.encode("hex"), walk.receive)
+		return issued
+
+
+
+	# advance a feed walk by processing its last response and issuing the next request
+	#
+	# a walk first gets the head hash of the feed, unless a walk to a previous head was not completed
+	# it then follows the linked list until the last seen hash (or zerohash) is found
+	# if one lookup fails, the contents retrieved up until that point are kept, and the break is recorded as an orphan
+	# returns True if a request was issued
+	def _step(self, bzz, walk, deactivateonfail, fails):
+		feedstate = walk.state
+
+		if walk.result != None:
+			(data, err) = walk.result
+			walk.result = None
+
+			# response to head request
+			if feedstate.headhsh == "":
+				if err != None:
 					if deactivateonfail:
 						feedstate.active = False
 					fails.append(feedstate.obj.account)
-					continue
-
-			#sys.stderr.write("headhsh " + feedstate.headhsh.encode("hex") + "\n")
-
-			if feedstate.headhsh == "":
-				continue
-				
-			# store new messages for feed
-			(msgs, brk) = self._retrieve(bzz, feedstate.obj.account, feedstate.headhsh, feedstate.lasthsh)
-			feedmsgs[feedstate.obj.account.get_address()] = msgs
-			if brk != None:
-				sys.stderr.write("retrieve fail on hash: " + str(brk) + "\n")
-				feedstate.lasthsh = brk
-				feedstate.orphans[feedstate.headhsh] = feedstate.lasthsh
-
-			# set next retrieve to terminate on
+					walk.done = True
+					return False
+				if data == "":
+					walk.done = True
+					return False
+				feedstate.headhsh = data
+				feedstate.curhsh = data
+
+			# response to chunk request
+			else:
+				if err != None or data == "":
+					if err != None:
+						sys.stderr.write("request fail: " + repr(err) + "\n")
+					sys.stderr.write("retrieve fail on hash: " + feedstate.curhsh.encode("hex") + "\n")
+					feedstate.orphans[feedstate.headhsh] = feedstate.curhsh
+					feedstate.repairs[feedstate.curhsh] = (feedstate.curhsh, feedstate.lasthsh, 0, time.time() + FEED_REPAIR_DELAY)
+					feedstate.curhsh = feedstate.lasthsh
+				else:
+					try:
+						(prevhsh, serial, height, _, content) = parse_update(data)
+					except ValueError as e:
+						sys.stderr.write("invalid update " + feedstate.curhsh.encode("hex") + ": " + repr(e) + "\n")
+						(prevhsh, serial, height, content) = (data[:32], data[32:37], 0, data[37:])
+					walk.msgs[serial] = Message(serial, feedstate.obj.account, content)
+					if feedstate.curhsh == feedstate.headhsh:
+						feedstate.headheight = height
+					feedstate.curhsh = prevhsh
+
+					# leave older updates for paging if backlog is exceeded
+					if height > 0 and self.backlog > 0 and feedstate.headheight - height + 1 >= self.backlog and height - 1 > feedstate.lastheight and prevhsh != feedstate.lasthsh:
+						feedstate.gaps[prevhsh] = (height - 1, feedstate.lasthsh)
+						feedstate.curhsh = feedstate.lasthsh
+
+		elif feedstate.headhsh == "":
+			walk.waiting = True
+			walk.deadline = time.time() + walk.timeout
+			feedstate.obj.head_async(walk.receive)
+			return True
+
+		elif feedstate.curhsh == "":
+			feedstate.curhsh = feedstate.headhsh
+
+		# we are done when we reach the previous head
+		if feedstate.curhsh == feedstate.lasthsh or feedstate.curhsh == zerohsh:
 			feedstate.lasthsh = feedstate.headhsh
+			feedstate.lastheight = feedstate.headheight
 			feedstate.headhsh = ""
-	
-		self.retrievals.append(feedmsgs)
-		return (len(self.retrievals)-1, fails)
+			feedstate.curhsh = ""
+			walk.done = True
+			return False
 
-	
-	
-	# private function for traversing linked list until target hash (or zerohash) is found 	
-	# if one lookup fails, the contents retrieved up until that point is returned
-	def _retrieve(self, bzz, feedaddress, curhsh, targethsh):
+		walk.waiting = True
+		walk.deadline = time.time() + walk.timeout
+		bzz.get_async(feedstate.curhsh.encode("hex"), walk.receive)
+		return True
 
-		# hash map serial (timestamp+seq) => Message
-		msgs = {}
-
-		# we break out of loop when we reach the previous head	
-		while curhsh != targethsh and curhsh != zerohsh:
-			try:
-				r = bzz.get(curhsh.encode("hex"))
-			except Exception as e:
-				sys.stderr.write("request fail: " + repr(e) + "\n")
-				return (msgs, curhsh)
-				#raise BzzRetrieveError(curhsh, str(e))
-			if r == "":
-				return (msgs, curhsh)
-				#raise BzzRetrieveError(curhsh, "empty HTTP response body")
 
-			curhsh = r[:32]
-			serial = r[32:37] # 4 bytes time + 1 byte serial
-			content = r[37:]	
-			msgs[serial] = Message(serial, feedaddress, content)
 
-		return (msgs, None)
+## \brief Parse feed collection update
+#
+# \param data Raw update data
+# \return Tuple; previous update hash, serial (without extension flag), height (0 if no skip list header), list of skip pointer hashes, content
+# \exception ValueError on invalid update data
+# \see FeedCollection
+def parse_update(data):
+	if len(data) < 37:
+		raise ValueError("invalid update data")
+
+	seq = ord(data[36])
+	serial = data[32:36] + chr(seq & ~FEED_SERIAL_EXTENDED)
+	if seq & FEED_SERIAL_EXTENDED == 0:
+		return (data[:32], serial, 0, [], data[37:])
+
+	if len(data) < 40:
+		raise ValueError("invalid update header extension")
+	version = ord(data[37])
+	extlength = struct.unpack(">H", data[38:40])[0]
+	crsr = 40 + extlength
+	if len(data) < crsr:
+		raise ValueError("invalid update header extension length")
+
+	# skip extensions we don't know
+	if version != FEED_SKIPLIST_VERSION:
+		return (data[:32], serial, 0, [], data[crsr:])
+
+	height = struct.unpack(">I", data[40:44])[0]
+	levels = ord(data[44])
+	if 45 + (levels*32) > crsr:
+		raise ValueError("invalid skip list header")
+	skips = []
+	for i in range(levels):
+		skips.append(data[45+(i*32):45+((i+1)*32)])
+	return (data[:32], serial, height, skips, data[crsr:])
+
+
+
+## \brief Number of skip pointers for update at height
+#
+# \param height Height of update
+# \return Number of times height is divisible by two, capped at maximum number of pointers
+def skip_levels(height):
+	levels = 0
+	while height > 0 and height & 1 == 0 and levels < FEED_SKIPLIST_LEVELS:
+		height >>= 1
+		levels += 1
+	return levels
 
 
 
@@ -464,6 +1413,52 @@ def compile_digest(topic, user, inputdata, tim, epoch=1):
 
 
 
+## \brief Get base time of feed epoch
+#
+# \param tim Epoch time
+# \param level Epoch level
+# \return Epoch base time, numerical
+def epoch_base(tim, level):
+	return tim & ~((1 << level) - 1)
+
+
+
+## \brief Calculate level of next feed epoch
+#
+# Implements the level selection of the swarm feeds lookup algorithm. The next level is the highest bit in which the last epoch's base time and the current time differ, but no lower than one below the last level.
+#
+# \param lasttime Time of last update
+# \param lastlevel Level of last update
+# \param now Time of next update
+# \return Epoch level, numerical
+def epoch_next_level(lasttime, lastlevel, now):
+	mix = epoch_base(lasttime, lastlevel) ^ now
+	if lastlevel > 0:
+		mix |= 1 << (lastlevel - 1)
+
+	if mix >= 1 << (FEED_HIGHEST_LEVEL + 1):
+		return FEED_HIGHEST_LEVEL
+
+	for i in range(FEED_HIGHEST_LEVEL, 0, -1):
+		if mix & (1 << i) != 0:
+			return i
+	return 0
+
+
+
+## \brief Calculate next feed epoch
+#
+# \param lasttime Time of last update, 0 if there is no previous update
+# \param lastlevel Level of last update
+# \param now Time of next update
+# \return Tuple; (time, level), numerical
+def epoch_next(lasttime, lastlevel, now):
+	if lasttime == 0:
+		return (now, FEED_HIGHEST_LEVEL)
+	return (now, epoch_next_level(lasttime, lastlevel, now))
+
+
+
 ## sign a digest with given private key to use for feed update
 def sign_digest(pk, digest):
 	sig = pk.ecdsa_sign_recoverable(digest, raw=True)
@@ -495,6 +1490,11 @@ def new_topic_mask(base, prefix, postfix):
 	return topic
 
 
+# the last topic byte is used as bitflag to allow to determine context from the topic
+chattopic = new_topic_mask(zerohsh, "", "\x01")
+roomtopic = new_topic_mask(zerohsh, "", "\x02")
+
+
 ## Check if input is valid feed topic
 #
 # \return True; valid topic
@@ -1,13 +1,17 @@
 import os
 import sys
 import copy
+import json
 
 from tools import clean_pubkey, clean_overlay, Queue
 from user import PssContact
 from bzz import Feed, FeedCollection, chattopic, roomtopic
 from room import Room
+from store import ChunkStore
 
 CACHE_CONTACT_STOREFILE = ".pss-contacts"
+CACHE_CHUNK_STOREFILE = ".pss-chunks"
+CACHE_FEED_STOREFILE = ".pss-feeds"
 
 
 ## Provides API for UI
@@ -17,6 +21,7 @@ class Cache:
 	
 	def __init__(self, path=".", queuelength=10):
 		self.bzzs = {}
+		self.pools = {}
 		self.psses = {}
 		self.selfs = {}	
 		self.defaultname = ""
@@ -32,6 +37,9 @@ class Cache:
 		self.feeds = {}
 		self.chats = {}
 
+		# feed collection positions from last session, by collection name
+		self.checkpoints = {}
+
 		# index nicks to chat rooms
 		self.rooms = {}
 		self.idx_room_contacts = {}
@@ -40,9 +48,11 @@ class Cache:
 		# verify path and handle trailing slash
 		self.path = path
 		self.file = None
+		self.chunkstore = None
 
 
-	def add_node(self, pssobj):
+	# progress is passed to Pss.add_many for the registration of stored contacts with the node
+	def add_node(self, pssobj, progress=None):
 		if pssobj.get_name() in self.psses.keys():
 			raise AttributeError("pss key " + str(nodename) + " already in use")
 
@@ -51,7 +61,7 @@ class Cache:
 
 		self.psses[pssobj.get_name()] = pssobj
 		self.idx_publickey_pss[pssobj.get_public_key()] = pssobj
-		self.update_node_contact(pssobj.get_name())
+		self.update_node_contact(pssobj.get_name(), progress)
 		return True
 
 	
@@ -102,6 +112,7 @@ class Cache:
 			sys.stderr.write("can't find state for room " + name + ": " + repr(e) + "\n")
 			room.start(self.get_nodeself(nodename))
 
+		self.restore_checkpoint(room.feedcollection)
 		self.rooms[name] = room
 		return (room, loaded)
 		
@@ -137,6 +148,30 @@ class Cache:
 
 
 
+	## \brief Add connection pool for swarm gateway
+	#
+	# Pools are shared by all nodes using the same gateway
+	#
+	# \param poolobj AgentPool object
+	def add_agent_pool(self, poolobj):
+		if poolobj.get_key() in self.pools:
+			raise AttributeError("pool for gateway " + poolobj.get_key() + " already exists")
+
+		self.pools[poolobj.get_key()] = poolobj
+		return True
+
+
+
+	## \brief Get connection pool for swarm gateway
+	#
+	# \param host Gateway host
+	# \param port Gateway port
+	# \return AgentPool object, or None if no pool exists for gateway
+	def get_agent_pool(self, host, port):
+		return self.pools.get(host + ":" + str(port))
+
+
+
 	# \todo handle source param, must be supplied	
 	def add_contact(self, contact, store=False, overwrite=False):
 
@@ -193,6 +228,7 @@ class Cache:
 
 		coll = FeedCollection(srcnode.get_name() + "." + contact.get_nick(), senderfeed)
 		coll.add(contact.get_nick(), peerfeed)
+		self.restore_checkpoint(coll)
 
 		if not contact.get_public_key() in self.chats:
 			self.chats[contact.get_public_key()] = {}
@@ -235,17 +271,15 @@ class Cache:
 
 	# check all sources and add as recipients in node
 	# returns array of contacts added
-	def update_node_contact(self, nodename):
+	# registers all stored contacts with the node in one pipelined batch
+	def update_node_contact(self, nodename, progress=None):
 		node = self.psses[nodename]
 		srckey = node.get_public_key()
-		contacts = []
+		contacts = list(self.idx_src_contacts.get(srckey, []))
 		try:
-			for c in self.idx_src_contacts[srckey]:
-				self.psses[nodename].add(c)
-				contacts.append(c)
-
-		except:
-			pass
+			node.add_many(contacts, progress)
+		except IOError as e:
+			sys.stderr.write("could not register contacts with node " + nodename + ": " + str(e) + "\n")
 
 		if node.can_write():
 			self.update_node_contact_feed(node)
@@ -280,6 +314,18 @@ class Cache:
 
 
 
+	## \brief Get persistent swarm chunk store
+	#
+	# The store is opened on first call
+	#
+	# \return ChunkStore object
+	def get_chunk_store(self):
+		if self.chunkstore == None:
+			self.chunkstore = ChunkStore(self.path + "/" + CACHE_CHUNK_STOREFILE)
+		return self.chunkstore
+
+
+
 	def load_store(self):
 
 		entrycount = 0
@@ -329,9 +375,68 @@ class Cache:
 
 		# \todo dump valid entries to new file and copy over old
 		self.file = open(self.get_store_path(), "a", 0600)
+		self.load_checkpoints()
 		return (entrycount, okcount)
 
 
+	def get_feed_store_path(self):
+		return self.path + "/" + CACHE_FEED_STOREFILE
+
+
+
+	## \brief Load feed positions saved in last session
+	#
+	# They are applied to feed collections as they are created
+	#
+	# \return Number of feed collections loaded
+	def load_checkpoints(self):
+		try:
+			f = open(self.get_feed_store_path(), "r")
+			self.checkpoints = json.load(f)
+			f.close()
+		except IOError as e:
+			pass
+		except ValueError as e:
+			sys.stderr.write("invalid feed store " + self.get_feed_store_path() + ": " + repr(e) + "\n")
+		return len(self.checkpoints)
+
+
+
+	## \brief Apply saved positions to feed collection
+	#
+	# \param coll FeedCollection object
+	def restore_checkpoint(self, coll):
+		try:
+			coll.set_checkpoint(self.checkpoints[coll.get_name()])
+		except KeyError as e:
+			pass
+		except ValueError as e:
+			sys.stderr.write("skipping checkpoint for " + coll.get_name() + ": " + repr(e) + "\n")
+
+
+
+	## \brief Save positions of all feed collections
+	#
+	# The file is replaced atomically, so a crash while saving leaves the previous version intact
+	def save_checkpoints(self):
+		colls = []
+		for chats in self.chats.values():
+			colls += chats.values()
+		for room in self.rooms.values():
+			colls.append(room.feedcollection)
+		for coll in colls:
+			self.checkpoints[coll.get_name()] = coll.get_checkpoint()
+
+		tmppath = self.get_feed_store_path() + ".tmp"
+		f = open(tmppath, "w", 0600)
+		json.dump(self.checkpoints, f)
+		f.flush()
+		os.fsync(f.fileno())
+		f.close()
+		os.rename(tmppath, self.get_feed_store_path())
+
+
+
 	def close_node(self, name):
 		self.psses[name].close()
 		if (self.bzzs[name] != self.get_active_bzz()):
@@ -340,10 +445,21 @@ class Cache:
 
 	def close(self):
 
+		try:
+			self.save_checkpoints()
+		except Exception as e:
+			sys.stderr.write("could not save feed positions: " + repr(e) + "\n")
+
 		for p in self.psses.values():
 			p.close()
 
 		for b in self.bzzs.values():
 			b.close()
 
+		for p in self.pools.values():
+			p.close()
+
+		if self.chunkstore != None:
+			self.chunkstore.close()
+
 		self.file.close()
@@ -1,9 +1,31 @@
 import json
+import re
+
+# tokens affecting object depth outside of strings
+STREAM_TOKEN = re.compile(r'[{}"]')
+
+# tokens ending or escaping within strings
+STREAM_QUOTED_TOKEN = re.compile(r'["\\]')
+
 
 ## Lowlevel handler for JSONRPC responses
+#
+# Splits a stream of concatenated json objects into the individual objects. The data is scanned for braces and quotes only, skipping the characters in between in bulk. Braces inside strings are not counted.
+#
+# Data outside of objects is discarded. Incomplete objects are kept until completed by later calls.
+#
+# The client does not use this for pss messages; the websocket frames read by FrameReader already hold one complete message each. It is kept for reading json from unframed streams.
+#
+# \see FrameReader
 class Stream:
-	buf = ""
-	depth = 0
+
+	def __init__(self):
+		# parts of incomplete object
+		self.pending = []
+		self.depth = 0
+		self.quoted = False
+		self.escaped = False
+
 
 	def process(self, data):
 		"""  process stream of json and connect/disconnect indicators, keeping state between calls
@@ -13,7 +35,6 @@ class Stream:
 		* status: if false, connection status is down
 		"""
 
-		n = 0
 		r = {
 			"processing": False,
 			"results": [],
@@ -23,27 +44,54 @@ class Stream:
 		try:
 			n = len(data)
 		except:
-			return 			
+			return
+
+		# offset of current object in data
+		start = None
+		if self.depth > 0:
+			start = 0
 
-		last = 0
-		for i in range(0, n):
+		# character escaped at end of previous data is skipped
+		crsr = 0
+		if self.escaped and n > 0:
+			self.escaped = False
+			crsr = 1
 
-			if ord(data[i]) == 0x7b:
+		while crsr < n:
+			if self.quoted:
+				m = STREAM_QUOTED_TOKEN.search(data, crsr)
+			else:
+				m = STREAM_TOKEN.search(data, crsr)
+			if m == None:
+				break
+			i = m.start()
+			c = data[i]
+			crsr = i + 1
+
+			if self.quoted:
+				if c == "\\":
+					if crsr == n:
+						self.escaped = True
+					crsr += 1
+				else:
+					self.quoted = False
+			elif c == '"':
+				if self.depth > 0:
+					self.quoted = True
+			elif c == "{":
+				if self.depth == 0:
+					start = i
 				self.depth += 1
-				self.buf += data[i]
-			elif ord(data[i]) == 0x7d:
+			elif self.depth > 0:
 				self.depth -= 1
 				if self.depth == 0:
-					self.buf += data[i]
-					r['results'].append(self.buf)
-					self.buf = ""
-					last = i
-				else:
-					self.buf += data[i]
-			elif self.depth > 0:
-				self.buf += data[i]
+					self.pending.append(data[start:crsr])
+					r['results'].append("".join(self.pending))
+					self.pending = []
+					start = None
 
 		if self.depth > 0:
+			self.pending.append(data[start:])
 			r['processing'] = True
 
 		return r
@@ -0,0 +1,223 @@
+import socket
+import struct
+import errno
+
+# default initial size of frame read buffer
+FRAME_BUFFER_SIZE = 65536
+
+# maximum size of a single frame, the read buffer will not grow beyond this
+FRAME_MAX_SIZE = 16 * 1024 * 1024
+
+# websocket frame opcodes
+FRAME_OP_CONTINUATION = 0x0
+FRAME_OP_TEXT = 0x1
+FRAME_OP_BINARY = 0x2
+FRAME_OP_CLOSE = 0x8
+FRAME_OP_PING = 0x9
+FRAME_OP_PONG = 0xa
+
+
+## \brief Incremental websocket frame reader
+#
+# Reads websocket frames from a socket into a reusable buffer, and returns the payloads of complete messages. Fragmented messages are joined, and masked payloads are unmasked.
+#
+# Each read drains all data available on the socket without blocking, filling as much of the buffer as possible per system call. Frames are parsed in place whenever the buffer fills, so the maximum size limits a single frame and not the amount of data read at once; the buffer is only compacted when the free space at its end runs out, and grown when a single frame doesn't fit.
+#
+# Control frames received are kept in the control list as tuples of opcode and payload, for the caller to answer pings and handle close.
+class FrameReader:
+
+	## \param sock Socket to read from, may be None if data is only passed with feed()
+	# \param size Initial size of buffer
+	# \param maxsize Maximum size of buffer
+	def __init__(self, sock=None, size=FRAME_BUFFER_SIZE, maxsize=FRAME_MAX_SIZE):
+		self.sock = sock
+		self.buf = bytearray(size)
+		self.view = memoryview(self.buf)
+		self.maxsize = maxsize
+
+		# unparsed data is between start and end
+		self.start = 0
+		self.end = 0
+
+		# payloads of fragmented message in progress
+		self.fragments = []
+
+		self.control = []
+		self.closed = False
+
+
+	## \brief Number of bytes read but not yet parsed
+	#
+	# \return Byte count
+	def buffered(self):
+		return self.end - self.start
+
+
+	## \brief Add data to buffer
+	#
+	# \param data Raw websocket data
+	# \return Payloads of messages completed, in order received
+	# \exception IOError if a frame is too large or invalid
+	def feed(self, data):
+		msgs = []
+		crsr = 0
+		while crsr < len(data):
+			if self.end == len(self.buf):
+				msgs += self.messages()
+			self._reserve()
+			n = min(len(data) - crsr, len(self.buf) - self.end)
+			self.buf[self.end:self.end+n] = data[crsr:crsr+n]
+			self.end += n
+			crsr += n
+		return msgs + self.messages()
+
+
+	## \brief Read all data available on socket
+	#
+	# Does not block. If the connection is closed by the peer, closed is set
+	#
+	# \return Payloads of messages completed, in order received
+	# \exception IOError if a frame is too large or invalid, or on socket error
+	def read(self):
+		msgs = []
+		while True:
+			# parse complete frames before making room, so the buffer only has to hold the frame in progress
+			if self.end == len(self.buf):
+				msgs += self.messages()
+			self._reserve()
+			try:
+				n = self.sock.recv_into(self.view[self.end:], len(self.buf) - self.end, socket.MSG_DONTWAIT)
+			except socket.error as e:
+				if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+					break
+				if e.errno == errno.EINTR:
+					continue
+				raise
+			if n == 0:
+				self.closed = True
+				break
+			self.end += n
+		return msgs + self.messages()
+
+
+	## \brief Parse complete frames in buffer
+	#
+	# \return Payloads of messages completed, in order received
+	# \exception IOError if a frame is invalid
+	def messages(self):
+		msgs = []
+		while True:
+			frame = self._frame()
+			if frame == None:
+				break
+			(fin, opcode, payload) = frame
+
+			if opcode >= FRAME_OP_CLOSE:
+				self.control.append((opcode, payload))
+				if opcode == FRAME_OP_CLOSE:
+					self.closed = True
+				continue
+
+			if opcode == FRAME_OP_CONTINUATION:
+				if len(self.fragments) == 0:
+					raise IOError("continuation frame without message")
+			elif len(self.fragments) > 0:
+				raise IOError("new message before fragmented message completed")
+
+			self.fragments.append(payload)
+			if fin:
+				msgs.append("".join(self.fragments))
+				self.fragments = []
+
+		if self.start == self.end:
+			self.start = 0
+			self.end = 0
+		return msgs
+
+
+	# parse one frame from buffer and advance start
+	# returns tuple of final flag, opcode and payload, or None if frame is not complete
+	def _frame(self):
+		available = self.end - self.start
+		if available < 2:
+			return None
+
+		(b0, b1) = struct.unpack_from("BB", self.buf, self.start)
+		fin = b0 & 0x80 != 0
+		opcode = b0 & 0x0f
+		masked = b1 & 0x80 != 0
+		length = b1 & 0x7f
+
+		crsr = self.start + 2
+		if length == 126:
+			if available < 4:
+				return None
+			length = struct.unpack_from(">H", self.buf, crsr)[0]
+			crsr += 2
+		elif length == 127:
+			if available < 10:
+				return None
+			length = struct.unpack_from(">Q", self.buf, crsr)[0]
+			crsr += 8
+
+		headerlength = crsr - self.start
+		if masked:
+			headerlength += 4
+		if headerlength + length > self.maxsize:
+			raise IOError("frame too large: " + str(length))
+		if available < headerlength + length:
+			self._expect(headerlength + length)
+			return None
+
+		mask = None
+		if masked:
+			mask = self.buf[crsr:crsr+4]
+			crsr += 4
+
+		if mask == None:
+			payload = self.view[crsr:crsr+length].tobytes()
+		else:
+			data = self.buf[crsr:crsr+length]
+			for i in range(length):
+				data[i] ^= mask[i & 3]
+			payload = str(data)
+
+		self.start = crsr + length
+		return (fin, opcode, payload)
+
+
+	# make room at end of buffer by moving unparsed data to the front
+	def _reserve(self):
+		if self.end < len(self.buf):
+			return
+		if self.start > 0:
+			n = self.end - self.start
+			self.buf[0:n] = self.buf[self.start:self.end]
+			self.start = 0
+			self.end = n
+			return
+		self._expect(len(self.buf) * 2)
+
+
+	# make sure a frame of given size fits in buffer
+	def _expect(self, size):
+		if size <= len(self.buf) - self.start:
+			return
+		n = self.end - self.start
+		if size <= len(self.buf):
+			self.buf[0:n] = self.buf[self.start:self.end]
+			self.start = 0
+			self.end = n
+			return
+		newsize = len(self.buf)
+		while newsize < size:
+			newsize *= 2
+		newsize = min(newsize, self.maxsize)
+		if newsize < size:
+			raise IOError("frame too large: " + str(size))
+		buf = bytearray(newsize)
+		buf[0:n] = self.buf[self.start:self.end]
+		self.buf = buf
+		self.view = memoryview(self.buf)
+		self.start = 0
+		self.end = n
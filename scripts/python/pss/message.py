@@ -3,6 +3,9 @@ import struct
 
 rMsg = re.compile("\S")
 
+# marks pss message as room notice, can't be entered as chat text
+MESSAGE_ROOM_NOTICE = "\x00\x01"
+
 ## Base type for all user-generated message updates
 class Message:
 	
@@ -10,19 +13,74 @@ class Message:
 		if len(serial) != 5:
 			raise ValueError("wrong serial length")
 
-		self.timestamp = struct.unpack(">I", serial[0:4])
-		self.seq = struct.unpack("B", serial[len(serial)-1])
+		self.timestamp = struct.unpack("<I", serial[0:4])[0]
+		self.seq = struct.unpack("B", serial[len(serial)-1])[0]
 		self.key = acc.publickeybytes
 		self.user = acc.address
 		self.content = content
 
 
 	def serialize(self):
-		serial = struct.pack(">I", self.timestamp)
+		serial = struct.pack("<I", self.timestamp)
 		serial += struct.pack("B", self.seq)
-		serial += content
+		serial += self.content
 		return serial
 
 
+	## \brief Key to order messages by
+	#
+	# \return Tuple; timestamp, sequence number and address of sender
+	def sort_key(self):
+		return (self.timestamp, self.seq, self.user)
+
+
 def is_message(content):
 	return rMsg.search(content) != None
+
+
+
+## \brief Create room notice
+#
+# A room notice tells a participant that the sender has posted a new update to a room, so it can be retrieved right away
+#
+# Format is notice marker, 1 byte length of room name, room name and swarm hash of the update
+#
+# \param name Room name
+# \param hsh Swarm hash of update, binary format
+# \return Notice data to send by pss
+# \exception ValueError if name or hash is invalid
+def new_room_notice(name, hsh):
+	if len(name) == 0 or len(name) > 255:
+		raise ValueError("invalid room name")
+	if len(hsh) != 32:
+		raise ValueError("invalid hash")
+	return MESSAGE_ROOM_NOTICE + chr(len(name)) + name + hsh
+
+
+
+## \brief Check if pss message is room notice
+#
+# \param content Raw pss message content
+# \return True if room notice
+def is_room_notice(content):
+	return content[:len(MESSAGE_ROOM_NOTICE)] == MESSAGE_ROOM_NOTICE
+
+
+
+## \brief Parse room notice
+#
+# \param content Raw pss message content
+# \return Tuple; room name and swarm hash of update, binary format
+# \exception ValueError if not a valid room notice
+# \see new_room_notice
+def parse_room_notice(content):
+	if not is_room_notice(content):
+		raise ValueError("not a room notice")
+	crsr = len(MESSAGE_ROOM_NOTICE)
+	if len(content) < crsr + 1:
+		raise ValueError("invalid room notice")
+	namelength = ord(content[crsr])
+	crsr += 1
+	if namelength == 0 or len(content) != crsr + namelength + 32:
+		raise ValueError("invalid room notice length")
+	return (content[crsr:crsr+namelength], content[crsr+namelength:])
@@ -1,13 +1,34 @@
 import websocket
+import sys
+import collections
 
 from tools import clean_pubkey, clean_overlay, rpchex
 from error import *
 from content import rpc_call, rpc_parse
 from user import PssContact, Account
+from frame import FrameReader, FRAME_OP_PING
 
 # topic we will be using for this messenger service
 topic = "0xdeadbee2"
 
+# maximum peer registrations awaiting response from node
+PSS_ADD_WINDOW = 32
+
+# maximum messages awaiting response from node
+PSS_SEND_WINDOW = 16
+
+# maximum messages waiting to be sent, further sends are refused
+PSS_SEND_QUEUE_SIZE = 1024
+
+# times a message refused by the node for unknown recipient is sent again after registering the recipient
+PSS_SEND_RETRIES = 3
+
+
+# check if error response from node means the recipient is not registered
+# the node answers sendAsym to unknown key with "Invalid topic '<topic>' or address '<key>'"
+def is_recipient_error(err):
+	return "invalid topic" in str(err).lower()
+
 
 ## Handles connection and transactions for a pss node
 #
@@ -32,9 +53,34 @@ class Pss:
 		self.errstr = ""
 		self.seq = 0
 		self.ws = None
+		self.reader = None
 		self.run = False
 		self.sub = ""
 
+		# request id => callback for requests awaiting response
+		self.pending = {}
+
+		# subscription notifications received but not yet returned by read()
+		self.notifications = []
+
+		# public keys of peers registered with node in this session
+		self.peers = set()
+
+		# peer registrations waiting to be sent, and progress of current batch
+		self.addqueue = collections.deque()
+		self.addwindow = PSS_ADD_WINDOW
+		self.addprogress = None
+		self.adding = 0
+		self.addcount = 0
+		self.addtotal = 0
+
+		# outgoing messages waiting to be sent, and messages sent awaiting response
+		# each entry is a list of contact, message and callback
+		self.sendqueue = collections.deque()
+		self.sending = []
+		self.sendwindow = PSS_SEND_WINDOW
+		self.sendqueuesize = PSS_SEND_QUEUE_SIZE
+
 
 
 	def can_write(self):
@@ -68,12 +114,27 @@ class Pss:
 
 
 	# open sockets and get initial data
+	# the requests for node address, node key and subscription are sent at once, and the responses are matched by id
 	def connect(self):
 
 		overlay = ""
 		key = ""
 
+		self._requeue()
+		if self.ws != None:
+			try:
+				self.ws.close()
+			except Exception as e:
+				pass
 		self.ws = None
+		self.reader = None
+		self.pending = {}
+		self.notifications = []
+		self.peers = set()
+		self.addqueue.clear()
+		self.adding = 0
+		self.addcount = 0
+		self.addtotal = 0
 		try:
 			self.ws = websocket.create_connection("ws://" + self.host + ":" + self.port)
 		except Exception as e:
@@ -81,45 +142,57 @@ class Pss:
 			self.errstr = "could not connect to pss " + self.name + " on " + self.host + ":" + self.port + ": " + repr(e)
 			return False
 
-		# get the node adress	
-		self.ws.send(rpc_call(self.seq, "baseAddr", []))
-		self.seq += 1
-		resp = rpc_parse(self.ws.recv())
+		results = {}
+		def keep(name):
+			def done(result, err):
+				results[name] = (result, err)
+			return done
+
+		# get the node address, node key and subscribe to incoming
+		try:
+			self.call("baseAddr", [], keep("overlay"))
+			self.call("getPublicKey", [], keep("key"))
+			self.call("subscribe", ['receive', topic, False, False], keep("sub"))
+			while len(self.pending) > 0:
+				self._dispatch(self.ws.recv())
+		except Exception as e:
+			self.err = PSS_ESOCK
+			self.errstr = "initial requests to pss " + self.name + " failed: " + repr(e)
+			return False
+
+		for (name, (result, err)) in results.iteritems():
+			if err != None:
+				self.err = PSS_EREMOTEINVAL
+				self.errstr = "request for " + name + " failed: " + str(err)
+				return False
 
 		# verify address
 		try:
-			overlay = clean_overlay(resp['result']).decode("hex")
-		except ValueError as e:
+			overlay = clean_overlay(results['overlay'][0]).decode("hex")
+		except (ValueError, TypeError) as e:
 			self.err = PSS_EREMOTEINVAL
-			self.errstr = "received bogus base address " + resp['result']
+			self.errstr = "received bogus base address " + repr(results['overlay'][0])
 			return False
 		
-		# retrieve the node key	data
-		self.ws.send(rpc_call(self.seq, "getPublicKey", []))
-		self.seq += 1
-		resp = rpc_parse(self.ws.recv())
-	
 		# verify key
 		try: 
-			key = clean_pubkey(resp['result']).decode("hex")
-		except ValueError as e:
+			key = clean_pubkey(results['key'][0]).decode("hex")
+		except (ValueError, TypeError) as e:
 			self.err = PSS_EREMOTEINVAL
-			self.errstr = "received bogus pubkey " + resp['result']
+			self.errstr = "received bogus pubkey " + repr(results['key'][0])
 			return False
 
-		# subscribe to incoming
-		self.ws.send(rpc_call(self.seq, "subscribe", ['receive', topic, False, False]))
-		self.seq += 1
-		resp = rpc_parse(self.ws.recv())
-		self.sub = resp['result']
+		self.sub = results['sub'][0]
 
 		# now we're in the clear
 		# finish setting up object properties
 		self.account.set_public_key(key)
 		self.overlay = overlay
+		self.reader = FrameReader(self.ws.sock)
 		self.connected = True
 		self.run = True
 
+		# queued messages are sent as their recipients are registered again with add or add_many
 		return True
 
 
@@ -145,33 +218,307 @@ class Pss:
 
 	
 
+	## \brief Send json-rpc request to node
+	#
+	# The request is written immediately; the response is routed to the callback when it is received by read(). Any number of requests may be in progress at once.
+	#
+	# If no callback is given, an error response is recorded as the last error of the object.
+	#
+	# \param method Method name without pss_ prefix
+	# \param args List of method parameters
+	# \param callback Function to call with result and error on response; result is None on error
+	# \return Request id
+	# \exception IOError if there is no connection
+	def call(self, method, args, callback=None):
+		if self.ws == None:
+			raise IOError("not connected")
+		callid = self.seq
+		self.seq += 1
+		self.pending[callid] = callback
+		try:
+			self.ws.send(rpc_call(callid, method, args))
+		except Exception as e:
+			del self.pending[callid]
+			raise IOError("send fail: " + repr(e))
+		return callid
+
+
+
 	# adds recipient to node
-	def add(self, contact):
+	def add(self, contact, callback=None):
 
 		# no use if we're not connected
-		# \todo use exception instead
 		if self.ws == None or not self.connected:
 			raise IOError("not connected")
 
 		# add to node and object cache
 		pubkeyhx = rpchex(contact.get_public_key())
 		overlayhx = rpchex(contact.get_overlay())
-		self.ws.send(rpc_call(self.seq, "setPeerPublicKey", [pubkeyhx, topic, overlayhx]))
-		#self.ws.recv()
-		self.seq += 1
+		def done(result, err):
+			if err == None:
+				self.peers.add(contact.get_public_key())
+			if callback != None:
+				callback(result, err)
+			elif err != None:
+				self.err = PSS_EREMOTEINVAL
+				self.errstr = str(err)
+			if err == None:
+				self._send_next()
+		return self.call("setPeerPublicKey", [pubkeyhx, topic, overlayhx], done)
+
+
+	## \brief Register many recipients with node
+	#
+	# Registrations are pipelined; at most window requests await response from the node at any time, and the next is sent as each response is received by read(). Contacts already registered in this session, or already waiting to be, are skipped.
+	#
+	# If called while a previous batch is in progress, the contacts are added to that batch.
+	#
+	# \param contacts List of PssContact to register
+	# \param progress Function to call with number of completed registrations and total in batch after each response
+	# \param window Maximum requests awaiting response, default PSS_ADD_WINDOW
+	# \return Number of contacts queued for registration
+	# \exception IOError if not connected
+	def add_many(self, contacts, progress=None, window=None):
+		if self.ws == None or not self.connected:
+			raise IOError("not connected")
+
+		if window != None:
+			self.addwindow = window
+		if progress != None:
+			self.addprogress = progress
+
+		queued = set([c.get_public_key() for c in self.addqueue])
+		n = 0
+		for c in contacts:
+			k = c.get_public_key()
+			if k in self.peers or k in queued:
+				continue
+			self.addqueue.append(c)
+			queued.add(k)
+			n += 1
+
+		self.addtotal += n
+		self._add_next()
+		return n
+
+
+	## \brief Number of peer registrations not yet completed
+	#
+	# \return Count of queued and sent registrations
+	def adds_pending(self):
+		return len(self.addqueue) + self.adding
+
+
+	# send queued peer registrations until window is full
+	def _add_next(self):
+		while self.adding < self.addwindow and len(self.addqueue) > 0:
+			contact = self.addqueue.popleft()
+			self.adding += 1
+			try:
+				self.add(contact, self._added)
+			except IOError as e:
+				self._added(None, e)
+
+
+	# handle response to peer registration in batch
+	def _added(self, result, err):
+		self.adding -= 1
+		self.addcount += 1
+		if err != None:
+			sys.stderr.write("peer registration failed: " + str(err) + "\n")
+		if self.addprogress != None:
+			self.addprogress(self.addcount, self.addtotal)
+		if self.adding == 0 and len(self.addqueue) == 0:
+			self.addcount = 0
+			self.addtotal = 0
+			self.addprogress = None
+			return
+		self._add_next()
+
+
+	## \brief Send message to registered recipient
+	#
+	# Messages are queued, and sent in order with at most the send window awaiting response from the node at any time. While not connected, messages are kept until the next successful connect.
+	#
+	# A message is held in the queue until its recipient has been registered with the node in the current connection, using add() or add_many(). If the node refuses a message because it doesn't know the recipient, the recipient is registered again and the message is sent again, up to PSS_SEND_RETRIES times.
+	#
+	# Messages whose response was not received before the connection was lost are sent again, so a message may be delivered more than once.
+	#
+	# \param contact PssContact to send to
+	# \param msg Message to send
+	# \param callback Function to call with result and error when the node responds
+	# \exception IOError if the send queue is full
+	def send(self, contact, msg, callback=None):
+		if len(self.sendqueue) >= self.sendqueuesize:
+			raise IOError("send queue full")
+		# recipient, message, callback, retries, id of request in progress
+		self.sendqueue.append([contact, msg, callback, 0, None])
+		self._send_next()
+
+
+	## \brief Send notice to registered recipient, bypassing the send queue
+	#
+	# For messages that are only useful right away, such as room update notices. The notice is sent immediately and does not count against the send window. If not connected, it is dropped.
+	#
+	# \param contact PssContact to send to
+	# \param msg Notice to send
+	# \exception IOError if not connected
+	def send_notice(self, contact, msg):
+		if not self.connected:
+			raise IOError("not connected")
+
+		def sent(result, err):
+			if err != None:
+				sys.stderr.write("notice to " + rpchex(contact.get_public_key()) + " failed: " + str(err) + "\n")
+
+		self.call("sendAsym", [rpchex(contact.get_public_key()), topic, "0x" + msg.encode("hex")], sent)
+
+
+	## \brief Number of messages not yet confirmed by node
+	#
+	# \return Count of queued and sent messages
+	def send_backlog(self):
+		return len(self.sendqueue) + len(self.sending)
 
 
-	# send message to registered recipient
-	def send(self, contact, msg):
+	## \brief Check if node is keeping up with outgoing messages
+	#
+	# \return False if more messages are queued than fit in the send window
+	def send_ready(self):
+		return len(self.sendqueue) < self.sendwindow
 
-		# check if we have connection
-		# \todo store outgoing messages until online on temporary network loss
+
+	# send queued messages until window is full
+	# messages to recipients not yet registered in this connection stay in the queue, in order
+	def _send_next(self):
+		if not self.connected:
+			return
+		held = collections.deque()
+		while len(self.sending) < self.sendwindow and len(self.sendqueue) > 0:
+			item = self.sendqueue.popleft()
+			contact = item[0]
+			if not contact.get_public_key() in self.peers:
+				held.append(item)
+				continue
+			self.sending.append(item)
+			try:
+				item[4] = self.call("sendAsym", [rpchex(contact.get_public_key()), topic, "0x" + item[1].encode("hex")], self._sent_callback(item))
+			except IOError as e:
+				sys.stderr.write("send fail, will retry on reconnect: " + str(e) + "\n")
+				self.connected = False
+				break
+		held.extend(self.sendqueue)
+		self.sendqueue = held
 		if not self.connected:
+			self._requeue()
+
+
+	# build callback handling response to sent message
+	def _sent_callback(self, item):
+		def sent(result, err):
+			if not item in self.sending:
+				return
+			self.sending.remove(item)
+
+			# node lost or never got the recipient, register it and hold its messages until then
+			# other messages to the recipient awaiting response will fail too, so they go back in the queue in order with this one
+			if err != None and is_recipient_error(err) and item[3] < PSS_SEND_RETRIES:
+				contact = item[0]
+				sys.stderr.write("recipient " + rpchex(contact.get_public_key()) + " not known by node, registering again: " + str(err) + "\n")
+				item[3] += 1
+				self.peers.discard(contact.get_public_key())
+				retry = [item] + [i for i in self.sending if i[0].get_public_key() == contact.get_public_key()]
+				self.sending = [i for i in self.sending if i[0].get_public_key() != contact.get_public_key()]
+				for i in reversed(retry):
+					# late response to the earlier request is ignored
+					if i[4] in self.pending:
+						self.pending[i[4]] = lambda result, err: None
+					self.sendqueue.appendleft(i)
+				try:
+					self.add_many([contact])
+				except IOError as e:
+					pass
+				self._send_next()
+				return
+
+			if item[2] != None:
+				item[2](result, err)
+			elif err != None:
+				self.err = PSS_EREMOTEINVAL
+				self.errstr = str(err)
+			self._send_next()
+		return sent
+
+
+	# return messages awaiting response to front of send queue
+	def _requeue(self):
+		for item in reversed(self.sending):
+			self.sendqueue.appendleft(item)
+		self.sending = []
+
+
+	## \brief Read all incoming messages available on websocket
+	#
+	# Does not block. Responses to requests are passed to their callbacks, and invalid messages are skipped. Pings from the node are answered. If the node closes the connection, the object is set to disconnected.
+	#
+	# \return Parsed subscription notifications, in order received
+	# \exception IOError if not connected, or on invalid data or socket error
+	def read(self):
+		if self.reader == None:
 			raise IOError("not connected")
 
-		# send the message
-		self.ws.send(rpc_call(self.seq, "sendAsym", [rpchex(contact.get_public_key()), topic, "0x" + msg.encode("hex")]))
-		self.seq += 1
+		for payload in self.reader.read():
+			try:
+				self._dispatch(payload)
+			except ValueError as e:
+				sys.stderr.write("skipping invalid receive: " + str(e) + "\n")
+
+		for (opcode, payload) in self.reader.control:
+			if opcode == FRAME_OP_PING and not self.reader.closed:
+				self.ws.pong(payload)
+		self.reader.control = []
+
+		if self.reader.closed:
+			self.connected = False
+			self._requeue()
+
+		msgs = self.notifications
+		self.notifications = []
+		return msgs
+
+
+
+	# pass response to callback of request, or keep subscription notification for read()
+	def _dispatch(self, payload):
+		r = rpc_parse(payload)
+		if not isinstance(r, dict):
+			raise ValueError("not a json object: " + repr(payload))
+
+		if r.get('method') == "pss_subscription":
+			self.notifications.append(r)
+			return
+
+		callid = r.get('id')
+		if not callid in self.pending:
+			raise ValueError("response to unknown request: " + repr(payload))
+		callback = self.pending.pop(callid)
+
+		result = r.get('result')
+		err = None
+		if r.get('error') != None:
+			msg = r['error']
+			if isinstance(msg, dict):
+				msg = msg.get('message', "")
+			err = IOError("rpc error: " + str(msg))
+			result = None
+
+		if callback != None:
+			callback(result, err)
+		elif err != None:
+			self.err = PSS_EREMOTEINVAL
+			self.errstr = str(err)
+			sys.stderr.write("request " + str(callid) + " failed: " + str(err) + "\n")
+
 
 
 	# retrieve last error from object
@@ -187,7 +534,9 @@ class Pss:
 
 
 	# close down connections
+	# messages not yet sent are kept for the next connect
 	def close(self):
 		self.connected = False
 		self.run = False
+		self._requeue()
 		self.ws.close()
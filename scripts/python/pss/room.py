@@ -6,7 +6,24 @@ import sys
 from user import PssContact, Account, publickey_to_address
 from bzz import FeedCollection, Feed, zerohsh, new_topic_mask
 from tools import clean_pubkey, clean_name, now_int, clean_hex
-from message import is_message
+from message import is_message, new_room_notice
+from schedule import Scheduler
+
+# version of binary participant list format
+ROOM_STATE_VERSION = 1
+
+# version of binary participant list delta format
+ROOM_STATE_DELTA_VERSION = 2
+
+# length of public keys in participant list
+ROOM_STATE_KEYSIZE = 65
+
+# number of participant list versions between full snapshots, the others are stored as deltas
+ROOM_SNAPSHOT_INTERVAL = 16
+
+# seconds between polls of participant feeds, which fall back to polling when room notices are missed
+ROOM_POLL_MIN_INTERVAL = 10.0
+ROOM_POLL_MAX_INTERVAL = 300.0
 
 
 class Participant(PssContact):
@@ -16,6 +33,195 @@ class Participant(PssContact):
 		self.trusted = trusted
 		PssContact.__init__(self, nick, src)
 
+## \brief Participant list of a room state
+#
+# Holds the public keys of the participants in the order of their entries in room updates, and an index from public key to position
+#
+# The participant list is stored in swarm in the following binary format, where p is number of participants and n is length of name:
+#
+# [0          ]: version
+# [1          ]: length of name n
+# [2 - 1+n    ]: name of room
+# [2+n - 66+n ]: public key of owner, zeros if not known
+# [67+n - 68+n]: number of participants p, big-endian
+# [69+n -     ]: p public keys of participants, 65 bytes each
+#
+# As the records are fixed-width, the key of any participant can be sliced directly from the data.
+#
+# Changes to the list may instead be stored as a delta to the previous version, with a full list (snapshot) every ROOM_SNAPSHOT_INTERVAL versions. The participants removed are taken out of the previous list, and the participants added are appended to it, keeping the order of the others. The delta format, where a is number of participants added and r is number of participants removed:
+#
+# [0               ]: version (delta)
+# [1 - 32          ]: swarm hash of previous participant list
+# [33 - 34         ]: number of participants added a, big-endian
+# [35 - 34+(a*65)  ]: public keys of participants added
+# [35+(a*65) - 36+(a*65)]: number of participants removed r, big-endian
+# [37+(a*65) -     ]: public keys of participants removed
+#
+# Participant lists stored by earlier versions are json objects, with keys "name", "pubkey" and "participants" holding the same data in hex. These are still accepted by parse().
+class ParticipantList:
+
+	## \param publickeys List of participant public keys, binary format
+	# \param name Name of room
+	# \param owner Public key of owner of the participant list, binary format
+	def __init__(self, publickeys, name="", owner=""):
+		self.keys = list(publickeys)
+		self.name = name
+		self.owner = owner
+
+		# number of deltas since last snapshot
+		self.depth = 0
+
+		self.slots = {}
+		for i in range(len(self.keys)):
+			self.slots[self.keys[i]] = i
+
+
+	## \brief Get previous participant list a delta applies to
+	#
+	# \param data Participant list data as stored in swarm
+	# \return Swarm hash of previous participant list, binary format. None if data is not a delta
+	# \exception ValueError if data is invalid
+	@staticmethod
+	def previous(data):
+		if len(data) == 0 or ord(data[0]) != ROOM_STATE_DELTA_VERSION:
+			return None
+		if len(data) < 33:
+			raise ValueError("invalid participant list delta")
+		return data[1:33]
+
+
+	## \brief Parse stored participant list
+	#
+	# \param data Participant list data as stored in swarm, binary or json
+	# \param previous ParticipantList object of previous participant list, required if data is a delta
+	# \return ParticipantList object
+	# \exception ValueError if data is invalid
+	# \see ParticipantList.serialize
+	# \see ParticipantList.previous
+	@staticmethod
+	def parse(data, previous=None):
+		if len(data) == 0:
+			raise ValueError("empty participant list")
+
+		if ord(data[0]) == ROOM_STATE_DELTA_VERSION:
+			if previous == None:
+				raise ValueError("previous participant list required for delta")
+			crsr = 33
+			records = []
+			for i in range(2):
+				if len(data) < crsr + 2:
+					raise ValueError("invalid participant list delta")
+				count = struct.unpack(">H", data[crsr:crsr+2])[0]
+				crsr += 2
+				if len(data) < crsr + (count * ROOM_STATE_KEYSIZE):
+					raise ValueError("invalid participant list delta length")
+				records.append([data[crsr+(j*ROOM_STATE_KEYSIZE):crsr+((j+1)*ROOM_STATE_KEYSIZE)] for j in range(count)])
+				crsr += count * ROOM_STATE_KEYSIZE
+			if len(data) != crsr:
+				raise ValueError("invalid participant list delta length")
+			removed = set(records[1])
+			participantlist = ParticipantList([k for k in previous.keys if not k in removed] + [k for k in records[0] if not k in previous.slots], previous.name, previous.owner)
+			participantlist.depth = previous.depth + 1
+			return participantlist
+
+		if data[0] == "{":
+			try:
+				r = json.loads(data)
+				return ParticipantList([clean_pubkey(k).decode("hex") for k in r['participants']], r['name'].encode("utf-8"), clean_pubkey(r['pubkey']).decode("hex"))
+			except (KeyError, TypeError, AttributeError) as e:
+				raise ValueError("invalid participant list: " + repr(e))
+
+		if ord(data[0]) != ROOM_STATE_VERSION:
+			raise ValueError("unknown participant list version " + str(ord(data[0])))
+		if len(data) < 2:
+			raise ValueError("invalid participant list")
+		crsr = 2 + ord(data[1])
+		if len(data) < crsr + ROOM_STATE_KEYSIZE + 2:
+			raise ValueError("invalid participant list header")
+		name = data[2:crsr]
+		owner = data[crsr:crsr+ROOM_STATE_KEYSIZE]
+		if owner == "\x00" * ROOM_STATE_KEYSIZE:
+			owner = ""
+		crsr += ROOM_STATE_KEYSIZE
+		count = struct.unpack(">H", data[crsr:crsr+2])[0]
+		crsr += 2
+		if len(data) != crsr + (count * ROOM_STATE_KEYSIZE):
+			raise ValueError("invalid participant list length")
+		keys = [data[crsr+(i*ROOM_STATE_KEYSIZE):crsr+((i+1)*ROOM_STATE_KEYSIZE)] for i in range(count)]
+		return ParticipantList(keys, name, owner)
+
+
+	## \brief Create participant list data
+	#
+	# \return Participant list in binary format
+	# \exception ValueError if name or keys don't fit the format
+	def serialize(self):
+		if len(self.name) > 255:
+			raise ValueError("room name too long")
+		if len(self.keys) > 0xffff:
+			raise ValueError("too many participants")
+
+		owner = self.owner
+		if owner == "":
+			owner = "\x00" * ROOM_STATE_KEYSIZE
+		data = chr(ROOM_STATE_VERSION) + chr(len(self.name)) + self.name
+		for k in [owner] + self.keys:
+			if len(k) != ROOM_STATE_KEYSIZE:
+				raise ValueError("invalid public key length " + str(len(k)))
+		data += owner
+		data += struct.pack(">H", len(self.keys))
+		data += "".join(self.keys)
+		return data
+
+
+	## \brief Create participant list delta
+	#
+	# \param prevhsh Swarm hash of previous participant list, binary format
+	# \param previous ParticipantList object of previous participant list
+	# \return Participant list delta in binary format
+	# \exception ValueError if keys don't fit the format
+	# \see ParticipantList.update
+	def serialize_delta(self, prevhsh, previous):
+		added = [k for k in self.keys if not k in previous.slots]
+		removed = [k for k in previous.keys if not k in self.slots]
+		data = chr(ROOM_STATE_DELTA_VERSION) + prevhsh
+		for records in [added, removed]:
+			if len(records) > 0xffff:
+				raise ValueError("too many participants")
+			for k in records:
+				if len(k) != ROOM_STATE_KEYSIZE:
+					raise ValueError("invalid public key length " + str(len(k)))
+			data += struct.pack(">H", len(records))
+			data += "".join(records)
+		return data
+
+
+	## \brief Create next version of participant list
+	#
+	# Participants not in the new list are removed and new participants are appended, so the list can be stored as a delta
+	#
+	# \param publickeys Public keys of participants in new version, binary format
+	# \return ParticipantList object
+	def update(self, publickeys):
+		current = set(publickeys)
+		participantlist = ParticipantList([k for k in self.keys if k in current] + [k for k in publickeys if not k in self.slots], self.name, self.owner)
+		participantlist.depth = self.depth
+		return participantlist
+
+
+	## \brief Position of participant in room updates
+	#
+	# \param publickey Public key of participant, binary format
+	# \return Index of participant, -1 if not in list
+	def slot(self, publickey):
+		return self.slots.get(publickey, -1)
+
+
+	def __len__(self):
+		return len(self.keys)
+
+
+
 ## Room represents a multi-user chat room
 #
 # A multi-user chat room is defined solely by a 1-32 byte name, within one single name space,
@@ -46,6 +252,9 @@ class Room:
 		self.bzz = bzz
 		self.participants = {}
 		self.hsh_room = ""
+
+		# current and historic participant lists, ParticipantList objects by swarm hash in binary
+		self.states = {}
 		
 
 	## \brief Activates room
@@ -57,7 +266,7 @@ class Room:
 	# \param srckey Public key to register for the outgoing feed for self
 	def start(self, nick, srckey=None):
 		senderfeed = Feed(self.bzz, self.feed_room.account, new_topic_mask(self.name, "", "\x06"))
-		self.feedcollection = FeedCollection("room:"+self.name, senderfeed)
+		self.feedcollection = FeedCollection("room:"+self.name, senderfeed, schedule=Scheduler(ROOM_POLL_MIN_INTERVAL, ROOM_POLL_MAX_INTERVAL))
 
 		participant = Participant(nick, srckey)
 		participant.set_from_account(self.feed_room.account)
@@ -104,20 +313,18 @@ class Room:
 	# \todo get output update head hash at time of load
 	# \todo evaluate whether these todos are stale :D
 	def load(self, hsh, owneraccount=None):
-		savedJson = self.bzz.get(hsh.encode("hex"))
-		#sys.stderr.write("savedj " + repr(savedJson) + " from hash " + hsh.encode("hex") + "\n")
+		participantlist = self.get_state(hsh)
 		self.hsh_room = hsh
-		r = json.loads(savedJson)
-		self.name = clean_name(r['name'])
+		self.name = clean_name(participantlist.name)
+		self.states[hsh] = participantlist
 
 		# outgoing feed user is room publisher
 		if owneraccount == None:
 			owneraccount = self.feed_room.account
 		senderfeed = Feed(self.bzz, owneraccount, new_topic_mask(self.name, "", "\x06"))
-		self.feedcollection = FeedCollection("room:"+self.name, senderfeed)
+		self.feedcollection = FeedCollection("room:"+self.name, senderfeed, schedule=Scheduler(ROOM_POLL_MIN_INTERVAL, ROOM_POLL_MAX_INTERVAL))
 
-		for pubkeyhx in r['participants']:
-			pubkey = clean_pubkey(pubkeyhx).decode("hex")
+		for pubkey in participantlist.keys:
 			nick = publickey_to_address(pubkey)
 			p = Participant(nick.encode("hex"), None)
 			p.set_public_key(pubkey)
@@ -148,6 +355,30 @@ class Room:
 
 
 
+	## \brief Add several participants to room
+	#
+	# All participants are added before the participant list is saved, so only one new version of the list is published
+	#
+	# Participants whose feed is already in the room are skipped
+	#
+	# \param participants List of tuples; name to add participant under, and Participant object
+	# \param save True; save participant list to swarm
+	# \return List of names of participants added
+	# \exception ValueError if Feed instantiate fails
+	def add_many(self, participants, save=True):
+		added = []
+		for (nick, participant) in participants:
+			if participant.nick in self.feedcollection.feeds:
+				sys.stderr.write("skipping already added participant '" + str(nick) + "'\n")
+				continue
+			self.add(nick, participant, False)
+			added.append(nick)
+		if save and len(added) > 0:
+			self.hsh_room = self.save()
+		return added
+
+
+
 	## \brief Create new update in room
 	#
 	# Adds a new update to the room feed.
@@ -157,6 +388,8 @@ class Room:
 	# 32 - (32+(p*3))	3 bytes data offset per participant
 	# (32+(p*3)) - 		tightly packed update data per participant, in order of offsets
 	# 
+	# the participants are in the order of the participant list the update points to
+	#
 	# if filters are used, zero-length update entries will be made for the participants filtered out
 	# \param msg Raw message data
 	# \param filtrdefaultallow True; activate filter
@@ -164,8 +397,9 @@ class Room:
 	# \todo implement content filtering
 	# \todo evaluate if fltrdefaultallow is needed (why not just empty array)
 	# \todo filtered content should be 0x800000 in content length instead (that would allow for updates up to 8MB, which is plenty more than should be posted
+	# \param notify Pss object to send room notice with to other participants, so they retrieve the update right away. If None or not connected no notices are sent
 	# \return Swarm chunk hash of update, binary format
-	def send(self, msg, fltrdefaultallow=True, fltr=[]):
+	def send(self, msg, fltrdefaultallow=True, fltr=[], notify=None):
 		if not is_message(msg):
 			raise ValueError("invalid message")
 
@@ -175,15 +409,22 @@ class Room:
 		update_body = ""
 		crsr = 0
 
-		for k, v in self.participants.iteritems():
+		bykey = {}
+		for (k, v) in self.participants.iteritems():
+			bykey[v.get_public_key()] = (k, v)
+
+		for publickey in self.get_state(self.hsh_room).keys:
+			(k, v) = bykey.get(publickey, (None, None))
 			ciphermsg = ""
 			filtered = False
-			if k in fltr and fltrdefaultallow:
+			if v == None:
+				filtered = True
+			elif k in fltr and fltrdefaultallow:
 				filtered = True
 			elif not fltrdefaultallow and not k in fltr:
 				filtered = True
 			if filtered:	
-				sys.stderr.write("Skipping filtered " + k) 
+				sys.stderr.write("Skipping filtered " + str(k)) 
 			else:
 				ciphermsg = v.encrypt_to(msg)
 
@@ -192,9 +433,38 @@ class Room:
 			crsr += len(ciphermsg)
 
 		hsh = self.feedcollection.write(update_header + update_body)
+
+		# notices are only useful right away, so they are not queued for later delivery
+		if notify != None and notify.connected:
+			notice = new_room_notice(self.name, hsh.decode("hex"))
+			for p in self.participants.values():
+				if p.get_public_key() == self.feedcollection.senderfeed.obj.account.get_public_key():
+					continue
+				try:
+					notify.send_notice(p, notice)
+				except IOError as e:
+					sys.stderr.write("room notice to " + p.get_public_key().encode("hex") + " failed: " + repr(e) + "\n")
+
 		return hsh
 
 
+
+	## \brief Handle room notice from participant
+	#
+	# The participant's feed will be retrieved from the announced update on next retrieval
+	#
+	# \param publickey Public key of sender of notice, binary format
+	# \param hsh Swarm hash of update, binary format
+	# \return True if sender is a participant of the room
+	# \see FeedCollection.hint
+	def notice(self, publickey, hsh):
+		for p in self.participants.values():
+			if p.get_public_key() == publickey:
+				self.feedcollection.hint(p.nick, hsh)
+				return True
+		return False
+
+
 	## Extract metadata from response body
 	#
 	# \param body Raw response body data to parse
@@ -211,6 +481,55 @@ class Room:
 		return hsh, tim, serial
 
 
+	## \brief Retrieve historic participant lists for a batch of updates
+	#
+	# Retrieves all participant lists referenced by the updates that differ from the current one, in a single pipelined request.
+	#
+	# \param bodies List of raw update data, as passed to extract_message
+	def prefetch_states(self, bodies):
+		hshs = []
+		for body in bodies:
+			hsh = body[:32]
+			if len(hsh) != 32 or hsh == self.hsh_room or hsh in self.states or hsh in hshs:
+				continue
+			hshs.append(hsh)
+
+		if len(hshs) == 0:
+			return
+
+		states = self.bzz.get_many([hsh.encode("hex") for hsh in hshs])
+		for i in range(len(hshs)):
+			if states[i] == None:
+				continue
+			try:
+				self.states[hshs[i]] = self._decode_state(states[i])
+			except (IOError, ValueError) as e:
+				sys.stderr.write("invalid participant list " + hshs[i].encode("hex") + ": " + repr(e) + "\n")
+
+
+
+	## \brief Get participant list of room state
+	#
+	# \param hsh Swarm hash of participant list, binary format
+	# \return ParticipantList object
+	# \exception ValueError if participant list is invalid
+	def get_state(self, hsh):
+		participantlist = self.states.get(hsh)
+		if participantlist == None:
+			participantlist = self._decode_state(self.bzz.get(hsh.encode("hex")))
+			self.states[hsh] = participantlist
+		return participantlist
+
+
+	# parse participant list, resolving previous versions if it's a delta
+	def _decode_state(self, data):
+		prevhsh = ParticipantList.previous(data)
+		if prevhsh == None:
+			return ParticipantList.parse(data)
+		return ParticipantList.parse(data, self.get_state(prevhsh))
+
+
+
 	## \brief Extract a participant's message
 	# 
 	# Extracts an update message matching the recipient pubkey
@@ -226,26 +545,10 @@ class Room:
 		payloadlength = 0
 		ciphermsg = ""
 
-		# if recipient list for the update matches the one in memory
-		# we use the position of the participant in the list as the body offset index
-		matchidx = -1
-		idx = 0
-		if self.hsh_room == body[:32]:
-			participantcount = len(self.participants)
-			for p in self.participants.values():
-				if p.get_public_key() == account.get_public_key():
-					matchidx = idx
-				idx += 1
-		# if not we need to retrieve the one that was relevant at the time of update
-		# and match the index against that
-		else:
-			roomhshhx = self.bzz.get(body[:32].encode("hex"))
-			savedroom = json.loads(roomhshhx)
-			participantcount = len(savedroom['participants'])
-			for p in savedroom['participants']:
-				if clean_hex(p) == clean_pubkey(account.get_public_key().encode("hex")):
-					matchidx = idx
-				idx += 1
+		# the position of the participant in the participant list the update points to is the body offset index
+		participantlist = self.get_state(body[:32])
+		participantcount = len(participantlist)
+		matchidx = participantlist.slot(account.get_public_key())
 
 		# if no matches then this pubkey is not relevant for the room at that particular update	
 		if matchidx == -1:
@@ -279,33 +582,47 @@ class Room:
 
 
 
+	## \brief Participant list of current participants
+	#
+	# \return ParticipantList object
+	def get_participant_list(self):
+		return ParticipantList([p.get_public_key() for p in self.participants.values()], self.name, self.feed_room.account.publickeybytes)
+
+
+
 	## \brief Create participant list data
 	#
 	# outputs the serialized format in which the room parameters are stored in swarm
 	#
-	# \return json string of participant list  
-	# \todo binary serialization instead of json
+	# \return participant list, binary format
+	# \see ParticipantList
 	def serialize(self):
-		jsonStr = """{
-	"name":\"""" + self.name + """\",
-	"pubkey":\"0x""" + self.feed_room.account.publickeybytes.encode("hex") + """\",
-	"participants":["""
-		#participantList = ""
-		for k, p in self.participants.iteritems():
-			jsonStr += "\"" + p.get_public_key().encode("hex") + "\",\n"
-		#	participantList += p.serialize()
-		jsonStr = jsonStr[0:len(jsonStr)-2]
-		jsonStr += """
-	]
-}"""
-		return jsonStr
+		return self.get_participant_list().serialize()
 
 
 	## Save current participant list to swarm
 	#	
+	# The list is saved as a delta to the previous list, or as a full snapshot every ROOM_SNAPSHOT_INTERVAL versions
+	#
 	# \return New swarm hash of participant list
 	def save(self):
-		s = self.serialize()
+		previous = None
+		if self.hsh_room != "":
+			previous = self.get_state(self.hsh_room)
+
+		participantlist = self.get_participant_list()
+		if previous == None:
+			s = participantlist.serialize()
+		else:
+			participantlist = previous.update(participantlist.keys)
+			if previous.depth + 1 < ROOM_SNAPSHOT_INTERVAL:
+				s = participantlist.serialize_delta(self.hsh_room, previous)
+				participantlist.depth = previous.depth + 1
+			else:
+				s = participantlist.serialize()
+				participantlist.depth = 0
+
 		self.hsh_room = self.bzz.add(s).decode("hex")
+		self.states[self.hsh_room] = participantlist
 		self.feed_room.update(self.hsh_room)
 		return self.hsh_room
@@ -0,0 +1,87 @@
+import time
+
+# default seconds between polls of a feed with recent activity
+SCHEDULE_MIN_INTERVAL = 1.0
+
+# default maximum seconds between polls of a quiet feed
+SCHEDULE_MAX_INTERVAL = 60.0
+
+# default factor the interval of a feed grows by for every poll without activity
+SCHEDULE_BACKOFF = 2.0
+
+
+## \brief Polling schedule for feeds
+#
+# Keeps track of when each feed is due to be polled. A feed which had new updates at the last poll is polled again after the minimum interval. For every poll without updates, the interval grows by the backoff factor until the maximum interval is reached.
+#
+# Feeds are identified by any hashable key. Feeds not yet known are always due.
+class Scheduler:
+
+	## \param mininterval Seconds between polls of active feeds
+	# \param maxinterval Maximum seconds between polls of quiet feeds
+	# \param backoff Factor to multiply interval with after poll without activity
+	def __init__(self, mininterval=SCHEDULE_MIN_INTERVAL, maxinterval=SCHEDULE_MAX_INTERVAL, backoff=SCHEDULE_BACKOFF):
+		self.mininterval = mininterval
+		self.maxinterval = maxinterval
+		self.backoff = backoff
+
+		# key => list of current interval and time of next poll
+		self.entries = {}
+
+
+	## \brief Check if feed should be polled
+	#
+	# \param key Feed key
+	# \param now Time to check against, current time if None
+	# \return True if due
+	def due(self, key, now=None):
+		if now == None:
+			now = time.time()
+		if not key in self.entries:
+			return True
+		return self.entries[key][1] <= now
+
+
+	## \brief Record the result of a poll
+	#
+	# \param key Feed key
+	# \param active True if the poll found new updates
+	# \param now Time of poll, current time if None
+	# \return Seconds until next poll
+	def polled(self, key, active, now=None):
+		if now == None:
+			now = time.time()
+		interval = self.mininterval
+		if not active and key in self.entries:
+			interval = min(self.entries[key][0] * self.backoff, self.maxinterval)
+		self.entries[key] = [interval, now + interval]
+		return interval
+
+
+	## \brief Make feeds due for polling immediately
+	#
+	# The interval is reset to the minimum, as activity is expected
+	#
+	# \param key Feed key, or None for all feeds
+	def force(self, key=None):
+		keys = self.entries.keys()
+		if key != None:
+			keys = [key]
+		for k in keys:
+			self.entries[k] = [self.mininterval, 0]
+
+
+	## \brief Stop tracking feed
+	#
+	# \param key Feed key
+	def remove(self, key):
+		self.entries.pop(key, None)
+
+
+	## \brief Time of next due poll
+	#
+	# \return Earliest time a feed is due, or None if no feeds are tracked
+	def next(self):
+		if len(self.entries) == 0:
+			return None
+		return min([e[1] for e in self.entries.values()])
@@ -0,0 +1,124 @@
+import os
+import mmap
+import struct
+import sys
+
+# record header; 32 byte binary swarm hash, 4 byte big-endian data length
+CHUNKSTORE_HEADER_SIZE = 36
+
+# default maximum size of segment file in bytes, 0 for no limit
+CHUNKSTORE_MAX_SIZE = 256 * 1024 * 1024
+
+
+## \brief Persistent store of swarm chunks
+#
+# Chunks are appended to a single segment file, each as a record of the binary swarm hash, the data length and the data itself. The file is never rewritten.
+#
+# An index of hash to record offset is built by scanning the file on open. Reads are done through a memory map of the file, which is extended when records beyond the mapped region are read. The data returned by a read is a copy, as the map is replaced when extended.
+#
+# As records are never removed, the file only grows. When it reaches the maximum size, further chunks are not stored.
+#
+# A record that was cut short by a crash is truncated on open.
+class ChunkStore:
+
+	## \param path Path to segment file, created if it does not exist
+	# \param maxsize Maximum size of segment file in bytes, 0 for no limit
+	def __init__(self, path, maxsize=CHUNKSTORE_MAX_SIZE):
+		self.path = path
+		self.maxsize = maxsize
+		self.index = {}
+		self.map = None
+		self.mapsize = 0
+		self.file = open(path, "a+b")
+		self.size = self._scan()
+		self._remap()
+
+
+	# build index from records in file
+	# returns offset of end of last complete record
+	def _scan(self):
+		self.file.seek(0)
+		crsr = 0
+		while True:
+			header = self.file.read(CHUNKSTORE_HEADER_SIZE)
+			if len(header) < CHUNKSTORE_HEADER_SIZE:
+				break
+			length = struct.unpack(">I", header[32:])[0]
+			self.file.seek(length, os.SEEK_CUR)
+			if self.file.tell() > os.fstat(self.file.fileno()).st_size:
+				break
+			self.index[header[:32].encode("hex")] = (crsr + CHUNKSTORE_HEADER_SIZE, length)
+			crsr += CHUNKSTORE_HEADER_SIZE + length
+
+		if crsr < os.fstat(self.file.fileno()).st_size:
+			sys.stderr.write("truncating incomplete chunk record at " + str(crsr) + " in " + self.path + "\n")
+			self.file.truncate(crsr)
+		return crsr
+
+
+	def _remap(self):
+		if self.map != None:
+			self.map.close()
+			self.map = None
+		self.mapsize = self.size
+		if self.size > 0:
+			self.map = mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ)
+
+
+	## Check if chunk is stored
+	#
+	# \param hsh Swarm hash, hex format
+	def has(self, hsh):
+		return hsh in self.index
+
+
+	## Get stored chunk
+	#
+	# The data is copied out of the memory map
+	#
+	# \param hsh Swarm hash, hex format
+	# \return Chunk data, or None if not stored
+	def get(self, hsh):
+		try:
+			(offset, length) = self.index[hsh]
+		except KeyError:
+			return None
+		if offset + length > self.mapsize:
+			self._remap()
+		return self.map[offset:offset+length]
+
+
+	## Store chunk
+	#
+	# Chunks already stored are ignored, as are chunks that would take the file beyond its maximum size
+	#
+	# \param hsh Swarm hash, hex format
+	# \param data Chunk data
+	# \return True if chunk is stored
+	# \exception ValueError if hash is not a 32 byte hex hash
+	def put(self, hsh, data):
+		if hsh in self.index:
+			return True
+		hshbytes = hsh.decode("hex")
+		if len(hshbytes) != 32:
+			raise ValueError("invalid chunk hash " + repr(hsh))
+		if self.maxsize > 0 and self.size + CHUNKSTORE_HEADER_SIZE + len(data) > self.maxsize:
+			return False
+		self.file.seek(0, os.SEEK_END)
+		self.file.write(hshbytes + struct.pack(">I", len(data)) + data)
+		self.file.flush()
+		self.index[hsh] = (self.size + CHUNKSTORE_HEADER_SIZE, len(data))
+		self.size += CHUNKSTORE_HEADER_SIZE + len(data)
+		return True
+
+
+	## Number of chunks stored
+	def count(self):
+		return len(self.index)
+
+
+	def close(self):
+		if self.map != None:
+			self.map.close()
+			self.map = None
+		self.file.close()
@@ -0,0 +1,203 @@
+#!/usr/bin/python2
+
+import unittest
+import socket
+import json
+
+from pss.pss import Pss
+from pss.frame import FrameReader
+from pss.user import PssContact
+from frame_test import frame
+
+
+# records requests instead of writing them to websocket
+class FakeWebsocket:
+
+	def __init__(self):
+		self.sent = []
+
+
+	def send(self, data):
+		self.sent.append(json.loads(data))
+
+
+
+class TestPss(unittest.TestCase):
+
+
+	def setUp(self):
+		(self.sock, peer) = socket.socketpair()
+		self.pss = Pss("test")
+		self.pss.ws = FakeWebsocket()
+		self.pss.reader = FrameReader(peer)
+		self.pss.connected = True
+
+
+	def tearDown(self):
+		self.sock.close()
+		self.pss.reader.sock.close()
+
+
+	def reply(self, obj):
+		self.sock.sendall(frame(json.dumps(obj)))
+
+
+	# responses go to callbacks by id in any order, notifications are returned
+	def test_dispatch(self):
+		results = {}
+		def keep(result, err):
+			results[result] = err
+
+		contact = PssContact("foo", "")
+		contact.set_public_key("\x04" + "\x01" * 64)
+		contact.set_overlay("")
+		self.pss.peers.add(contact.get_public_key())
+		self.pss.send(contact, "hello", keep)
+		self.pss.send(contact, "world", keep)
+		self.assertEqual(self.pss.ws.sent[1]['method'], "pss_sendAsym")
+		first = self.pss.ws.sent[0]['id']
+		second = self.pss.ws.sent[1]['id']
+
+		notification = {"jsonrpc": "2.0", "method": "pss_subscription", "params": {"result": {"Msg": "0x00"}}}
+		self.reply({"jsonrpc": "2.0", "id": second, "result": "two"})
+		self.reply(notification)
+		self.reply({"jsonrpc": "2.0", "id": 666, "result": None})
+		self.reply({"jsonrpc": "2.0", "id": first, "error": {"code": -32000, "message": "no such peer"}})
+		self.assertEqual(self.pss.read(), [notification])
+		self.assertEqual(results["two"], None)
+		self.assertEqual(str(results[None]), "rpc error: no such peer")
+		self.assertEqual(len(self.pss.pending), 0)
+
+
+	# errors without callback are kept as last error
+	def test_error(self):
+		callid = self.pss.call("setPeerPublicKey", [])
+		self.reply({"jsonrpc": "2.0", "id": callid, "error": {"code": -32000, "message": "invalid"}})
+		self.assertEqual(self.pss.read(), [])
+		self.assertEqual(self.pss.error()['description'], "rpc error: invalid")
+
+
+
+	def ok(self, request):
+		self.reply({"jsonrpc": "2.0", "id": request['id'], "result": True})
+
+
+	# registrations are sent within window, and registered peers are skipped later
+	def test_add_many(self):
+		contacts = []
+		for i in range(5):
+			contact = PssContact(str(i), "")
+			contact.set_public_key("\x04" + chr(i) * 64)
+			contact.set_overlay("")
+			contacts.append(contact)
+		progress = []
+		def report(count, total):
+			progress.append((count, total))
+
+		self.assertEqual(self.pss.add_many(contacts + contacts[:1], report, 2), 5)
+		self.assertEqual(len(self.pss.ws.sent), 2)
+		self.assertEqual(self.pss.adds_pending(), 5)
+
+		for i in range(5):
+			self.ok(self.pss.ws.sent[i])
+			self.pss.read()
+		self.assertEqual(progress, [(1, 5), (2, 5), (3, 5), (4, 5), (5, 5)])
+		self.assertEqual(self.pss.adds_pending(), 0)
+		self.assertEqual(len(self.pss.peers), 5)
+
+		self.assertEqual(self.pss.add_many(contacts), 0)
+		self.assertEqual(len(self.pss.ws.sent), 5)
+
+
+
+	# messages are held while disconnected, sent within window, and sent again if unconfirmed on disconnect
+	def test_send_queue(self):
+		contact = PssContact("foo", "")
+		contact.set_public_key("\x04" + "\x01" * 64)
+		contact.set_overlay("")
+		self.pss.peers.add(contact.get_public_key())
+		self.pss.sendwindow = 2
+		self.pss.sendqueuesize = 4
+		self.pss.connected = False
+
+		for i in range(4):
+			self.pss.send(contact, str(i))
+		self.assertRaises(IOError, self.pss.send, contact, "4")
+		self.assertEqual(len(self.pss.ws.sent), 0)
+		self.assertFalse(self.pss.send_ready())
+
+		self.pss.connected = True
+		self.pss._send_next()
+		self.assertEqual(len(self.pss.ws.sent), 2)
+		self.ok(self.pss.ws.sent[0])
+		self.assertEqual(self.pss.read(), [])
+		self.assertEqual(len(self.pss.ws.sent), 3)
+		self.assertEqual(self.pss.send_backlog(), 3)
+
+		# connection lost, unconfirmed messages go first on reconnect
+		self.pss.connected = False
+		self.pss._requeue()
+		self.pss.pending = {}
+		self.pss.connected = True
+		self.pss._send_next()
+		msgs = [r['params'][2] for r in self.pss.ws.sent]
+		self.assertEqual(msgs, ["0x30", "0x31", "0x32", "0x31", "0x32"])
+
+
+
+	# messages are held until recipient is registered, and registered again if the node doesn't know it
+	def test_send_unregistered(self):
+		contact = PssContact("foo", "")
+		contact.set_public_key("\x04" + "\x01" * 64)
+		contact.set_overlay("")
+		results = []
+		def keep(result, err):
+			results.append(result)
+		for i in range(3):
+			self.pss.send(contact, str(i), keep)
+		self.assertEqual(len(self.pss.ws.sent), 0)
+
+		self.pss.add(contact)
+		self.ok(self.pss.ws.sent[0])
+		self.pss.read()
+		self.assertEqual([r['method'] for r in self.pss.ws.sent], ["pss_setPeerPublicKey"] + ["pss_sendAsym"] * 3)
+
+		# node lost the registration, all messages wait for it and go again in order
+		self.reply({"jsonrpc": "2.0", "id": self.pss.ws.sent[1]['id'], "error": {"code": -32000, "message": "Invalid topic '0xdeadbee2' or address '0x04'"}})
+		self.pss.read()
+		self.assertEqual(self.pss.ws.sent[4]['method'], "pss_setPeerPublicKey")
+		self.assertEqual(len(self.pss.ws.sent), 5)
+		self.assertEqual(len(self.pss.sendqueue), 3)
+		self.reply({"jsonrpc": "2.0", "id": self.pss.ws.sent[2]['id'], "result": "late"})
+		self.ok(self.pss.ws.sent[4])
+		self.pss.read()
+		self.assertEqual([r['params'][2] for r in self.pss.ws.sent[5:]], ["0x30", "0x31", "0x32"])
+		for r in self.pss.ws.sent[5:]:
+			self.ok(r)
+		self.pss.read()
+		self.assertEqual(results, [True, True, True])
+		self.assertEqual(self.pss.send_backlog(), 0)
+
+
+	# notices bypass the send queue, and are dropped when not connected
+	def test_send_notice(self):
+		contact = PssContact("foo", "")
+		contact.set_public_key("\x04" + "\x01" * 64)
+		contact.set_overlay("")
+		self.pss.peers.add(contact.get_public_key())
+		self.pss.sendwindow = 1
+		self.pss.send(contact, "queued")
+		self.pss.send(contact, "waiting")
+		self.pss.send_notice(contact, "notice")
+		self.assertEqual([r['params'][2] for r in self.pss.ws.sent], ["0x" + "queued".encode("hex"), "0x" + "notice".encode("hex")])
+		self.assertEqual(self.pss.send_backlog(), 2)
+
+		self.pss.connected = False
+		self.assertRaises(IOError, self.pss.send_notice, contact, "notice")
+		self.pss._requeue()
+		self.assertEqual(len(self.pss.sendqueue), 2)
+
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,130 @@
+#!/usr/bin/python2
+
+import unittest
+import struct
+
+from pss.bzz import Bzz, FeedCollection
+from pss.user import Account
+from pss.room import Room, Participant, ParticipantList, ROOM_SNAPSHOT_INTERVAL
+from bzz_test import FakeAgent
+
+
+class TestRoom(unittest.TestCase):
+
+
+	def setUp(self):
+		self.bzz = Bzz(FakeAgent())
+		self.accounts = []
+		for i in range(3):
+			acc = Account()
+			acc.set_key(chr(i+1) * 32)
+			self.accounts.append(acc)
+		self.room = Room(self.bzz, "fooroom", self.accounts[0])
+		for i in range(len(self.accounts)):
+			p = Participant(str(i), None)
+			p.set_public_key(self.accounts[i].get_public_key())
+			self.room.participants[str(i)] = p
+
+
+	# stored participant list is parsed into public key index
+	def test_participant_list(self):
+		participantlist = ParticipantList.parse(self.room.serialize())
+		self.assertEqual(len(participantlist), 3)
+		for acc in self.accounts:
+			self.assertEqual(participantlist.keys[participantlist.slot(acc.get_public_key())], acc.get_public_key())
+		self.assertEqual(participantlist.slot("\x04" * 65), -1)
+		self.assertEqual(participantlist.name, "fooroom")
+		self.assertEqual(participantlist.owner, self.accounts[0].get_public_key())
+		self.assertRaises(ValueError, ParticipantList.parse, "{}")
+		self.assertRaises(ValueError, ParticipantList.parse, self.room.serialize()[:-1])
+
+
+	# participant lists stored as json by earlier versions can still be read
+	def test_participant_list_json(self):
+		data = """{
+	"name":"fooroom",
+	"pubkey":"0x""" + self.accounts[0].get_public_key().encode("hex") + """",
+	"participants":[""" + ",".join(["\"" + acc.get_public_key().encode("hex") + "\"" for acc in self.accounts]) + """]
+}"""
+		participantlist = ParticipantList.parse(data)
+		self.assertEqual(participantlist.keys, [acc.get_public_key() for acc in self.accounts])
+		self.assertEqual(participantlist.name, "fooroom")
+		self.assertEqual(ParticipantList.parse(participantlist.serialize()).keys, participantlist.keys)
+		self.assertTrue(len(participantlist.serialize()) < len(data) / 2)
+
+
+	# messages are extracted by position in the participant list the update points to
+	def test_extract_message(self):
+		hsh = self.bzz.add(self.room.serialize()).decode("hex")
+		participantlist = ParticipantList.parse(self.bzz.get(hsh.encode("hex")))
+		body = hsh
+		for i in range(len(participantlist)):
+			body += struct.pack("<I", i*3)[:3]
+		for k in participantlist.keys:
+			body += str(participantlist.keys.index(k)) * 3
+
+		for acc in self.accounts:
+			idx = participantlist.slot(acc.get_public_key())
+			self.assertEqual(self.room.extract_message(body, acc), str(idx) * 3)
+		self.assertEqual(self.room.states[hsh].keys, participantlist.keys)
+
+		acc = Account()
+		acc.set_key("\x2a" * 32)
+		self.assertRaises(ValueError, self.room.extract_message, body, acc)
+
+
+
+	# participants added together are saved once
+	def test_add_many(self):
+		saves = []
+		self.room.participants = {}
+		self.room.feedcollection = FeedCollection("room:fooroom")
+		self.room.save = lambda: saves.append(self.room.serialize())
+		participants = []
+		for i in range(len(self.accounts)):
+			p = Participant(str(i), None)
+			p.set_public_key(self.accounts[i].get_public_key())
+			participants.append((str(i), p))
+		self.assertEqual(self.room.add_many(participants[:2]), ["0", "1"])
+		self.assertEqual(self.room.add_many(participants), ["2"])
+		self.assertEqual(len(saves), 2)
+		self.assertEqual(len(ParticipantList.parse(saves[1])), 3)
+
+
+	# membership changes are stored as deltas, and any version can be rebuilt from the last snapshot
+	def test_delta(self):
+		saves = []
+		self.room.feed_room.update = lambda hsh: saves.append(hsh)
+		self.room.participants = {}
+		self.room.feedcollection = FeedCollection("room:fooroom")
+		for i in range(len(self.accounts)):
+			p = Participant(str(i), None)
+			p.set_public_key(self.accounts[i].get_public_key())
+			self.room.add(str(i), p)
+		self.room.remove("1")
+
+		room = Room(self.bzz, "fooroom", self.accounts[0])
+		for i in range(len(saves)):
+			data = self.bzz.get(saves[i].encode("hex"))
+			self.assertEqual(ParticipantList.previous(data), (saves[i-1] if i > 0 else None))
+			self.assertTrue(len(data) < 150)
+		participantlist = room.get_state(saves[-1])
+		self.assertEqual(participantlist.keys, [self.accounts[0].get_public_key(), self.accounts[2].get_public_key()])
+		self.assertEqual(participantlist.name, "fooroom")
+		self.assertEqual(len(room.get_state(saves[1])), 2)
+		self.assertRaises(ValueError, ParticipantList.parse, self.bzz.get(saves[-1].encode("hex")))
+
+		# snapshot after interval
+		for i in range(ROOM_SNAPSHOT_INTERVAL / 2):
+			nick = str((i % 2) * 2)
+			self.room.remove(nick)
+			p = Participant(nick, None)
+			p.set_public_key(self.accounts[int(nick)].get_public_key())
+			self.room.add(nick, p)
+		depths = [self.room.get_state(hsh).depth for hsh in saves]
+		self.assertEqual(depths.count(0), 2)
+		self.assertEqual(room.get_state(saves[-1]).keys, self.room.get_state(saves[-1]).keys)
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/python2
+
+import unittest
+
+from pss.schedule import Scheduler
+
+
+class TestScheduler(unittest.TestCase):
+
+
+	def setUp(self):
+		self.schedule = Scheduler(1.0, 8.0, 2.0)
+
+
+	# quiet feeds back off up to the maximum, active feeds are polled at minimum interval
+	def test_backoff(self):
+		self.assertTrue(self.schedule.due("foo", 0))
+		self.assertEqual(self.schedule.polled("foo", False, 0), 1.0)
+		self.assertFalse(self.schedule.due("foo", 0.5))
+		self.assertTrue(self.schedule.due("foo", 1.0))
+		for interval in [2.0, 4.0, 8.0, 8.0]:
+			self.assertEqual(self.schedule.polled("foo", False, 0), interval)
+		self.assertEqual(self.schedule.polled("foo", True, 0), 1.0)
+
+
+	def test_force(self):
+		self.schedule.polled("foo", False, 100)
+		self.schedule.polled("bar", False, 100)
+		self.schedule.force("foo")
+		self.assertTrue(self.schedule.due("foo", 100))
+		self.assertFalse(self.schedule.due("bar", 100))
+		self.schedule.force()
+		self.assertTrue(self.schedule.due("bar", 100))
+		self.assertEqual(self.schedule.next(), 0)
+
+
+
+if __name__ == "__main__":
+	unittest.main()
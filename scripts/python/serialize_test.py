@@ -6,7 +6,7 @@ import random
 import json
 import socket
 
-from pss.room import Participant
+from pss.room import Participant, ParticipantList
 
 # \todo one source of keys across test files
 
@@ -68,9 +68,10 @@ class TestSerialize(unittest.TestCase):
 
 		s = r.serialize()
 		try:
-			roomobj = json.loads(s)
+			participantlist = ParticipantList.parse(s)
 		except ValueError as e:
-			self.fail("json deserialize error: " + (str(e)))
+			self.fail("participant list deserialize error: " + (str(e)))
+		self.assertEqual(len(participantlist), len(self.pubkey))
 
 
 if __name__ == "__main__":
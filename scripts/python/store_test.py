@@ -0,0 +1,81 @@
+#!/usr/bin/python2
+
+import unittest
+import tempfile
+import shutil
+import os
+
+from pss.store import ChunkStore
+from pss.bzz import Bzz
+from bzz_test import FakeAgent
+
+hsha = "aa" * 32
+hshb = "bb" * 32
+
+
+class TestChunkStore(unittest.TestCase):
+
+
+	def setUp(self):
+		self.dir = tempfile.mkdtemp()
+		self.path = os.path.join(self.dir, ".pss-chunks")
+		self.store = ChunkStore(self.path)
+
+
+	# chunks survive reopening the store
+	def test_reopen(self):
+		self.store.put(hsha, "inky")
+		self.assertEqual(self.store.get(hsha), "inky")
+		self.store.put(hshb, "pinky" * 1000)
+		self.assertEqual(self.store.get(hshb), "pinky" * 1000)
+		self.store.close()
+
+		self.store = ChunkStore(self.path)
+		self.assertEqual(self.store.count(), 2)
+		self.assertEqual(self.store.get(hsha), "inky")
+		self.assertEqual(self.store.get(hshb), "pinky" * 1000)
+		self.assertEqual(self.store.get("cc" * 32), None)
+
+
+	# incomplete record at end of file is dropped
+	def test_truncated(self):
+		self.store.put(hsha, "inky")
+		self.store.put(hshb, "pinky")
+		self.store.close()
+		f = open(self.path, "r+b")
+		f.truncate(os.path.getsize(self.path) - 2)
+		f.close()
+
+		self.store = ChunkStore(self.path)
+		self.assertEqual(self.store.count(), 1)
+		self.store.put(hshb, "pinky")
+		self.assertEqual(self.store.get(hshb), "pinky")
+
+
+	# chunks beyond maximum size are not stored
+	def test_maxsize(self):
+		self.store.close()
+		os.unlink(self.path)
+		self.store = ChunkStore(self.path, 100)
+		self.assertTrue(self.store.put(hsha, "x" * 50))
+		self.assertFalse(self.store.put(hshb, "x" * 50))
+		self.assertEqual(self.store.get(hshb), None)
+		self.assertEqual(os.path.getsize(self.path), 86)
+
+
+	# bzz reads through store before going to network
+	def test_bzz(self):
+		agent = FakeAgent()
+		agent.chunks[hsha] = "blinky"
+		Bzz(agent, None, self.store).get(hsha)
+		self.assertEqual(Bzz(agent, None, self.store).get(hsha), "blinky")
+		self.assertEqual(agent.requests, 1)
+
+
+	def tearDown(self):
+		self.store.close()
+		shutil.rmtree(self.dir)
+
+
+if __name__ == "__main__":
+	unittest.main()
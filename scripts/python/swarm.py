@@ -3,6 +3,7 @@
 import weechat
 import os
 import sys
+import collections
 import pss # plugin package, nothing official
 
 # consts
@@ -21,10 +22,28 @@ PSS_BUFTYPE_CHAT = "\x11"
 
 PSS_DEFAULT_NICK = "me"
 
+PSS_GATEWAY_PORT = 8500
+PSS_GATEWAY_POOLSIZE = 4
+
+# keep swarm chunks on disk across sessions
+# off by default, as the store file is never compacted; it stops growing at CHUNKSTORE_MAX_SIZE in pss/store.py
+PSS_CHUNKSTORE = False
+
 PSS_FEEDBOX_PERIOD = 1000
 PSS_FEEDQUEUE_SIZE = 10
 PSS_ROOM_PERIOD = PSS_FEEDBOX_PERIOD
 
+# limits on room history retrieval per timer tick, so long backlogs don't freeze the client
+PSS_ROOM_HOPS = 32
+PSS_ROOM_BUDGET = 0.05
+PSS_CHECKPOINT_PERIOD = 60000
+
+# how often input held back while the node is behind on sends is offered again
+PSS_INPUT_PERIOD = 250
+
+# number of peer registrations between progress reports on node connect
+PSS_PEER_PROGRESS_STEP = 256
+
 # cache handles in-memory representations
 # of contacts, feeds, rooms and swarm nodes
 cache = None
@@ -35,6 +54,9 @@ hookFds = {}
 # hook for swarm gateway socket
 hookSocks = []
 
+# hook for swarm gateway socket reads, per gateway connection pool
+hookBzzFds = {}
+
 # hook for feed queue processing timers
 hookTimers = []
 
@@ -47,6 +69,10 @@ feedOutQueue = pss.Queue(PSS_FEEDQUEUE_SIZE)
 # \todo deprecate this global, always use EventContext instead
 bufs = {}
 
+# chat input held back while node is behind on sends, per node
+# pss name => queue of (buffer, input) in the order typed
+heldInput = {}
+
 # path to scripts
 scriptPath = ""
 
@@ -58,8 +84,6 @@ loadSigHook = None
 # \todo replace with ENCRYPTED key/value store
 storeFile = None
 
-# stream processor
-stream = pss.Stream()
 
 
 # FeedUpdate encapsulates a single update to be sent on the network
@@ -282,9 +306,38 @@ def pss_connect(ctxid, status, tlsrc, sock, error, ip):
 		"!!!",
 		"swarm gateway connected on " + ctx.get_name() + ", sock " + repr(sock)
 	)
-	agent = pss.Agent(ctx.get_pss().get_host(), 8500, sock)
+	# all nodes using the same gateway share one connection pool
+	# the connection weechat made for us is the first one in the pool
+	host = ctx.get_pss().get_host()
+	pool = cache.get_agent_pool(host, PSS_GATEWAY_PORT)
+	if pool == None:
+		pool = pss.AgentPool(host, PSS_GATEWAY_PORT, PSS_GATEWAY_POOLSIZE, pss.Agent(host, PSS_GATEWAY_PORT, sock))
+
+		# dispatch responses to non-blocking gateway requests from the main loop
+		# connections the pool opens later, if not all could be opened now, are hooked as they are opened
+		poolKey = pool.get_key()
+		def hookBzzFd(fd):
+			hookBzzFds[poolKey].append(weechat.hook_fd(fd, 1, 0, 0, "bzzSockRead", poolKey))
+		hookBzzFds[poolKey] = []
+		for fd in pool.fds():
+			hookBzzFd(fd)
+		pool.onconnect = hookBzzFd
+
+		try:
+			pool.connect()
+		except Exception as e:
+			wOut(PSS_BUFPFX_WARN, [], "!!!", "could not open all gateway connections: " + repr(e))
+		cache.add_agent_pool(pool)
+	else:
+		os.close(sock)
 
-	bzz = pss.Bzz(agent)
+	chunkstore = None
+	if PSS_CHUNKSTORE:
+		try:
+			chunkstore = cache.get_chunk_store()
+		except Exception as e:
+			wOut(PSS_BUFPFX_WARN, [], "!!!", "could not open chunk store: " + repr(e))
+	bzz = pss.Bzz(pool, None, chunkstore)
 	cache.add_bzz(bzz, ctx.get_name())
 	ctx.set_bzz(bzz)
 
@@ -309,6 +362,21 @@ def pss_connect(ctxid, status, tlsrc, sock, error, ip):
 	return weechat.WEECHAT_RC_OK
 
 
+# handle responses for pending non-blocking requests on swarm gateway socket
+def bzzSockRead(poolKey, fd):
+	try:
+		cache.pools[poolKey].process(int(fd))
+	except Exception as e:
+		wOut(
+			PSS_BUFPFX_DEBUG,
+			[],
+			"",
+			"gateway read fail: " + repr(e)
+		)
+	return weechat.WEECHAT_RC_OK
+
+
+
 _tmp_chat_queue_hash = {}
 _tmp_room_queue_hash = {}
 _tmp_room_initial = {}
@@ -357,6 +425,21 @@ def processFeedOutQueue(pssName, _):
 
 
 
+# store feed positions to resume from on next load
+def saveCheckpoints(data, _):
+	try:
+		cache.save_checkpoints()
+	except Exception as e:
+		wOut(
+			PSS_BUFPFX_WARN,
+			[],
+			"!!!",
+			"could not save feed positions: " + repr(e)
+		)
+	return weechat.WEECHAT_RC_OK
+
+
+
 # \todo conceal feed queries in room obj
 def roomRead(pssName, _):
 	global _tmp_room_initial
@@ -372,7 +455,18 @@ def roomRead(pssName, _):
 		ctx.reset(PSS_BUFTYPE_ROOM, pssName, r.get_name())
 		buf = weechat.buffer_search("python", ctx.to_buffer_name())
 
-		(_, fails) = r.feedcollection.gethead(cache.get_active_bzz(), True)
+		# retry updates lost to failed retrievals, when due
+		(_, recovered, pending) = r.feedcollection.repair(cache.get_active_bzz(), budget=PSS_ROOM_BUDGET)
+		if recovered > 0:
+			wOut(
+				PSS_BUFPFX_INFO,
+				[buf],
+				"---",
+				"Recovered " + str(recovered) + " missing message ranges, " + str(pending) + " still pending"
+			)
+
+		# unfinished retrievals continue on next tick
+		(_, fails) = r.feedcollection.gethead(cache.get_active_bzz(), True, hops=PSS_ROOM_HOPS, budget=PSS_ROOM_BUDGET)
 		for f in fails:
 			nick = cache.get_contact_by_public_key(f.get_public_key()).get_nick()
 			nickbufp = weechat.nicklist_search_nick(buf, "", nick)
@@ -387,6 +481,18 @@ def roomRead(pssName, _):
 
 
 		msgs = r.feedcollection.get()
+		dropped = r.feedcollection.overflow()
+		if dropped > 0:
+			wOut(
+				PSS_BUFPFX_WARN,
+				[buf],
+				"---",
+				"Retrieval buffer full, " + str(dropped) + " messages were dropped"
+			)
+		try:
+			r.prefetch_states([m.content for m in msgs])
+		except Exception as e:
+			sys.stderr.write("participant list prefetch fail: " + repr(e) + "\n")
 		#sys.stderr.write("getting feed for room: " + repr(r) + ": " + "msglen" + repr(len(msgs)))
 
 		for m in msgs:
@@ -423,8 +529,8 @@ def roomRead(pssName, _):
 	return weechat.WEECHAT_RC_OK	
 
 
-# perform a single read from incoming pss websocket file descriptor
-# \todo move this to a method of Pss object, so we can evaluate rpc replies to commands (such as setPeerPublicKey
+# read all incoming messages available on pss websocket file descriptor
+# responses to requests are handled by the Pss object, only subscription notifications are returned here
 def msgPipeRead(pssName, fd):
 
 	# the received message
@@ -445,36 +551,35 @@ def msgPipeRead(pssName, fd):
 	if fd < 0:
 		return weechat.WEECHAT_RC_ERROR
 
-	# get the data	
+	# get all complete messages available
 	# \todo how to handle failure
-	try:	
-		msg = os.read(fd, 1024)
-	except OSError as e:
+	try:
+		processed = cache.get_pss(pssName).read()
+	except IOError as e:
+		sys.stderr.write("pss read fail: " + repr(e) + "\n")
 		return weechat.WEECHAT_RC_OK
 
-	# parse the stream, and build whole stanzas
-	# will also detect connection events, using the last one found as the current state
-	# \todo remove json handling to websocket comms background process
-	processed = stream.process(msg)
+	# node closed the connection, stop listening on it
+	if not cache.get_pss(pssName).connected:
+		weechat.unhook(hookFds[pssName])
+		del hookFds[pssName]
+		wOut(PSS_BUFPFX_ERROR, [bufs[pssName]], "-1-x 0", "connection to '" + pssName + "' closed by node, connect again to resume")
 
-	# loop through all built stanzas
-	for o in processed['results']:
-	
-		# holds content data structure 
-		r = ""
+	# loop through all received notifications
+	for r in processed:
 
 		# check if data is valid	
 		try:
-			r = pss.rpc_parse(o)
-			_ = r['params']['result']
+			_ = r['params']['result']['Msg'][2:].decode("hex")
+			_ = r['params']['result']['Key']
 		except Exception as e:
 			wOut(
 				PSS_BUFPFX_DEBUG,
 				[bufs[pssName]],
 				"",
-				"skipping invalid receive: " + repr(o)
+				"skipping invalid receive: " + repr(r)
 			)
-			return weechat.WEECHAT_RC_OK
+			continue
 	
 		# decode contents and display in buffer
 		msgSrc = r['params']['result']['Msg'][2:].decode("hex")
@@ -483,6 +588,16 @@ def msgPipeRead(pssName, fd):
 		fromKeyHex = pss.clean_pubkey(r['params']['result']['Key'])
 		fromKey = fromKeyHex.decode("hex")
 
+		# room notices are not displayed, they make the sender's room feed due for retrieval on the next roomRead tick
+		if pss.is_room_notice(msgSrc):
+			try:
+				(roomname, hsh) = pss.parse_room_notice(msgSrc)
+				if not cache.get_room(roomname).notice(fromKey, hsh):
+					raise KeyError("sender not in room")
+			except (KeyError, ValueError) as e:
+				sys.stderr.write("ignoring room notice from " + fromKeyHex + ": " + repr(e) + "\n")
+			continue
+
 		# \todo add pss name and sender nick name to ctx
 		ctx = EventContext()
 		ctx.set_pss(cache.get_pss(pssName))
@@ -645,37 +760,141 @@ def buf_in(pssName, buf, inputdata):
 		room = cache.get_room(ctx.get_name())
 		for f in room.feedcollection.feeds.keys():
 			sys.stderr.write("f is " + repr(f) + "\n")	
-		hsh = room.send(inputdata)
+		hsh = room.send(inputdata, notify=ctx.get_pss())
 		sys.stderr.write("room update: " + hsh + "\n")
 		
 
 	else:
-		# send message
-		try:
-			ctx.get_pss().send(cache.get_contact_by_nick(ctx.get_name()), inputdata)
+		# node is falling behind, hold input back until it catches up
+		# input typed later waits behind held input, so messages keep their order
+		held = heldInput.get(ctx.get_node())
+		if held != None or not ctx.get_pss().send_ready():
+			if held == None:
+				held = collections.deque()
+				heldInput[ctx.get_node()] = held
+			held.append((buf, inputdata))
 			wOut(
-				PSS_BUFPFX_OUT,
-				[ctx.get_buffer()],
-				"you",
-				inputdata
+				PSS_BUFPFX_WARN,
+				[buf],
+				"!!!",
+				str(ctx.get_pss().send_backlog()) + " messages waiting for node, " + str(len(held)) + " held back"
 			)
-			
-		except Exception as e:
+			return weechat.WEECHAT_RC_OK
+
+		return chat_send(ctx, buf, inputdata)
+
+	return weechat.WEECHAT_RC_OK
+
+
+
+# send chat input to node
+# errors reported by the node arrive later with the response
+def chat_send(ctx, buf, inputdata):
+	def sent(result, err):
+		if err != None:
 			wOut(
 				PSS_BUFPFX_ERROR,
 				[buf],
 				"!!!",
-				"send fail: " + repr(e)
+				"send fail: " + str(err)
 			)
-			return weechat.WEECHAT_RC_ERROR
 
-		peercontact = cache.get_contact_by_nick(ctx.get_name())
-		if peercontact.is_owner():
-			feedcoll = cache.chats[peercontact.get_public_key()][ctx.get_node()]
-			# \todo should not do direct write, should go via msg object
-			hsh = feedcoll.write(inputdata)
-			sys.stderr.write("wrote update to swarm, got " + hsh + "\n")
+	try:
+		ctx.get_pss().send(cache.get_contact_by_nick(ctx.get_name()), inputdata, sent)
+		wOut(
+			PSS_BUFPFX_OUT,
+			[ctx.get_buffer()],
+			"you",
+			inputdata
+		)
+
+		# node is falling behind, tell the user messages are held back
+		if not ctx.get_pss().connected:
+			wOut(
+				PSS_BUFPFX_WARN,
+				[ctx.get_buffer()],
+				"!!!",
+				"not connected, message will be sent on reconnect"
+			)
+		elif not ctx.get_pss().send_ready():
+			wOut(
+				PSS_BUFPFX_WARN,
+				[ctx.get_buffer()],
+				"!!!",
+				str(ctx.get_pss().send_backlog()) + " messages waiting for node"
+			)
+		
+	except Exception as e:
+		wOut(
+			PSS_BUFPFX_ERROR,
+			[buf],
+			"!!!",
+			"send fail: " + repr(e)
+		)
+		return weechat.WEECHAT_RC_ERROR
+
+	peercontact = cache.get_contact_by_nick(ctx.get_name())
+	if peercontact.is_owner():
+		feedcoll = cache.chats[peercontact.get_public_key()][ctx.get_node()]
+		# \todo should not do direct write, should go via msg object
+		hsh = feedcoll.write(inputdata)
+		sys.stderr.write("wrote update to swarm, got " + hsh + "\n")
+
+	return weechat.WEECHAT_RC_OK
+
+
+
+# offer input held back by buf_in to the node again, as far as its send window allows
+def releaseInput(data, _):
+	for pssName in heldInput.keys():
+		held = heldInput[pssName]
+		pssnode = cache.get_pss(pssName)
+		while len(held) > 0 and pssnode.send_ready():
+			(buf, inputdata) = held.popleft()
+			ctx = EventContext()
+			ctx.parse_buffer(buf)
+			ctx.set_pss(pssnode)
+			chat_send(ctx, buf, inputdata)
+		if len(held) == 0:
+			del heldInput[pssName]
+	return weechat.WEECHAT_RC_OK
+
+
+
+# builds progress report for registration of contacts with node
+def peer_progress(pssName):
+	def registered(count, total):
+		if count == total or count % PSS_PEER_PROGRESS_STEP == 0:
+			wOut(PSS_BUFPFX_INFO, [bufs[pssName]], "0---0", "registered " + str(count) + " of " + str(total) + " contacts with node")
+	return registered
+
+
+
+# connect existing node again after connection was lost or stopped
+# messages queued while disconnected are sent once connected
+def pss_reconnect(pssName):
+	pssnode = cache.get_pss(pssName)
+
+	wOut(
+		PSS_BUFPFX_WARN,
+		[bufs[pssName]],
+		"0-> 0",
+		"reconnecting to '" + pssName + "'"
+	)
+
+	if not pssnode.connect():
+		wOut(PSS_BUFPFX_ERROR, [bufs[pssName]], "-1-x 0", "reconnect to '" + pssName + "' failed: " + pssnode.error()['description'])
+		return weechat.WEECHAT_RC_ERROR
+
+	wOut(PSS_BUFPFX_OK, [bufs[pssName]], "0---0", "connected to '" + pssName + "'")
+
+	if pssName in hookFds:
+		weechat.unhook(hookFds.pop(pssName))
+	hookFds[pssName] = weechat.hook_fd(pssnode.get_fd(), 1, 0, 0, "msgPipeRead", pssName)
+	cache.update_node_contact(pssName, peer_progress(pssName))
 
+	if pssnode.send_backlog() > 0:
+		wOut(PSS_BUFPFX_INFO, [bufs[pssName]], "0---0", "sending " + str(pssnode.send_backlog()) + " queued messages")
 
 	return weechat.WEECHAT_RC_OK
 
@@ -683,20 +902,25 @@ def buf_in(pssName, buf, inputdata):
 
 # when buffer is closed, node should also close down
 def buf_close(pssName, buf):
+	heldInput.pop(pssName, None)
 	cache.close_node(pssName)
 	return weechat.WEECHAT_RC_OK
 
 
+# add contacts to room, publishing one new participant list
+# returns nicks that were added
 # \todo broken
-def pss_invite(pssName, nick, room):
+def pss_invite(pssName, nicks, room):
 
 
 	#bufname = buf_generate_name(pssName, "room", nick)
 	#feeds[bufname] = pss.Feed(bzzs[pssName].agent, psses[pssName].get_account(), "d" + pss.publickey_to_address(remotekeys[nick]))
-	contact = cache.get_contact_by_nick(nick)
+	contacts = []
+	for nick in nicks:
+		contacts.append((nick, cache.get_contact_by_nick(nick)))
 	#nickkey = remotekeys[nick]
 	#contact = nicks[nickkey]
-	room.add(nick, contact)
+	return room.add_many(contacts)
 	#wOut(PSS_BUFPFX_DEBUG, [], "", "added room feed with topic " + feeds[bufname].topic.encode("hex"))
 
 
@@ -747,6 +971,8 @@ def pss_handle(pssName, buf, args):
 		if cache.have_node_name(ctx.get_node()):	
 			existingBuf = weechat.buffer_search("python", "pss.node." + ctx.get_node())
 			if existingBuf != "":
+				if not cache.get_pss(ctx.get_node()).connected:
+					return pss_reconnect(ctx.get_node())
 				wOut(PSS_BUFPFX_DEBUG, [], "", "pss " + ctx.get_node() + " already exists, changing to that buffer")
 				weechat.buffer_set(bufs[ctx.get_node()], "display", "1")
 				return weechat.WEECHAT_RC_OK
@@ -791,7 +1017,9 @@ def pss_handle(pssName, buf, args):
 		wOut(PSS_BUFPFX_OK, [bufs[ctx.get_node()]], "0---0", "connected to '" + ctx.get_node() + "'")
 
 		_tmp_chat_queue_hash[ctx.get_node()] = ""
-		cache.add_node(pssnode)
+
+		# stored contacts are registered with the node in the background, responses arrive through msgPipeRead
+		cache.add_node(pssnode, peer_progress(ctx.get_node()))
 
 		wOut(PSS_BUFPFX_OK, [], "+++", "added pss " + ctx.get_node())
 
@@ -802,7 +1030,7 @@ def pss_handle(pssName, buf, args):
 		ctx.set_bzz(cache.get_active_bzz())
 		# \todo temporary solution, swarm gateway should be set explicitly or at least we need to be able to choose port
 		ctxid = ctxstore.put(ctx)
-		hookSocks.append(weechat.hook_connect("", host, 8500, 0, 0, "", "pss_connect", ctxid))
+		hookSocks.append(weechat.hook_connect("", host, PSS_GATEWAY_PORT, 0, 0, "", "pss_connect", ctxid))
 		
 
 
@@ -1021,14 +1249,45 @@ def pss_handle(pssName, buf, args):
 		buf_get(ctx, True)
 
 
+	# poll all feeds of a room right away, regardless of schedule
+	# room argument can be omitted if command is issued in the room buffer
+	elif argv[0] == "refresh":
+
+		if argc > 1:
+			ctx.reset(PSS_BUFTYPE_ROOM, ctx.get_node(), argv[1])
+		elif not ctx.is_room():
+			wOut(
+				PSS_BUFPFX_ERROR,
+				[ctx.get_buffer()],
+				"!!!",
+				"not enough arguments for refresh"
+			)
+			return weechat.WEECHAT_RC_ERROR
+
+		try:
+			room = cache.get_room(ctx.get_name())
+		except KeyError as e:
+			wOut(
+				PSS_BUFPFX_ERROR,
+				[ctx.get_buffer()],
+				"!!!",
+				"Unknown room: " + str(e)
+			)
+			return weechat.WEECHAT_RC_ERROR
+
+		room.feedcollection.schedule.force()
+		roomRead(ctx.get_node(), "")
+
+
 	# invite works in context of chat rooms, and translates in swarm terms to
 	# adding one separate feed encoded with the invited peer's key
 	# room argument can be omitted if command is issued om channel to invite to
+	# several nicks can be invited at once separated by comma, which publishes only one new participant list
 	# note feeds are currently unencrypted
 	# \todo broken
 	elif argv[0] == "invite":
 
-		nick = ""
+		nicks = []
 		roomname = ""
 
 		if argc < 2:
@@ -1038,6 +1297,7 @@ def pss_handle(pssName, buf, args):
 				"!!!",
 				"not enough arguments for invite"
 			)
+			return weechat.WEECHAT_RC_ERROR
 
 		# if missing channel argument get bufname command was issued in
 		# and derive channel name from it if we can (fail if not)
@@ -1054,7 +1314,16 @@ def pss_handle(pssName, buf, args):
 		else:
 			ctx.set_name(argv[2])
 
-		nick = pss.clean_nick(argv[1])
+		try:
+			nicks = [pss.clean_nick(n) for n in argv[1].split(",") if n != ""]
+		except ValueError as e:
+			wOut(
+				PSS_BUFPFX_ERROR,
+				[ctx.get_buffer()],
+				"!!!",
+				"Invalid nick: " + str(e)
+			)
+			return weechat.WEECHAT_RC_ERROR
 
 		# check if room exists
 		# if it does, perform invitation
@@ -1062,16 +1331,17 @@ def pss_handle(pssName, buf, args):
 			#roombufname = buf_generate_name(pssName, "room", roomname)
 			roombufname = ctx.to_buffer_name()
 			room = cache.get_room(ctx.get_name()) #roombufname)
-			pss_invite(pssName, nick, room)
+			added = pss_invite(pssName, nicks, room)
 			wOut(
 				PSS_BUFPFX_DEBUG,
 				[],
 				"!!!",
-				"added " + nick + " to " + ctx.get_name()
+				"added " + ",".join(added) + " to " + ctx.get_name()
 			)
-			# if neither the previous fail, add the nick to the buffer
+			# if neither the previous fail, add the nicks to the buffer
 			roombuf = weechat.buffer_search("python", roombufname)
-			buf_room_add(roombuf, nick)
+			for nick in added:
+				buf_room_add(roombuf, nick)
 
 		except KeyError as e: # keyerror catches both try statements
 			wOut(
@@ -1126,7 +1396,8 @@ def pss_handle(pssName, buf, args):
 	# \todo also kill the subprocess 
 	# \todo ensure clean shutdown so conncet can be called over
 	elif argv[0] == "stop":
-		weechat.unhook(hookFds[ctx.get_node()])
+		if ctx.get_node() in hookFds:
+			weechat.unhook(hookFds.pop(ctx.get_node()))
 		wOut(
 			PSS_BUFPFX_INFO,
 			[ctx.get_buffer()],
@@ -1191,6 +1462,12 @@ def pss_sighandler_load(data, sig, sigdata):
 		"successfully imported " + str(okcount) + " of " + str(entrycount) + " store entries"
 	)
 	
+	# save feed positions regularly, so a crash doesn't lose more than one period
+	hookTimers.append(weechat.hook_timer(PSS_CHECKPOINT_PERIOD, 0, 0, "saveCheckpoints", ""))
+
+	# send chat input held back while the node was behind
+	hookTimers.append(weechat.hook_timer(PSS_INPUT_PERIOD, 0, 0, "releaseInput", ""))
+
 	# signal is not needed anymore now, unhook and stop it from propagating
 	weechat.unhook(loadSigHook)
 	return weechat.WEECHAT_RC_OK_EAT
@@ -1231,6 +1508,7 @@ cmd_main = weechat.hook_command(
 	" <name> connect: connect to node\n"
 	" <name>     add: add new contact\n"
 	" <name>     msg: send message to contact\n"
+	" <name> refresh: poll room for new messages now\n"
 	" <name>    stop: disconnect from node\n"
 	" <name>     key: display public key\n"
 	" <name>    addr: display overlay address\n"